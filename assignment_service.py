@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import urllib.parse
+
+from munch import Munch
+
+import data
+import db
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class AssignmentService:
+    """Assigns the samples of a study for any number of `main.py` workers.
+
+    The service is the single writer of the study database, so several
+    Streamlit processes, also on other hosts, can share a study by setting
+    `service.url`. The frequencies are kept in memory by the sampler of the
+    service process and the background refresher and reservation pool run
+    here instead of in the workers.
+
+    Requests are collected for up to `batch_window` seconds or `batch_size`
+    users, including all requests that arrive while the previous batch is
+    written, and assigned with `data.assign_batch` in a single transaction on
+    a dedicated thread. An error assigning one user only fails the request
+    of that user.
+    """
+
+    def __init__(self, config, batch_size: int = 64, batch_window: float = 0.002):
+        self.config = config
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        # all writes happen on this thread, the event loop only does I/O
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="assign")
+        self._queue = None
+
+    def _assign_batch(self, user_ids):
+        dataset = data.get_dataset(
+            self.config.paths.dataset, self.config.data.instance_id_key
+        )
+        database = db.get_database(self.config.paths.db)
+        with database.connect() as con:
+            return data.assign_batch(self.config, con, dataset, user_ids)
+
+    def _read_revision(self):
+        with db.get_database(self.config.paths.db).connect() as con:
+            return data.read_mapping_revision(con)
+
+    async def assign(self, user_id: str) -> list:
+        """Return the sample of `user_id` once its batch has been assigned"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((user_id, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            user_ids = [user_id for user_id, _ in batch]
+            logger.debug("assigning batch of %s requests", len(batch))
+            try:
+                with metrics.span("assign_batch"):
+                    samples, errors = await loop.run_in_executor(
+                        self._executor, self._assign_batch, user_ids
+                    )
+            except Exception as e:
+                logger.exception("could not assign batch")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for user_id, future in batch:
+                if future.done():
+                    continue
+                if user_id in errors:
+                    future.set_exception(errors[user_id])
+                else:
+                    future.set_result(samples[user_id])
+
+    async def _handle(self, reader, writer):
+        status, body = 500, {"error": "internal error"}
+        try:
+            request_line = await reader.readline()
+            # the headers are not needed
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            url = urllib.parse.urlsplit(target)
+            if method != "GET":
+                status, body = 405, {"error": "method not allowed"}
+            elif url.path == "/assign":
+                user_id = urllib.parse.parse_qs(url.query).get("user_id", [""])[0]
+                if user_id:
+                    instance_ids = await self.assign(user_id)
+                    status, body = 200, {"user_id": user_id, "instance_ids": instance_ids}
+                else:
+                    status, body = 400, {"error": "missing user_id"}
+            elif url.path == "/revision":
+                revision = await asyncio.get_running_loop().run_in_executor(
+                    None, self._read_revision
+                )
+                status, body = 200, {"revision": revision}
+            elif url.path == "/health":
+                status, body = 200, {"status": "ok"}
+            else:
+                status, body = 404, {"error": "not found"}
+        except Exception:
+            logger.exception("could not handle request")
+        finally:
+            payload = json.dumps(body).encode()
+            writer.write(
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode()
+                + payload
+            )
+            try:
+                await writer.drain()
+            finally:
+                writer.close()
+
+    async def serve(self, host: str, port: int, started=None):
+        """Serve until cancelled, `started` is called with the bound port"""
+        self._queue = asyncio.Queue()
+        batches = asyncio.create_task(self._run_batches())
+        # workers fall back to assigning in-process if the connection is
+        # refused, so don't refuse connections during bursts
+        server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        port = server.sockets[0].getsockname()[1]
+        logger.info("assignment service listening on http://%s:%s", host, port)
+        if started is not None:
+            started(port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches.cancel()
+
+
+def main(config_path, host=None, port=None):
+    """Runs the assignment service for the study implemented in config_path,
+    set `service.url` in the config of the workers to its url"""
+    # parse the config file to get the configured db path
+    config = Munch.fromYAML(open(config_path))
+    metrics.configure(config)
+
+    assert os.path.exists(config.paths.db)
+    options = config.get("service", {})
+    service = AssignmentService(
+        config,
+        batch_size=options.get("batch_size", 64),
+        batch_window=options.get("batch_window_ms", 2) / 1000,
+    )
+
+    # load the demographics and fill the pool before the first request
+    data.apply_participant_status(config)
+    if config.data.get("pool_size", 0):
+        data.get_reservation_pool(config)
+
+    # print the bound port for scripts starting the service with port 0
+    asyncio.run(
+        service.serve(
+            host or options.get("host", "localhost"),
+            options.get("port", 8100) if port is None else port,
+            started=lambda port: print(f"port {port}", flush=True),
+        )
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(asctime)s  %(levelname)s  %(name)s  %(funcName)16s()]:  %(message)s",
+        datefmt="%d.%m. %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path")
+    parser.add_argument("--host", help="defaults to service.host")
+    parser.add_argument("--port", type=int, help="defaults to service.port")
+
+    args = parser.parse_args()
+
+    main(args.config_path, args.host, args.port)
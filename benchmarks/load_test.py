@@ -0,0 +1,457 @@
+"""End-to-end load test of a study with simulated participants.
+
+Sets up a temporary study with `init_db.py` and a local stand-in for the
+prolific API (`fake_prolific.py`), then lets participants with distinct
+PROLIFIC_PIDs arrive concurrently and click through all pages of the survey.
+Every click does the server-side work of a rerun of `main.py`, without
+rendering widgets. Some participants return the study halfway, which the
+fake API reports so their instances are reassigned.
+
+With `--service` samples are assigned by `assignment_service.py` running in
+a subprocess, and with `--processes` the participants are spread over
+several worker processes sharing the study.
+
+Run from the repository root:
+
+    python -m benchmarks.load_test --participants 1000 --concurrency 100
+    python -m benchmarks.load_test --service --processes 4
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from munch import Munch
+
+import data
+import db
+import fake_prolific
+import init_db
+import plan as study_plan
+import results
+import utils
+
+
+class Recorder:
+    """Thread-safe collection of durations by name"""
+
+    def __init__(self):
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            self.durations.setdefault(name, []).append(duration)
+
+
+class TimedDatabase(db.Database):
+    """Records how long each write transaction waits for the db lock"""
+
+    def __init__(self, path, recorder):
+        super().__init__(path)
+        self.recorder = recorder
+
+    def _begin(self, cur):
+        start = time.perf_counter()
+        super()._begin(cur)
+        self.recorder.add("db lock wait", time.perf_counter() - start)
+
+
+class TimedLock:
+    """Records how long each acquisition of `lock` waits"""
+
+    def __init__(self, lock, recorder, name):
+        self.lock = lock
+        self.recorder = recorder
+        self.name = name
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.recorder.add(self.name, time.perf_counter() - start)
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Export:
+    """Writes the participant `statuses` served by the fake prolific API to
+    `path` in the background. `statuses` may be a shared dict of a
+    multiprocessing manager when participants run in several processes."""
+
+    def __init__(self, path, statuses, interval: float = 0.2):
+        self.path = path
+        self.statuses = statuses
+        self.interval = interval
+        self._stopped = threading.Event()
+        self.write()
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def write(self):
+        rows = list(self.statuses.items())
+        # the server re-reads the file on every request
+        with open(f"{self.path}.tmp", "w", newline="") as h:
+            writer = csv.writer(h)
+            writer.writerow(["Participant id", "Status"])
+            writer.writerows(rows)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._stopped.set()
+        self._writer.join()
+        self.write()
+
+
+def setup_study(args, api_url, service_url=""):
+    """Create dataset, config and database of the study in the current
+    directory and return the config path"""
+    with open("dataset.jsonl", "w") as h:
+        for i in range(args.instances):
+            h.write(json.dumps({"post_id": i, "text": f"instance {i}"}) + "\n")
+    with open("api_token.txt", "w") as h:
+        h.write("load-test")
+
+    config = Munch(
+        study=Munch(title="load test", completion_code="LOADTEST"),
+        paths=Munch(db="study.sqlite", dataset="dataset.jsonl"),
+        data=Munch(
+            instance_id_key="post_id",
+            instances_per_annotator=args.k,
+            attention_per_annotator=args.attention,
+            pool_size=args.pool_size,
+            pool_refill_interval=1,
+        ),
+        results=Munch(backend=args.results_backend, flush_interval=0.5),
+        api=Munch(
+            url=api_url,
+            study_id="load-test",
+            token_file="api_token.txt",
+            refresh_interval=args.refresh_interval,
+        ),
+        # fail instead of silently assigning in the worker processes
+        service=Munch(url=service_url, fallback=False),
+    )
+    with open("config.yml", "w") as h:
+        h.write(config.toYAML())
+
+    init_db.main("config.yml")
+    return "config.yml"
+
+
+def rerun(config_path, user_id, page_number, responses, session):
+    """The server-side work of one rerun of `main.py` showing `page_number`,
+    returns the `StudyPlan` of the user. `session` stands in for the session
+    state."""
+    config = utils.load_config(config_path)
+    dataset = data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+    instances, attentions = data.get_session_instances(
+        session, config, dataset, user_id
+    )
+
+    store = results.get_results_store(config, config_path)
+    if page_number == 0:
+        store.load(user_id)
+
+    plan = study_plan.get_study_plan(config_path, len(instances))
+    page = plan.get(page_number)
+    # the rendered instance
+    if page.kind == study_plan.INSTANCE:
+        dataset[instances[page.index]]
+    elif page.kind == study_plan.ATTENTION:
+        attentions[page.index]
+    dataset.prefetch([instances[index] for index in plan.upcoming_instances(page_number, 2)])
+
+    responses[f"page_{page_number}"] = "answer"
+    store.save(user_id, dict(responses))
+    return plan
+
+
+def participate(config_path, user_id, args, statuses, recorder):
+    """Click through all pages of the survey as `user_id`, returns whether
+    the participant completed the study"""
+    statuses[user_id] = "ACTIVE"
+    returns = random.random() < args.return_rate
+
+    responses = {}
+    session = {}
+    page_number = 0
+    while True:
+        start = time.perf_counter()
+        plan = rerun(config_path, user_id, page_number, responses, session)
+        duration = time.perf_counter() - start
+        if page_number == 0:
+            recorder.add("assignment", duration)
+        recorder.add(f"page {page_number:>2} {plan.pages[page_number].kind}", duration)
+
+        if returns and page_number >= plan.num_pages // 2:
+            statuses[user_id] = "RETURNED"
+            return False
+        if page_number == plan.num_pages - 1:
+            statuses[user_id] = "AWAITING REVIEW"
+            return True
+
+        if args.think_time:
+            time.sleep(random.expovariate(1 / args.think_time))
+        page_number += 1
+
+
+def run_participants(config_path, indices, args, statuses, start, concurrency):
+    """Let the participants with the given `indices` arrive, returns the
+    number of completed participants and the recorded durations"""
+    recorder = Recorder()
+
+    def arrive(i):
+        if args.arrival_rate:
+            time.sleep(max(0, start + i / args.arrival_rate - time.time()))
+        return participate(config_path, f"participant_{i}", args, statuses, recorder)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        completed = sum(executor.map(arrive, indices))
+
+    # pool processes exit without running atexit handlers
+    config = utils.load_config(config_path)
+    results.get_results_store(config, config_path).flush()
+    return completed, recorder.durations
+
+
+def start_service(config_path, port, log_level):
+    """Start `assignment_service.py` for the study in a subprocess"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(root, "assignment_service.py"), config_path]
+        + ["--port", str(port)],
+        stdout=subprocess.PIPE,
+        stderr=None if log_level in ("DEBUG", "INFO") else subprocess.DEVNULL,
+        env={**os.environ, "PYTHONPATH": root},
+        text=True,
+    )
+    # printed once the service accepts connections
+    for line in process.stdout:
+        if line.startswith("port"):
+            return process
+    raise RuntimeError("assignment service did not start")
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def report_durations(recorder):
+    print(f"{'':<24} {'n':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for name in sorted(recorder.durations):
+        durations = sorted(recorder.durations[name])
+        n = len(durations)
+        p50, p90, p99 = (durations[min(n - 1, int(q * n))] for q in (0.5, 0.9, 0.99))
+        print(
+            f"{name:<24} {n:>7} {p50 * 1e3:>7.2f}ms {p90 * 1e3:>7.2f}ms"
+            f" {p99 * 1e3:>7.2f}ms {durations[-1] * 1e3:>7.2f}ms"
+        )
+
+
+def report_balance(config):
+    """Recompute the instance frequencies from the mapping and the final
+    participant statuses with `data.get_frequencies`"""
+    database = db.get_database(config.paths.db)
+    with database.connect() as con:
+        mapping = {
+            user_id: json.loads(instance_ids)
+            for user_id, instance_ids in con.execute(
+                "SELECT user_id, instance_ids FROM mapping"
+            )
+        }
+        participant_status = dict(
+            con.execute("SELECT user_id, status FROM participant_status")
+        )
+        table = dict(con.execute("SELECT instance_id, frequency FROM instance_frequency"))
+
+    dataset = data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+    rejected = data.get_rejected(config, participant_status)
+    frequencies = data.get_frequencies(config, dataset, mapping, rejected)
+    values = list(frequencies.values())
+    print(
+        f"coverage of {len(values)} instances by {len(mapping) - len(rejected)}"
+        f" non-rejected users: min {min(values)}, mean {statistics.mean(values):.2f},"
+        f" max {max(values)}, stdev {statistics.pstdev(values):.2f}"
+    )
+    drift = sum(abs(table.get(i, 0) - f) for i, f in frequencies.items())
+    reserved = "including reserved samples " if config.data.pool_size else ""
+    print(f"instance_frequency table {reserved}differs by {drift} assignments")
+
+
+def main(args):
+    logging.basicConfig(level=args.log_level)
+
+    directory = tempfile.mkdtemp(prefix="load_test_")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        if args.processes > 1:
+            assert args.service, "only the assignment service supports several processes"
+            manager = multiprocessing.get_context("fork").Manager()
+            statuses = manager.dict()
+        else:
+            statuses = {}
+        export = Export("prolific_export.csv", statuses)
+        server = fake_prolific.serve(
+            "prolific_export.csv", latency=args.api_latency, failure_rate=args.api_failure_rate
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        service_url = ""
+        if args.service:
+            service_port = get_free_port()
+            service_url = f"http://localhost:{service_port}"
+        config_path = setup_study(
+            args, f"http://localhost:{server.server_address[1]}", service_url
+        )
+        config = utils.load_config(config_path)
+        service = start_service(config_path, service_port, args.log_level) if args.service else None
+
+        recorder = Recorder()
+        db._databases[config.paths.db] = TimedDatabase(config.paths.db, recorder)
+        data._assignment_lock = TimedLock(
+            data._assignment_lock, recorder, "assignment lock wait"
+        )
+
+        start = time.time()
+        if args.processes > 1:
+            concurrency = -(-args.concurrency // args.processes)
+            with multiprocessing.get_context("fork").Pool(args.processes) as pool:
+                outcomes = pool.starmap(
+                    run_participants,
+                    [
+                        (config_path, range(p, args.participants, args.processes), args)
+                        + (statuses, start, concurrency)
+                        for p in range(args.processes)
+                    ],
+                )
+        else:
+            outcomes = [
+                run_participants(
+                    config_path, range(args.participants), args, statuses, start, args.concurrency
+                )
+            ]
+        elapsed = time.time() - start
+
+        completed = 0
+        for process_completed, durations in outcomes:
+            completed += process_completed
+            for name, values in durations.items():
+                recorder.durations.setdefault(name, []).extend(values)
+
+        # apply the final statuses before checking the balance
+        export.stop()
+        if service is not None:
+            # the refresher of the service is the only one writing
+            time.sleep(2 * args.refresh_interval + args.api_latency)
+            service.terminate()
+            service.wait()
+        else:
+            refresher = data.get_demographics_refresher(config)
+            for _ in range(10):
+                try:
+                    refresher.refresh()
+                    break
+                except Exception:
+                    time.sleep(args.api_latency)
+
+        reruns = sum(
+            len(durations)
+            for name, durations in recorder.durations.items()
+            if name.startswith("page")
+        )
+        print(
+            f"{args.participants} participants ({completed} completed) in {elapsed:.2f}s:"
+            f" {args.participants / elapsed:.1f} participants/s, {reruns / elapsed:.1f} reruns/s"
+        )
+        if service is not None:
+            print("the lock waits of the assignment service are not recorded")
+        report_durations(recorder)
+        report_balance(config)
+        server.shutdown()
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"kept study in {directory}")
+        else:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participants", type=int, default=200)
+    parser.add_argument(
+        "--concurrency", type=int, default=50, help="participants active at once"
+    )
+    parser.add_argument(
+        "--arrival-rate",
+        type=float,
+        default=0,
+        help="participants arriving per second, 0 for all at once",
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0, help="mean seconds spent on a page"
+    )
+    parser.add_argument(
+        "--return-rate",
+        type=float,
+        default=0.1,
+        help="fraction of participants returning the study halfway",
+    )
+    parser.add_argument("--instances", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=15, help="instances per annotator")
+    parser.add_argument("--attention", type=int, default=2)
+    parser.add_argument("--pool-size", type=int, default=0)
+    parser.add_argument("--results-backend", choices=["files", "db"], default="files")
+    parser.add_argument(
+        "--refresh-interval",
+        type=float,
+        default=1,
+        help="seconds between polls of the fake prolific API",
+    )
+    parser.add_argument("--api-latency", type=float, default=0.0)
+    parser.add_argument("--api-failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--service",
+        action="store_true",
+        help="assign through assignment_service.py instead of in-process",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="worker processes to spread the participants over, requires --service",
+    )
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument(
+        "--keep", action="store_true", help="don't delete the temporary study"
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,439 @@
+"""Micro-benchmarks of the assignment and routing hot paths on synthetic
+data, and checks of the balance of the samplers.
+
+Timed functions, for 1e3 to 1e6 instances and 1e2 to 1e5 users:
+
+- `data.load_jsonl` of a dataset with short texts
+- `data.get_frequencies` from a mapping of all users
+- `data.get_sample` with a dict of frequencies and with a
+  `sampling.LeastFrequentSampler`
+- `data.parse_demographics` of an export with all users and
+  `data.get_rejected` of its statuses
+- `utils.get_attention_indices_offsets`, `plan.build_plan` and the page
+  lookups of `plan.StudyPlan` per rerun
+- `input_validation.Validator.is_valid` with the conditions of a page
+
+Every case reports the median time per call over `--repeats` batches and
+the interquartile range relative to it. With `--output` the results are
+appended to a JSON lines file, and the run fails if a case got slower than
+`--max-regression` relative to the last record in it with that case.
+
+The balance checks draw samples of `-k` instances from frequencies without
+rejections and fail the run if:
+
+- the frequencies of any two instances differ by more than 1 after any
+  sample (per stratum for `sampling.StratifiedSampler`)
+- the instances picked among equally frequent ones are not uniformly
+  distributed, by a chi-squared test at `--alpha`
+
+Run from the repository root:
+
+    python -m benchmarks.micro --output micro.jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from munch import Munch
+
+import data
+import input_validation
+import plan as study_plan
+import sampling
+import utils
+from benchmarks.startup import get_commit
+
+
+STATUSES = ["APPROVED", "AWAITING REVIEW", "ACTIVE", "RETURNED", "TIMED-OUT", "REJECTED"]
+STATUS_WEIGHTS = [60, 20, 5, 8, 4, 3]
+
+
+def measure(func, repeats, min_time=0.05):
+    """Return the median seconds per call of `func` over `repeats` batches,
+    each running it often enough to take at least `min_time`, and the
+    interquartile range relative to the median"""
+    start = time.perf_counter()
+    func()
+    number = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    if len(times) > 1:
+        quartiles = statistics.quantiles(times, n=4)
+        spread = (quartiles[2] - quartiles[0]) / statistics.median(times)
+    else:
+        spread = 0.0
+    return statistics.median(times), spread
+
+
+def get_mapping(instance_ids, num_users, k):
+    """Samples of `num_users` users drawn with the least frequent sampling,
+    as stored in the mapping table"""
+    sampler = sampling.LeastFrequentSampler(dict.fromkeys(instance_ids, 0))
+    return {f"user_{u}": sampler.sample(k) for u in range(num_users)}
+
+
+def get_export(user_ids):
+    """A demographics export of the prolific API with `user_ids`"""
+    h = io.StringIO()
+    writer = csv.writer(h)
+    writer.writerow(
+        ["Submission id", "Participant id", "Status", "Started at", "Time taken", "Age"]
+    )
+    statuses = random.choices(STATUSES, STATUS_WEIGHTS, k=len(user_ids))
+    for i, (user_id, status) in enumerate(zip(user_ids, statuses)):
+        writer.writerow(
+            [f"submission_{i}", user_id, status, "2024-01-01T12:00:00", 600, 30]
+        )
+    return h.getvalue()
+
+
+def write_dataset(path, num_instances):
+    with open(path, "w") as h:
+        for i in range(num_instances):
+            h.write(json.dumps({"post_id": f"instance_{i}", "text": f"text {i} " * 20}))
+            h.write("\n")
+
+
+def benchmark_instances(config, directory, num_instances, repeats):
+    path = os.path.join(directory, f"dataset_{num_instances}.jsonl")
+    write_dataset(path, num_instances)
+    yield "load_jsonl", measure(lambda: data.load_jsonl(path), repeats)
+    os.remove(path)
+
+    instance_ids = [f"instance_{i}" for i in range(num_instances)]
+    # half of the instances have been assigned once more than the others
+    frequencies = {
+        instance_id: 3 + (i % 2) for i, instance_id in enumerate(instance_ids)
+    }
+    yield "get_sample dict", measure(
+        lambda: data.get_sample(config, "benchmark", dict(frequencies)), repeats
+    )
+    sampler = sampling.LeastFrequentSampler(frequencies)
+    yield "get_sample sampler", measure(
+        lambda: data.get_sample(config, "benchmark", sampler), repeats
+    )
+
+
+def benchmark_users(config, num_users, repeats):
+    user_ids = [f"user_{u}" for u in range(num_users)]
+    export = get_export(user_ids)
+    yield "parse_demographics", measure(lambda: data.parse_demographics(export), repeats)
+    participant_status = data.parse_demographics(export)
+    yield "get_rejected", measure(
+        lambda: data.get_rejected(config, participant_status), repeats
+    )
+
+
+def benchmark_frequencies(config, num_instances, num_users, repeats):
+    # instance ids as in the dataset index
+    dataset = dict.fromkeys(f"instance_{i}" for i in range(num_instances))
+    mapping = get_mapping(dataset, num_users, config.data.instances_per_annotator)
+    rejected = set(random.sample(list(mapping), num_users // 10))
+    yield "get_frequencies", measure(
+        lambda: data.get_frequencies(config, dataset, mapping, rejected), repeats
+    )
+
+
+def benchmark_routing(config, repeats):
+    k = config.data.instances_per_annotator
+    attention = config.data.attention_per_annotator
+    yield "get_attention_indices_offsets", measure(
+        lambda: utils.get_attention_indices_offsets(k, attention), repeats
+    )
+    yield "build_plan", measure(lambda: study_plan.build_plan(k, attention), repeats)
+
+    plan = study_plan.build_plan(k, attention)
+
+    def rerun():
+        for page_number in range(plan.num_pages):
+            plan.get(page_number)
+            plan.upcoming_instances(page_number, 2)
+
+    yield "plan reruns", measure(rerun, repeats)
+
+    # a consent page with two radio buttons and a page with five questions
+    answers = {"consent_1": "Yes", "consent_2": "Yes", "label": "a", "comment": "ok"}
+    validator = input_validation.Validator()
+    validator.add(0, lambda: answers["consent_1"] == "Yes")
+    validator.add(0, lambda: answers["consent_2"] == "Yes")
+    for question in ["label", "comment", "label", "comment", "label"]:
+        validator.add(1, lambda question=question: bool(answers[question]))
+
+    yield "Validator.is_valid", measure(
+        lambda: (validator.is_valid(0), validator.is_valid(1)), repeats
+    )
+
+
+def chi_squared_critical(df, alpha):
+    """Approximate critical value of the chi-squared distribution with `df`
+    degrees of freedom (Wilson-Hilferty)"""
+    z = statistics.NormalDist().inv_cdf(1 - alpha)
+    return df * (1 - 2 / (9 * df) + z * math.sqrt(2 / (9 * df))) ** 3
+
+
+def check_uniform(counts, alpha):
+    """Return the chi-squared statistic of `counts` against the uniform
+    distribution, its critical value at `alpha` and whether it passes"""
+    expected = sum(counts) / len(counts)
+    statistic = sum((count - expected) ** 2 / expected for count in counts)
+    critical = chi_squared_critical(len(counts) - 1, alpha)
+    return statistic, critical, statistic <= critical
+
+
+def check_spread(name, sampler, instance_ids, k, num_users, strata=None):
+    """Draw `num_users` samples and return the largest difference between
+    the frequencies of two instances of the same stratum after any of them"""
+    frequencies = dict.fromkeys(instance_ids, 0)
+    worst = 0
+    for _ in range(num_users):
+        sample = sampler.sample(k)
+        assert len(set(sample)) == k, f"{name} drew duplicate instances"
+        for instance_id in sample:
+            frequencies[instance_id] += 1
+        by_stratum = {}
+        for instance_id, frequency in frequencies.items():
+            stratum = strata[instance_id] if strata else None
+            low, high = by_stratum.get(stratum, (frequency, frequency))
+            by_stratum[stratum] = (min(low, frequency), max(high, frequency))
+        worst = max(worst, max(high - low for low, high in by_stratum.values()))
+    return worst
+
+
+def check_balance(k, alpha, trials):
+    """Run the balance checks, return a list of (name, passed, details)"""
+    checks = []
+    config = Munch(data=Munch(instances_per_annotator=k))
+
+    # frequency spread over many users, the number of instances is not a
+    # multiple of k so the levels fill up in the middle of samples
+    num_instances = 10 * k + 3
+    instance_ids = [f"instance_{i}" for i in range(num_instances)]
+    spread = check_spread(
+        "LeastFrequentSampler",
+        sampling.LeastFrequentSampler(dict.fromkeys(instance_ids, 0)),
+        instance_ids,
+        k,
+        200,
+    )
+    checks.append(
+        ("LeastFrequentSampler max-min frequency", spread <= 1, f"spread {spread}")
+    )
+
+    strata = {instance_id: i % 4 for i, instance_id in enumerate(instance_ids)}
+    spread = check_spread(
+        "StratifiedSampler",
+        sampling.StratifiedSampler(dict.fromkeys(instance_ids, 0), strata),
+        instance_ids,
+        k,
+        200,
+        strata,
+    )
+    checks.append(
+        (
+            "StratifiedSampler max-min frequency per stratum",
+            spread <= 1,
+            f"spread {spread}",
+        )
+    )
+
+    frequencies = dict.fromkeys(instance_ids, 0)
+    worst = 0
+    for u in range(200):
+        data.get_sample(config, f"user_{u}", frequencies)
+        worst = max(worst, max(frequencies.values()) - min(frequencies.values()))
+    checks.append(("get_sample dict max-min frequency", worst <= 1, f"spread {worst}"))
+
+    # tie-breaks: the least frequent instances are always picked, the rest
+    # of the sample uniformly among the next level
+    num_least = k // 3
+    ties = [f"instance_{i}" for i in range(num_least, num_instances)]
+    frequencies = {
+        instance_id: 0 if i < num_least else 1
+        for i, instance_id in enumerate(instance_ids)
+    }
+    for name, draw in [
+        (
+            "LeastFrequentSampler",
+            lambda: sampling.LeastFrequentSampler(frequencies).sample(k),
+        ),
+        (
+            "get_sample dict",
+            lambda: data.get_sample(config, "benchmark", dict(frequencies)),
+        ),
+    ]:
+        counts = dict.fromkeys(ties, 0)
+        least_always = True
+        for _ in range(trials):
+            sample = draw()
+            least_always &= all(f"instance_{i}" in sample for i in range(num_least))
+            for instance_id in sample:
+                if instance_id in counts:
+                    counts[instance_id] += 1
+        statistic, critical, passed = check_uniform(list(counts.values()), alpha)
+        checks.append(
+            (
+                f"{name} tie-break uniformity",
+                least_always and passed,
+                f"least frequent always picked {least_always},"
+                f" chi2 {statistic:.1f} <= {critical:.1f}",
+            )
+        )
+
+    # samplers that are kept in memory keep breaking ties uniformly when
+    # samples are put back, as for rejected users
+    samplers = [
+        (
+            "LeastFrequentSampler",
+            sampling.LeastFrequentSampler(dict.fromkeys(instance_ids, 0)),
+        ),
+        (
+            "StratifiedSampler",
+            sampling.StratifiedSampler(dict.fromkeys(instance_ids, 0), strata),
+        ),
+    ]
+    for name, sampler in samplers:
+        counts = dict.fromkeys(instance_ids, 0)
+        for _ in range(trials):
+            sample = sampler.sample(k)
+            for instance_id in sample:
+                counts[instance_id] += 1
+            sampler.update(sample, -1)
+        statistic, critical, passed = check_uniform(list(counts.values()), alpha)
+        checks.append(
+            (
+                f"{name} tie-break uniformity after put-backs",
+                passed,
+                f"chi2 {statistic:.1f} <= {critical:.1f}",
+            )
+        )
+    return checks
+
+
+def check_regressions(output, results, max_regression):
+    """Return the cases that got slower than `max_regression` relative to
+    the last record in `output` that has them"""
+    if not os.path.exists(output):
+        return []
+    previous = {}
+    with open(output) as h:
+        for line in h:
+            if line.strip():
+                for name, result in json.loads(line)["results"].items():
+                    previous[name] = result["median"]
+    return [
+        (name, previous[name], result["median"])
+        for name, result in results.items()
+        if name in previous and result["median"] > previous[name] * (1 + max_regression)
+    ]
+
+
+def main(args):
+    random.seed(args.seed)
+    config = Munch(
+        data=Munch(instances_per_annotator=args.k, attention_per_annotator=args.attention)
+    )
+
+    results = {}
+
+    def record(case, params, timing):
+        name = " ".join([case] + [f"{key}={value}" for key, value in params.items()])
+        median, spread = timing
+        results[name] = {"case": case, **params, "median": median, "iqr": spread}
+        print(f"{name:<52} {median * 1e6:>14.3f}us  ±{spread * 100:>5.1f}%", flush=True)
+
+    directory = tempfile.mkdtemp(prefix="micro_")
+    try:
+        for num_instances in args.instances:
+            for case, timing in benchmark_instances(
+                config, directory, num_instances, args.repeats
+            ):
+                record(case, {"instances": num_instances}, timing)
+    finally:
+        shutil.rmtree(directory)
+    for num_users in args.users:
+        for case, timing in benchmark_users(config, num_users, args.repeats):
+            record(case, {"users": num_users}, timing)
+    for num_instances in args.instances:
+        for num_users in args.users:
+            for case, timing in benchmark_frequencies(
+                config, num_instances, num_users, args.repeats
+            ):
+                record(case, {"instances": num_instances, "users": num_users}, timing)
+    for case, timing in benchmark_routing(config, args.repeats):
+        record(case, {"k": args.k}, timing)
+
+    failed = False
+    if not args.skip_checks:
+        print()
+        for name, passed, details in check_balance(args.k, args.alpha, args.trials):
+            print(f"{'ok' if passed else 'FAILED':<7} {name}: {details}")
+            failed |= not passed
+
+    if args.output:
+        regressions = check_regressions(args.output, results, args.max_regression)
+        with open(args.output, "a") as h:
+            record = {
+                "time": time.time(),
+                "commit": get_commit(),
+                "python": platform.python_version(),
+                "results": results,
+            }
+            h.write(json.dumps(record) + "\n")
+        for name, previous, median in regressions:
+            print(
+                f"REGRESSION {name}: {median * 1e6:.3f}us, previously {previous * 1e6:.3f}us"
+            )
+        failed |= bool(regressions)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--instances", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[100, 1_000, 10_000, 100_000]
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("-k", type=int, default=15, help="instances per annotator")
+    parser.add_argument("--attention", type=int, default=2, help="attention checks per annotator")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--trials", type=int, default=2000, help="samples drawn per uniformity check"
+    )
+    parser.add_argument(
+        "--alpha", type=float, default=0.001, help="significance of the uniformity checks"
+    )
+    parser.add_argument(
+        "--skip-checks", action="store_true", help="only run the benchmarks"
+    )
+    parser.add_argument("--output", help="JSON lines file to append the results to")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.5,
+        help="fail if a case is this fraction slower than in the last record of --output,"
+        " higher than for the startup benchmark as short cases are noisier",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,102 @@
+"""Compare the least frequent sampling in `data.get_sample` and
+`sampling.LeastFrequentSampler` against the original implementation, and
+time `sampling.StratifiedSampler` with 20 strata, groups of 5 instances of
+which at most one is assigned per participant and 2 anchors.
+
+Run from the repository root:
+
+    python -m benchmarks.sampler --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import time
+
+from munch import Munch
+
+import data
+import sampling
+
+
+def naive_get_sample(k, frequencies):
+    """The original implementation of `data.get_sample`, which scans all
+    frequencies for every pick"""
+    sample = set()
+    while len(sample) < k:
+        min_freq = min(frequencies.values())
+        candidates = [
+            instance_id
+            for (instance_id, freq) in frequencies.items()
+            if freq == min_freq
+        ]
+        if len(sample) + len(candidates) < k:
+            for candidate in candidates:
+                sample.add(candidate)
+                frequencies[candidate] += 1
+        else:
+            for candidate in random.sample(candidates, k - len(sample)):
+                sample.add(candidate)
+                frequencies[candidate] += 1
+    return list(sample)
+
+
+def get_frequencies(num_instances):
+    """Frequencies of a study in progress, where the least frequent sampling
+    has assigned about half of the instances one more time than the rest"""
+    return {
+        f"instance_{i}": 3 + (random.random() < 0.5) for i in range(num_instances)
+    }
+
+
+def get_stratified_sampler(frequencies):
+    instance_ids = list(frequencies)
+    strata = {instance_id: i % 20 for i, instance_id in enumerate(instance_ids)}
+    groups = {instance_id: i // 5 for i, instance_id in enumerate(instance_ids)}
+    return sampling.StratifiedSampler(
+        frequencies, strata, groups, max_per_group=1, anchors=instance_ids[:2]
+    )
+
+
+def timed(func, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(sizes, repeats, k):
+    config = Munch(data=Munch(instances_per_annotator=k))
+    print(
+        f"{'instances':>10} {'naive':>12} {'get_sample':>12} {'build':>12}"
+        f" {'sampler':>12} {'stratified':>12}"
+    )
+    for size in sizes:
+        frequencies = get_frequencies(size)
+
+        naive = timed(lambda: naive_get_sample(k, frequencies), repeats)
+        get_sample = timed(
+            lambda: data.get_sample(config, "benchmark", frequencies), repeats
+        )
+        build = timed(lambda: sampling.LeastFrequentSampler(frequencies), 1)
+        sampler = sampling.LeastFrequentSampler(frequencies)
+        persistent = timed(lambda: sampler.sample(k), repeats * 100)
+        stratified_sampler = get_stratified_sampler(frequencies)
+        stratified = timed(lambda: stratified_sampler.sample(k), repeats * 100)
+
+        print(
+            f"{size:>10} {naive * 1e3:>10.3f}ms {get_sample * 1e3:>10.3f}ms"
+            f" {build * 1e3:>10.3f}ms {persistent * 1e6:>10.3f}us"
+            f" {stratified * 1e6:>10.3f}us"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("-k", type=int, default=15, help="instances per annotator")
+
+    args = parser.parse_args()
+
+    main(args.sizes, args.repeats, args.k)
@@ -0,0 +1,187 @@
+"""Startup time of the study server.
+
+Every measurement runs in a fresh interpreter against a temporary study with
+a local stand-in for the prolific API (`fake_prolific.py`):
+
+- the import time of `data` and of all modules of `main.py`
+- the first new participant of a cold server, which loads the config, the
+  dataset index, the database, the demographics and the sampler
+- `studies.StudyRegistry.warm_up` as run by `serve.py`, and the first new
+  participant after it
+
+With `--output` the medians are appended to a JSON lines file, and the run
+fails if a phase got slower than `--max-regression` relative to the
+previous record in it with the same number of instances.
+
+Run from the repository root:
+
+    python -m benchmarks.startup --instances 100000 --output startup.jsonl
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from munch import Munch
+
+import fake_prolific
+from benchmarks.load_test import setup_study
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in a fresh interpreter, prints the durations in seconds as JSON
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import data
+durations = {"import data": time.perf_counter() - start}
+start = time.perf_counter()
+import main
+durations["import main"] = time.perf_counter() - start
+import studies
+
+registry = studies.get_registry(["config.yml"])
+if sys.argv[1] == "warm":
+    start = time.perf_counter()
+    registry.warm_up("config")
+    durations["warm up"] = time.perf_counter() - start
+start = time.perf_counter()
+with registry.use("config") as study:
+    data.get_user_instances(study.config, study.dataset, "first_participant")
+durations[f"first participant {sys.argv[1]}"] = time.perf_counter() - start
+print(json.dumps(durations))
+"""
+
+
+def probe(mode):
+    # a new participant each time
+    with sqlite3.connect("study.sqlite") as con:
+        con.execute("DELETE FROM mapping WHERE user_id = 'first_participant'")
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE, mode],
+        capture_output=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=ROOT,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def check_regressions(output, instances, medians, max_regression):
+    """Return the phases that got slower than `max_regression` relative to
+    the last record in `output` with the same number of instances"""
+    if not os.path.exists(output):
+        return []
+    with open(output) as h:
+        records = [json.loads(line) for line in h if line.strip()]
+    records = [record for record in records if record["instances"] == instances]
+    if not records:
+        return []
+    previous = records[-1]["medians"]
+    return [
+        (name, previous[name], median)
+        for name, median in medians.items()
+        if name in previous and median > previous[name] * (1 + max_regression)
+    ]
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix="startup_")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        with open("prolific_export.csv", "w") as h:
+            h.write("Participant id,Status\n")
+        server = fake_prolific.serve("prolific_export.csv", latency=args.api_latency)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        setup_study(
+            Munch(
+                instances=args.instances,
+                k=15,
+                attention=2,
+                pool_size=0,
+                results_backend="files",
+                refresh_interval=60,
+            ),
+            f"http://localhost:{server.server_address[1]}",
+        )
+
+        durations = {}
+        for _ in range(args.repeats):
+            for mode in ("cold", "warm"):
+                for name, duration in probe(mode).items():
+                    durations.setdefault(name, []).append(duration)
+        server.shutdown()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    print(f"{args.instances} instances, {args.repeats} repeats")
+    print(f"{'':<28} {'median':>9} {'min':>9} {'max':>9}")
+    medians = {}
+    for name, values in durations.items():
+        medians[name] = statistics.median(values)
+        print(
+            f"{name:<28} {medians[name] * 1e3:>7.1f}ms {min(values) * 1e3:>7.1f}ms"
+            f" {max(values) * 1e3:>7.1f}ms"
+        )
+
+    if args.output:
+        regressions = check_regressions(
+            args.output, args.instances, medians, args.max_regression
+        )
+        with open(args.output, "a") as h:
+            record = {
+                "time": time.time(),
+                "commit": get_commit(),
+                "instances": args.instances,
+                "medians": medians,
+            }
+            h.write(json.dumps(record) + "\n")
+        for name, previous, median in regressions:
+            print(
+                f"REGRESSION {name}: {median * 1e3:.1f}ms, previously {previous * 1e3:.1f}ms"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", type=int, default=100_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--api-latency", type=float, default=0.2, help="seconds per prolific API request"
+    )
+    parser.add_argument("--output", help="JSON lines file to append the medians to")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="fail if a median is this fraction slower than in the last record of --output",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,6 +1,8 @@
 import streamlit as st
 import streamlit_survey as ss
 
+import media
+
 
 def _introduction(config, *args, **kwargs):
     """Intro 1: Welcome and high-level introduction
@@ -67,9 +69,20 @@ def _exit_survey(config, survey, validator, current_page, *args, **kwargs):
     st.title("Exit survey")
 
 
+def answer_key(kind, index, question):
+    """Survey key for the answer to `question` on the page of the instance or
+    attention check at `index` of the user, e.g. `instance_3.label`.
+    `export_results.py` joins answers with keys of this form with the
+    assigned instances."""
+    return f"{kind}_{index}.{question}"
+
+
 def instance_page(config, survey, validator, current_page, instance, *args, **kwargs):
     st.title("Instance page")
     st.write(current_page)
+    # pre-rendered images of the instance, see `media.py`
+    for image in media.get_instance_media(config, instance):
+        st.image(image)
 
 
 def attention_page(config, survey, validator, current_page, instance, *args, **kwargs):
@@ -0,0 +1,154 @@
+import argparse
+import time
+
+import streamlit as st
+
+import data
+import db
+import studies
+import utils
+
+
+STATUS_ACTIVE = set(["ACTIVE"])
+STATUS_COMPLETED = set(["AWAITING REVIEW", "APPROVED"])
+
+
+def get_progress(con, window: int = 60) -> dict:
+    """Read the progress of a study from the aggregates maintained by
+    triggers, see `db.create_aggregates`. None of the queries scans a table
+    that grows with the number of instances or participants.
+
+    Arrivals are the users assigned a sample per minute during the last
+    `window` minutes, oldest first."""
+    histogram = dict(
+        con.execute(
+            "SELECT frequency, instances FROM frequency_histogram "
+            "WHERE instances > 0 ORDER BY frequency"
+        )
+    )
+    statuses = dict(
+        con.execute("SELECT status, participants FROM status_count WHERE participants > 0")
+    )
+    now = int(time.time()) // 60
+    arrivals = dict(
+        con.execute(
+            "SELECT minute, users FROM arrival WHERE minute > ?", (now - window,)
+        )
+    )
+
+    groups = {"active": 0, "completed": 0, "rejected": 0, "other": 0}
+    for status, participants in statuses.items():
+        if status in STATUS_ACTIVE:
+            groups["active"] += participants
+        elif status in STATUS_COMPLETED:
+            groups["completed"] += participants
+        elif status in data.STATUS_BAD:
+            groups["rejected"] += participants
+        else:
+            groups["other"] += participants
+
+    return {
+        "instances": sum(histogram.values()),
+        "assignments": sum(f * n for f, n in histogram.items()),
+        "min_frequency": min(histogram, default=None),
+        "max_frequency": max(histogram, default=None),
+        "histogram": histogram,
+        "statuses": statuses,
+        "participants": groups,
+        "arrivals": [arrivals.get(minute, 0) for minute in range(now - window + 1, now + 1)],
+    }
+
+
+def format_progress(progress) -> str:
+    """Return the progress as text for the terminal"""
+    arrivals = progress["arrivals"]
+    lines = [
+        f"{progress['instances']} instances, {progress['assignments']} assignments,"
+        f" frequency min {progress['min_frequency']} max {progress['max_frequency']}",
+        "instances per frequency: "
+        + ", ".join(f"{f}: {n}" for f, n in progress["histogram"].items()),
+        "participants: "
+        + ", ".join(f"{group} {n}" for group, n in progress["participants"].items()),
+        "statuses: " + ", ".join(f"{s} {n}" for s, n in sorted(progress["statuses"].items())),
+        f"arrivals per minute: last minute {arrivals[-1]},"
+        f" last 5 minutes {sum(arrivals[-5:]) / 5:.1f},"
+        f" last {len(arrivals)} minutes {sum(arrivals) / len(arrivals):.1f}",
+    ]
+    return "\n".join(lines)
+
+
+def render_progress(config):
+    with db.get_database(config.paths.db).connect() as con:
+        progress = get_progress(con)
+
+    columns = st.columns(4)
+    columns[0].metric("Instances", progress["instances"])
+    columns[1].metric(
+        "Frequency min / max",
+        f"{progress['min_frequency']} / {progress['max_frequency']}",
+    )
+    columns[2].metric("Assignments", progress["assignments"])
+    columns[3].metric("Arrivals in the last minute", progress["arrivals"][-1])
+
+    columns = st.columns(4)
+    for column, (group, participants) in zip(columns, progress["participants"].items()):
+        column.metric(f"Participants {group}", participants)
+
+    left, right = st.columns(2)
+    with left:
+        st.markdown("**Instances per frequency**, including reserved samples")
+        st.bar_chart(
+            {
+                "frequency": list(progress["histogram"]),
+                "instances": list(progress["histogram"].values()),
+            },
+            x="frequency",
+            y="instances",
+        )
+    with right:
+        st.markdown("**Users assigned per minute**")
+        arrivals = progress["arrivals"]
+        st.bar_chart(
+            {
+                "minutes ago": list(range(-len(arrivals) + 1, 1)),
+                "users": arrivals,
+            },
+            x="minutes ago",
+            y="users",
+        )
+    st.caption(f"updated {time.strftime('%H:%M:%S')}")
+
+
+def main(config_paths, interval: float = 5):
+    """Shows the progress of the studies implemented in config_paths,
+    refreshed every `interval` seconds. Run with `python` instead of
+    `streamlit run` to print it once."""
+    configs = {
+        studies.get_study_name(config_path): config_path for config_path in config_paths
+    }
+
+    if not st.runtime.exists():
+        for name, config_path in configs.items():
+            config = utils.load_config(config_path)
+            with db.get_database(config.paths.db).connect() as con:
+                print(f"{name}\n{format_progress(get_progress(con))}\n")
+        return
+
+    st.title("Study progress")
+    name = st.selectbox("Study", list(configs)) if len(configs) > 1 else next(iter(configs))
+    config = utils.load_config(configs[name])
+
+    # only the fragment is rerun
+    st.fragment(run_every=interval)(render_progress)(config)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_paths", nargs="+")
+    parser.add_argument(
+        "--interval", type=float, default=5, help="seconds between refreshes"
+    )
+
+    args = parser.parse_args()
+
+    main(args.config_paths, args.interval)
@@ -1,22 +1,38 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+import csv
+import io
 import json
 import logging
 import os
 from pathlib import Path
 import random
-import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 
-import pyrolific
-
-# from pyrolific.api.studies import get_studies, export_study
-from pyrolific.api.studies import export_study
+import db
+import metrics
+import sampling
 
 
 logger = logging.getLogger(__name__)
 
 
-STATUS_BAD = set(["RETURNED", "TIMED-OUT", "REJECTED"])
+STATUS_BAD = db.STATUS_BAD
+
+# rough memory per instance in bytes of the dataset index and of a loaded
+# sampler, and of decoded instances relative to their JSON line, measured
+# with tracemalloc
+INDEX_BYTES = 200
+SAMPLER_BYTES = 150
+DECODED_FACTOR = 3
 
 
+@metrics.timed("load_jsonl")
 def load_jsonl(path: Path) -> list[str]:
     data = []
     with open(path) as h:
@@ -26,11 +42,200 @@ def load_jsonl(path: Path) -> list[str]:
     return data
 
 
+class DatasetChangedError(Exception):
+    """The dataset file has been modified in place while an index of it was
+    in use"""
+
+
+def get_file_version(stat):
+    """Identify the contents of a file by its inode, size and modification
+    time, which all change when it is replaced"""
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class DatasetIndex(Mapping):
+    """Read-only mapping from instance id to instance over a JSONL file.
+
+    The file is scanned once to record the byte range of every line keyed by
+    the value of `key`, and kept open. Instances are only read and decoded
+    when they are accessed, so the index itself stays small and the file
+    contents are shared between all sessions through the page cache.
+
+    The dataset must only be changed by replacing the file atomically, e.g.
+    with `os.replace`, which `get_dataset` detects. The index keeps reading
+    the replaced file until it is dropped. A file rewritten in place can't
+    be read consistently, reading from it raises `DatasetChangedError`.
+
+    The last `cache_size` decoded instances are kept, and `prefetch` decodes
+    the instances of upcoming pages in the background so they are warm by
+    the time they are shown. Decoded instances are shared between sessions
+    and must not be modified.
+    """
+
+    def __init__(self, path: Path, key: str, cache_size: int = 1024):
+        self.path = path
+        self.key = key
+        self.offsets = {}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # instance ids queued for decoding in the background
+        self._prefetching = set()
+        self._fields = {}
+        self._fields_lock = threading.Lock()
+
+        # closed when the index is garbage collected
+        self._file = open(path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self.version = get_file_version(stat)
+        self.size = stat.st_size
+
+        start = 0
+        for line in self._file:
+            end = start + len(line.rstrip(b"\n"))
+            if line.strip():
+                instance_id = json.loads(line)[key]
+                if instance_id in self.offsets:
+                    logger.warning("duplicate instance id %s in %s", instance_id, path)
+                self.offsets[instance_id] = (start, end)
+            start += len(line)
+
+    def _decode(self, instance_id):
+        start, end = self.offsets[instance_id]
+        line = os.pread(self._file.fileno(), end - start, start)
+        try:
+            if len(line) < end - start:
+                raise ValueError("short read")
+            instance = json.loads(line)
+            if instance[self.key] != instance_id:
+                raise ValueError(f"found instance {instance[self.key]!r}")
+        except (ValueError, KeyError, TypeError) as e:
+            raise DatasetChangedError(
+                f"could not read instance {instance_id} from {self.path}, the file"
+                f" has been changed in place: {e}"
+            ) from e
+        return instance
+
+    def __getitem__(self, instance_id):
+        with self._cache_lock:
+            instance = self._cache.get(instance_id)
+            if instance is not None:
+                self._cache.move_to_end(instance_id)
+                return instance
+
+        instance = self._decode(instance_id)
+        self._remember(instance_id, instance)
+        return instance
+
+    def _remember(self, instance_id, instance):
+        with self._cache_lock:
+            self._cache[instance_id] = instance
+            self._cache.move_to_end(instance_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _prefetch(self, instance_id):
+        try:
+            self._remember(instance_id, self._decode(instance_id))
+        except Exception:
+            logger.warning("could not prefetch instance %s", instance_id, exc_info=True)
+        finally:
+            with self._cache_lock:
+                self._prefetching.discard(instance_id)
+
+    def prefetch(self, instance_ids):
+        """Decode the `instance_ids` that are not cached yet in a background
+        thread"""
+        with self._cache_lock:
+            missing = [
+                instance_id
+                for instance_id in instance_ids
+                if instance_id in self.offsets
+                and instance_id not in self._cache
+                and instance_id not in self._prefetching
+            ]
+            self._prefetching.update(missing)
+        for instance_id in missing:
+            _get_prefetch_executor().submit(self._prefetch, instance_id)
+
+    def estimate_memory(self) -> int:
+        """Estimate the memory held by the index and the decoded instances in
+        bytes, the file itself only counts towards the page cache"""
+        size = len(self.offsets) * INDEX_BYTES
+        if self.offsets:
+            line = self.size / len(self.offsets)
+            size += len(self._cache) * line * DECODED_FACTOR
+        return int(size)
+
+    def get_field(self, name) -> dict:
+        """Return the value of the field `name` of all instances, None where
+        it is missing. The values are extracted in a single pass on first use
+        and kept with the index."""
+        with self._fields_lock:
+            values = self._fields.get(name)
+            if values is None:
+                logger.info("extracting field %s from %s", name, self.path)
+                values = {
+                    instance_id: self._decode(instance_id).get(name)
+                    for instance_id in self.offsets
+                }
+                self._fields[name] = values
+        return values
+
+    def __contains__(self, instance_id):
+        return instance_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+_datasets = {}
+_datasets_lock = threading.Lock()
+_prefetch_executor = None
+# not `_datasets_lock`, which is held while a dataset is indexed
+_prefetch_executor_lock = threading.Lock()
+
+
+def _get_prefetch_executor() -> ThreadPoolExecutor:
+    global _prefetch_executor
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="prefetch"
+            )
+    return _prefetch_executor
+
+
+def get_dataset(path: Path, key: str, cache_size: int = 1024) -> DatasetIndex:
+    """Return the process-wide `DatasetIndex` for `path`.
+
+    The index is shared between all sessions of the server process and
+    rebuilt when the file has been replaced, see `get_file_version`."""
+    version = get_file_version(os.stat(path))
+    with _datasets_lock:
+        dataset = _datasets.get((path, key))
+        if dataset is None or dataset.version != version:
+            logger.info("building dataset index for %s", path)
+            with metrics.span("dataset_index"):
+                dataset = DatasetIndex(path, key, cache_size)
+            _datasets[(path, key)] = dataset
+            logger.info("indexed %s instances", len(dataset))
+    return dataset
+
+
+@metrics.timed("get_frequencies")
 def get_frequencies(config, data, mapping, rejected):
     logger.info("calculating frequencies for least frequent sampling")
     frequencies = {}
-    for instance in data:
-        frequencies[instance[config.data.instance_id_key]] = 0
+    if isinstance(data, Mapping):
+        instance_ids = data.keys()
+    else:
+        instance_ids = (instance[config.data.instance_id_key] for instance in data)
+    for instance_id in instance_ids:
+        frequencies[instance_id] = 0
 
     for user_id, instance_ids in mapping.items():
         if user_id in rejected:
@@ -43,34 +248,136 @@ def get_frequencies(config, data, mapping, rejected):
     return frequencies
 
 
+def load_frequencies(cur, dataset):
+    """Load the persisted instance frequencies for all instances in `dataset`.
+
+    Instances that were added to the dataset after the database has been
+    created are registered with a frequency of 0, instances that are no longer
+    part of the dataset are ignored."""
+    logger.debug('loading table "instance_frequency" from DB')
+    res = cur.execute("SELECT instance_id, frequency FROM instance_frequency")
+    stored = dict(res.fetchall())
+
+    frequencies = {}
+    missing = []
+    for instance_id in dataset:
+        if instance_id in stored:
+            frequencies[instance_id] = stored[instance_id]
+        else:
+            frequencies[instance_id] = 0
+            missing.append((instance_id,))
+    if missing:
+        logger.info("registering %s new instances in frequency table", len(missing))
+        cur.executemany(
+            "INSERT OR IGNORE INTO instance_frequency VALUES(?, 0)", missing
+        )
+
+    return frequencies
+
+
+def update_frequencies(cur, instance_ids, delta: int = 1, sampler=None):
+    """Add `delta` to the persisted frequency of each of the `instance_ids`
+    and, if given, to their frequency in `sampler`"""
+    cur.executemany(
+        "UPDATE instance_frequency SET frequency = frequency + ? WHERE instance_id = ?",
+        [(delta, instance_id) for instance_id in instance_ids],
+    )
+    if sampler is not None:
+        sampler.update(
+            [instance_id for instance_id in instance_ids if instance_id in sampler],
+            delta,
+        )
+
+
+@metrics.timed("get_sample")
 def get_sample(
     config,
     user_id: str,
     frequencies,
 ):
+    """Draw `instances_per_annotator` least frequent instances for `user_id`.
+
+    `frequencies` is either a `sampling.Sampler`, which should be used when
+    sampling repeatedly, or a dict from instance id to frequency which is
+    scanned once per frequency level and updated in place."""
     logger.debug("starting least frequent sampling")
-    sample = set()
-    while len(sample) < config.data.instances_per_annotator:
-        min_freq = min(frequencies.values())
-        candidates = [
-            instance_id
-            for (instance_id, freq) in frequencies.items()
-            if freq == min_freq
-        ]
-        logger.info("found %s candidates", len(candidates))
-        if len(sample) + len(candidates) < config.data.instances_per_annotator:
-            for candidate in candidates:
-                sample.add(candidate)
-                frequencies[candidate] += 1
-        else:
-            for candidate in random.sample(
-                candidates, config.data.instances_per_annotator - len(sample)
-            ):
-                sample.add(candidate)
-                frequencies[candidate] += 1
+    if isinstance(frequencies, sampling.Sampler):
+        sample = frequencies.sample(config.data.instances_per_annotator)
+    else:
+        sample = []
+        for min_freq in sorted(set(frequencies.values())):
+            missing = config.data.instances_per_annotator - len(sample)
+            if not missing:
+                break
+            candidates = [
+                instance_id
+                for (instance_id, freq) in frequencies.items()
+                if freq == min_freq
+            ]
+            logger.info("found %s candidates", len(candidates))
+            if len(candidates) <= missing:
+                sample.extend(candidates)
+            else:
+                sample.extend(random.sample(candidates, missing))
+        for instance_id in sample:
+            frequencies[instance_id] += 1
+
+    assert len(set(sample)) == config.data.instances_per_annotator
+    return sample
+
+
+# db path -> (dataset, sampler, mapping revision it was loaded at)
+_samplers = {}
+# serializes the creation of new samples within the server process
+_assignment_lock = threading.Lock()
+# db path -> whether the last request to the assignment service succeeded
+_service_reachable = {}
+# db paths whose samplers may miss samples the assignment service assigned
+# before it went down, reloaded before they are used next
+_stale_samplers = set()
+
+
+def get_sampler(config, cur, dataset) -> sampling.Sampler:
+    """Return the process-wide sampler for the study database, of the type
+    configured in the `sampler` section.
+
+    The sampler is loaded from the frequency table on first use, whenever
+    the dataset index has been rebuilt and whenever an operator has changed
+    the mapping, see `db.create_mapping_triggers`. Afterwards it is kept up
+    to date in memory alongside the writes to the frequency table. Must be
+    called with `_assignment_lock` held."""
+    cached = _samplers.get(config.paths.db)
+    if config.paths.db in _stale_samplers:
+        _stale_samplers.discard(config.paths.db)
+        cached = None
+    revision = read_mapping_revision(cur)
+    if cached is not None and cached[0] is dataset and cached[2] == revision:
+        return cached[1]
+
+    logger.info("loading sampler from frequency table")
+    sampler = sampling.create_sampler(
+        config.get("sampler", {}), load_frequencies(cur, dataset), dataset
+    )
+    _samplers[config.paths.db] = (dataset, sampler, revision)
+    return sampler
+
+
+def invalidate_sampler(config):
+    """Drop the process-wide sampler so it is reloaded from the database, e.g.
+    after a transaction has been rolled back"""
+    _samplers.pop(config.paths.db, None)
+
+
+def has_sampler(config) -> bool:
+    """Whether the process-wide sampler of the study is loaded"""
+    return config.paths.db in _samplers
 
-    assert len(sample) == config.data.instances_per_annotator
-    return list(sample)
+
+def release_dataset(path: Path, key: str):
+    """Forget the process-wide `DatasetIndex` for `path`, sessions still
+    holding it can keep using it"""
+    with _datasets_lock:
+        _datasets.pop((path, key), None)
 
 
 def load_token_from_file(path):
@@ -94,11 +401,24 @@ def load_demographics_cache(config):
 def save_demographics_cache(config, demographics):
     demographics_path = f"demographics_{config.api.study_id}.csv"
     logger.info("saving demographics cache to %s", demographics_path)
-    with open(demographics_path, "w") as h:
-         h.write(demographics)
+    # write atomically, the cache may be read concurrently at cold start
+    with open(f"{demographics_path}.tmp", "w") as h:
+        h.write(demographics)
+        h.flush()
+        os.fsync(h.fileno())
+    os.replace(f"{demographics_path}.tmp", demographics_path)
 
 
+@metrics.timed("prolific_api")
 def get_demographics_from_api(config):
+    # the client is only needed for new users but takes a large part of the
+    # import time of this module, so it is imported on first use
+    import pyrolific
+    import pyrolific.errors
+
+    # from pyrolific.api.studies import get_studies, export_study
+    import pyrolific.api.studies.export_study
+
     _token = load_token_from_file(config.api.token_file)
     token = f"Token {_token}"
 
@@ -134,20 +454,681 @@ def get_rejected(config, participant_status):
     return rejected
 
 
-def parse_demographics(string):
-    participant_status = {}
-    header = None
-    for line in string.split("\n"):
-        line = line.strip()
-        if not line:
+def update_participant_status(config, cur, changes, sampler=None) -> dict:
+    """Persist the participant status `changes` and apply rejections to the
+    frequencies, return the changes that were not stored yet.
+
+    Changes are compared with the stored status in the open write
+    transaction, so a change another process has already applied, e.g. the
+    assignment service and a worker that fell back to assigning in-process,
+    is skipped. The instances of participants that became rejected are
+    decremented in the frequency table so they are handed out again, or with
+    a reservation pool, put back into the pool as a whole. If a participant
+    is no longer rejected, their sample is taken out of the pool again if it
+    is still unclaimed, otherwise its instances are incremented."""
+    applied = {}
+    for user_id, status in changes.items():
+        res = cur.execute(
+            "SELECT status FROM participant_status WHERE user_id = ?", (user_id,)
+        )
+        row = res.fetchone()
+        previous = row[0] if row is not None else None
+        if previous == status:
+            continue
+        applied[user_id] = status
+        cur.execute(
+            "INSERT INTO participant_status VALUES(?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET status = excluded.status",
+            (user_id, status),
+        )
+
+        rejected = status in STATUS_BAD
+        if rejected == (previous in STATUS_BAD):
+            continue
+        instance_ids = get_assigned_instances(cur, user_id)
+        if instance_ids is None:
             continue
-        _fields = line.split(",")
-        if header is None:
-            header = _fields
+        if rejected and config.data.get("pool_size", 0):
+            # the instances stay counted in the frequencies while reserved
+            logger.info("reclaiming sample of rejected PROLIFIC_PID %s", user_id)
+            add_reservations(cur, [instance_ids])
+        elif rejected:
+            logger.info("removing rejected PROLIFIC_PID %s from frequencies", user_id)
+            update_frequencies(cur, instance_ids, -1, sampler)
+        elif remove_reservation(cur, instance_ids):
+            # still counted in the frequencies
+            logger.info("restoring PROLIFIC_PID %s from the reservation pool", user_id)
         else:
-            fields = {h: f for h, f in zip(header, _fields)}
-            participant_status[fields["Participant id"]] = fields["Status"]
-    return participant_status
+            logger.info("restoring PROLIFIC_PID %s in frequencies", user_id)
+            update_frequencies(cur, instance_ids, 1, sampler)
+
+    logger.info("%s participant status changes", len(applied))
+    return applied
+
+
+def iter_participant_status(lines):
+    """Yield `(participant id, status)` for each row of a demographics export.
+
+    `lines` is any iterable of CSV lines such as an open file or a
+    `io.StringIO` around an API response. Rows are parsed one at a time and
+    only the two needed columns are kept, quoted fields are handled by the
+    csv module."""
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    id_column = header.index("Participant id")
+    status_column = header.index("Status")
+    for fields in reader:
+        if not fields:
+            continue
+        yield fields[id_column], fields[status_column]
+
+
+def iter_status_changes(previous_status, rows):
+    """Yield only the `(participant id, status)` pairs from `rows` whose
+    status differs from `previous_status`. Participants missing from `rows`
+    keep their previous status."""
+    for user_id, status in rows:
+        if previous_status.get(user_id) != status:
+            yield user_id, status
+
+
+@metrics.timed("parse_demographics")
+def parse_demographics(string):
+    return dict(iter_participant_status(io.StringIO(string)))
+
+
+class DemographicsRefresher(threading.Thread):
+    """Polls the prolific export of the study in the background.
+
+    `snapshot` mirrors the `participant_status` table: it is loaded from the
+    database when the first export is applied, and afterwards only the
+    status changes of each export are persisted, applying rejections to the
+    frequencies. Until then `snapshot` is None. Readers always get the last
+    known status without any network I/O.
+    """
+
+    def __init__(self, config, interval: float):
+        super().__init__(name=f"demographics-{config.api.study_id}", daemon=True)
+        self.config = config
+        self.interval = interval
+        self.snapshot = None
+        self.updated = None
+        # set after the first poll, whether it succeeded or not
+        self.attempted = threading.Event()
+        self._stopped = threading.Event()
+
+    def apply(self, rows):
+        """Persist the status changes in `rows` relative to `snapshot`"""
+        database = db.get_database(self.config.paths.db)
+        with _assignment_lock, metrics.span("apply_participant_status"):
+            try:
+                with database.transaction() as cur:
+                    snapshot = self.snapshot
+                    if snapshot is None:
+                        logger.debug('loading table "participant_status" from DB')
+                        res = cur.execute("SELECT user_id, status FROM participant_status")
+                        snapshot = dict(res.fetchall())
+                    changes = dict(iter_status_changes(snapshot, rows))
+
+                    cached = _samplers.get(self.config.paths.db)
+                    sampler = cached[1] if cached is not None else None
+                    update_participant_status(self.config, cur, changes, sampler)
+            except:
+                invalidate_sampler(self.config)
+                raise
+
+            # only after the changes have been committed
+            snapshot.update(changes)
+            self.snapshot = snapshot
+
+    def refresh(self):
+        """Fetch and apply the latest export, raises if the API fails"""
+        demographics = get_demographics_from_api(self.config)
+        save_demographics_cache(self.config, demographics)
+        self.apply(iter_participant_status(io.StringIO(demographics)))
+        self.updated = time.time()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                metrics.count("prolific_api_failures")
+                logger.warning(
+                    "could not refresh demographics, keeping snapshot from %s",
+                    self.updated,
+                    exc_info=True,
+                )
+            self.attempted.set()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+_refreshers = {}
+_refreshers_lock = threading.Lock()
+
+
+def get_demographics_refresher(config) -> DemographicsRefresher:
+    """Return the process-wide `DemographicsRefresher` of the study, starting
+    it on first use. The polling interval is set by `api.refresh_interval` in
+    seconds."""
+    key = (config.api.study_id, config.paths.db)
+    with _refreshers_lock:
+        refresher = _refreshers.get(key)
+        if refresher is None:
+            refresher = DemographicsRefresher(
+                config, config.api.get("refresh_interval", 60)
+            )
+            refresher.start()
+            _refreshers[key] = refresher
+    return refresher
+
+
+def apply_participant_status(config):
+    """Make sure rejections are applied before a new user is assigned,
+    without network I/O.
+
+    Normally the background refresher has already applied the latest export.
+    Only at cold start, before the first export has been fetched, the
+    demographics cache is streamed and applied instead."""
+    refresher = get_demographics_refresher(config)
+    if refresher.snapshot is not None:
+        return
+
+    demographics_path = f"demographics_{config.api.study_id}.csv"
+    logger.info("no demographics snapshot yet, falling back to %s", demographics_path)
+    metrics.count("demographics_cache_fallbacks")
+    try:
+        with open(demographics_path, newline="") as h:
+            refresher.apply(iter_participant_status(h))
+    except:
+        metrics.count("demographics_unavailable")
+        logger.warning("!!! COULD NOT LOAD DEMOGRAPHICS FROM API OR CACHE, NOT UPDATING REJECTIONS !!!")
+
+
+def warm_up(config, dataset, timeout: float = 30):
+    """Prepare everything a new user needs before the first one arrives: a
+    db connection, the demographics snapshot and the sampler.
+
+    Waits up to `timeout` seconds for the first poll of the prolific API and
+    falls back to the demographics cache if it fails. With `service.url` set,
+    the assignment service does all of this instead."""
+    if config.get("service", {}).get("url"):
+        return
+
+    logger.info("warming up study %s", config.api.study_id)
+    database = db.get_database(config.paths.db)
+    with database.connect():
+        pass
+
+    refresher = get_demographics_refresher(config)
+    if not refresher.attempted.wait(timeout):
+        logger.warning("no response from the prolific API after %ss", timeout)
+    apply_participant_status(config)
+
+    with _assignment_lock:
+        try:
+            with database.transaction() as cur:
+                get_sampler(config, cur, dataset)
+        except:
+            invalidate_sampler(config)
+            raise
+
+    if config.data.get("pool_size", 0):
+        get_reservation_pool(config)
+
+
+def get_assigned_instances(cur, user_id: str):
+    """Return the instance ids assigned to `user_id` in their original order
+    or None if `user_id` has not been assigned a sample yet"""
+    res = cur.execute(
+        "SELECT instance_id FROM assignment WHERE user_id = ? ORDER BY position",
+        (user_id,),
+    )
+    instance_ids = [instance_id for (instance_id,) in res.fetchall()]
+    return instance_ids or None
+
+
+def save_assignment(cur, user_id: str, sample):
+    """Store the `sample` assigned to `user_id`"""
+    cur.execute("INSERT INTO mapping VALUES(?, ?)", (user_id, json.dumps(sample)))
+    cur.executemany(
+        "INSERT INTO assignment VALUES(?, ?, ?)",
+        [(user_id, position, instance_id) for position, instance_id in enumerate(sample)],
+    )
+
+
+def claim_reservation(cur, user_id: str):
+    """Claim the oldest unclaimed reserved sample for `user_id` with a single
+    row update and return it, or None if the pool is empty"""
+    res = cur.execute(
+        "UPDATE reservation SET user_id = ? WHERE id = "
+        "(SELECT id FROM reservation WHERE user_id IS NULL ORDER BY id LIMIT 1) "
+        "RETURNING instance_ids",
+        (user_id,),
+    )
+    row = res.fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def add_reservations(cur, samples):
+    """Add unclaimed `samples` to the reservation pool, their instances must
+    already be counted in the frequencies"""
+    cur.executemany(
+        "INSERT INTO reservation(instance_ids) VALUES(?)",
+        [(json.dumps(sample),) for sample in samples],
+    )
+
+
+def remove_reservation(cur, instance_ids) -> bool:
+    """Remove an unclaimed reserved sample of exactly `instance_ids`, e.g.
+    the sample of a rejected user put back into the pool, and return whether
+    there was one. Its instances stay counted in the frequencies."""
+    res = cur.execute(
+        "DELETE FROM reservation WHERE id = "
+        "(SELECT id FROM reservation WHERE user_id IS NULL AND instance_ids = ? LIMIT 1)",
+        (json.dumps(instance_ids),),
+    )
+    return res.rowcount > 0
+
+
+def refill_reservations(config, dataset, batch_size: int = 50) -> int:
+    """Draw up to `batch_size` samples with the least frequent sampler to
+    fill the reservation pool up to `data.pool_size` and return how many were
+    added"""
+    database = db.get_database(config.paths.db)
+    with _assignment_lock:
+        try:
+            with database.transaction() as cur:
+                res = cur.execute(
+                    "SELECT COUNT(*) FROM reservation WHERE user_id IS NULL"
+                )
+                missing = min(config.data.pool_size - res.fetchone()[0], batch_size)
+                if missing <= 0:
+                    return 0
+
+                sampler = get_sampler(config, cur, dataset)
+                samples = [get_sample(config, None, sampler) for _ in range(missing)]
+                add_reservations(cur, samples)
+                for sample in samples:
+                    update_frequencies(cur, sample)
+        except:
+            invalidate_sampler(config)
+            raise
+
+    logger.info("added %s samples to the reservation pool", missing)
+    return missing
+
+
+class ReservationPool(threading.Thread):
+    """Keeps the reservation pool of the study filled in the background.
+
+    Refills every `data.pool_refill_interval` seconds and whenever `wake` is
+    called after a sample has been claimed. Samples of rejected users are
+    reclaimed into the pool by `update_participant_status`.
+    """
+
+    def __init__(self, config, interval: float):
+        super().__init__(name=f"reservations-{config.paths.db}", daemon=True)
+        self.config = config
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                dataset = get_dataset(
+                    self.config.paths.dataset, self.config.data.instance_id_key
+                )
+                while refill_reservations(self.config, dataset):
+                    pass
+            except Exception:
+                logger.warning("could not refill reservation pool", exc_info=True)
+            self._wake.wait(self.interval)
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_reservation_pool(config) -> ReservationPool:
+    """Return the process-wide `ReservationPool` of the study, starting it on
+    first use"""
+    with _pools_lock:
+        pool = _pools.get(config.paths.db)
+        if pool is None:
+            pool = ReservationPool(config, config.data.get("pool_refill_interval", 5))
+            pool.start()
+            _pools[config.paths.db] = pool
+    return pool
+
+
+def _stop_background(config, join: bool = True):
+    """Stop the demographics refresher and reservation pool of the study,
+    they are started again on next use"""
+    with _refreshers_lock:
+        refresher = _refreshers.pop((config.api.study_id, config.paths.db), None)
+    with _pools_lock:
+        pool = _pools.pop(config.paths.db, None)
+    for thread in (refresher, pool):
+        if thread is not None:
+            thread.stop()
+            if join:
+                thread.join()
+
+
+def stop_study(config):
+    """Stop the background threads of the study, wait for them to finish and
+    drop its sampler. Everything is started or loaded again on next use."""
+    _stop_background(config)
+    with _assignment_lock:
+        invalidate_sampler(config)
+
+
+def _assign(config, cur, dataset, user_id):
+    """Return the sample of `user_id`, assigning one in the open write
+    transaction unless another rerun has already done so.
+
+    If a reservation pool is configured, a pre-computed sample is claimed
+    instead of sampling, unless the pool has run empty."""
+    # a concurrent rerun of the same session may have assigned a sample while
+    # this one was waiting for the lock
+    sample = get_assigned_instances(cur, user_id)
+    if sample is not None:
+        return sample
+
+    if config.data.get("pool_size", 0):
+        sample = claim_reservation(cur, user_id)
+        if sample is None:
+            metrics.count("reservation_pool_empty")
+            logger.warning("reservation pool is empty, sampling directly")
+        else:
+            logger.info("claimed reserved sample")
+            save_assignment(cur, user_id, sample)
+            get_reservation_pool(config).wake()
+            return sample
+
+    sampler = get_sampler(config, cur, dataset)
+    sample = get_sample(config, user_id, sampler)
+
+    # save the sample to the database, the frequencies are updated in the
+    # same transaction so they always match the mapping
+    save_assignment(cur, user_id, sample)
+    update_frequencies(cur, sample)
+    return sample
+
+
+def _create_sample(config, con, dataset, user_id, dry_run):
+    """Draw a sample for `user_id` and store it unless another rerun has
+    already done so. Must be called with `_assignment_lock` held.
+
+    Only the read-modify-write of the assignment runs in the write
+    transaction, it does not involve any network or file I/O."""
+    database = db.get_database(config.paths.db)
+    try:
+        with database.transaction(con) as cur:
+            sample = _assign(config, cur, dataset, user_id)
+
+            if dry_run:
+                logger.info("DRY RUN not saving to DB")
+                con.rollback()
+                invalidate_sampler(config)
+            else:
+                logger.info("saving sample to db")
+    except:
+        invalidate_sampler(config)
+        raise
+
+    return sample
+
+
+def assign_batch(config, con, dataset, user_ids) -> tuple[dict, dict]:
+    """Return the samples of all `user_ids` and the errors of those that
+    could not be assigned one, assigning samples to the new users among them
+    in a single write transaction.
+
+    Returning users are looked up without taking the db lock. Assigning a
+    batch costs one lock acquisition and one commit instead of one per
+    user."""
+    samples = {}
+    for user_id in user_ids:
+        sample = get_assigned_instances(con, user_id)
+        if sample is not None:
+            samples[user_id] = sample
+    metrics.count("users_returning", len(samples))
+
+    new_user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in samples]
+    if not new_user_ids:
+        return samples, {}
+    metrics.count("users_new", len(new_user_ids))
+    logger.info("assigning samples to %s new users", len(new_user_ids))
+
+    apply_participant_status(config)
+
+    with metrics.span("assignment_lock_wait"):
+        _assignment_lock.acquire()
+    try:
+        assigned, errors = _assign_all(config, con, dataset, new_user_ids)
+    finally:
+        _assignment_lock.release()
+
+    samples.update(assigned)
+    return samples, errors
+
+
+def _assign_all(config, con, dataset, user_ids) -> tuple[dict, dict]:
+    """Assign samples to `user_ids` in a single write transaction, one after
+    the other with the same sampler, and return the samples and the errors
+    by user. Must be called with `_assignment_lock` held.
+
+    Each user is assigned in a savepoint, so an error only rolls back the
+    assignment of that user and the others are committed."""
+    database = db.get_database(config.paths.db)
+    samples = {}
+    errors = {}
+    try:
+        with database.transaction(con) as cur:
+            for user_id in user_ids:
+                cur.execute("SAVEPOINT assign")
+                try:
+                    samples[user_id] = _assign(config, cur, dataset, user_id)
+                except Exception as e:
+                    logger.exception("could not assign a sample to %s", user_id)
+                    errors[user_id] = e
+                    cur.execute("ROLLBACK TO assign")
+                    # the sampler may already have handed out the sample
+                    invalidate_sampler(config)
+                cur.execute("RELEASE assign")
+    except:
+        invalidate_sampler(config)
+        raise
+    return samples, errors
+
+
+class AdmissionQueue:
+    """Group commit of the new users of the study arriving at once.
+
+    The first new user to arrive becomes the leader of a batch: it waits up
+    to `window` seconds for further new users, or until `batch_size` have
+    arrived, and then for the assignment lock. Once it holds the lock, it
+    takes all users queued until then, including those that arrived while
+    the previous batch was written, assigns them in a single transaction
+    with `_assign_all` and hands each waiting session its sample, or the
+    error of its own assignment. The next user to arrive leads the next
+    batch.
+
+    During a burst this costs one lock acquisition and one commit per batch
+    instead of per user, and the users are sampled one after the other from
+    the same frequencies and demographics snapshot as before.
+    """
+
+    def __init__(self, config, window: float = 0.002, batch_size: int = 64):
+        self.config = config
+        self.window = window
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        # (user_id, Future) of the users waiting for the next batch
+        self._pending = []
+        self._full = threading.Event()
+
+    def assign(self, con, dataset, user_id: str) -> list:
+        """Return the sample of the new user `user_id` once its batch has
+        been committed"""
+        future = Future()
+        with self._lock:
+            self._pending.append((user_id, future))
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.batch_size:
+                self._full.set()
+
+        if leader:
+            self._full.wait(self.window)
+            with metrics.span("assignment_lock_wait"):
+                _assignment_lock.acquire()
+            try:
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                    self._full.clear()
+                logger.info("assigning samples to a batch of %s new users", len(batch))
+                metrics.count("admission_batches")
+                samples, errors = _assign_all(
+                    self.config, con, dataset, [user_id for user_id, _ in batch]
+                )
+            except BaseException as e:
+                for _, waiting in batch:
+                    waiting.set_exception(e)
+                raise
+            finally:
+                _assignment_lock.release()
+            for batch_user_id, waiting in batch:
+                if batch_user_id in errors:
+                    waiting.set_exception(errors[batch_user_id])
+                else:
+                    waiting.set_result(samples[batch_user_id])
+
+        return future.result()
+
+
+_admission_queues = {}
+_admission_queues_lock = threading.Lock()
+
+
+def get_admission_queue(config) -> AdmissionQueue:
+    """Return the process-wide `AdmissionQueue` of the study, configured by
+    `data.admission_window_ms` and `data.admission_batch_size`"""
+    with _admission_queues_lock:
+        queue = _admission_queues.get(config.paths.db)
+        if queue is None:
+            queue = AdmissionQueue(
+                config,
+                config.data.get("admission_window_ms", 2) / 1000,
+                config.data.get("admission_batch_size", 64),
+            )
+            _admission_queues[config.paths.db] = queue
+    return queue
+
+
+def _request_service(config, path: str, params=None) -> dict:
+    """GET `path` from the assignment service at `service.url`. Raises
+    `ConnectionRefusedError` if the service is not running."""
+    url = f"{config.service.url.rstrip('/')}{path}"
+    if params:
+        url = f"{url}?{urllib.parse.urlencode(params)}"
+    try:
+        with urllib.request.urlopen(
+            url, timeout=config.service.get("timeout", 10)
+        ) as response:
+            return json.load(response)
+    except urllib.error.URLError as e:
+        if isinstance(e.reason, ConnectionRefusedError):
+            raise e.reason
+        raise
+
+
+def request_assignment(config, user_id: str) -> list:
+    """Get or assign the sample of `user_id` from the assignment service"""
+    return _request_service(config, "/assign", {"user_id": user_id})["instance_ids"]
+
+
+def read_mapping_revision(con) -> int:
+    return con.execute("SELECT revision FROM mapping_revision").fetchone()[0]
+
+
+# db path -> (time of the last check, revision)
+_revisions = {}
+
+
+def get_mapping_revision(config) -> int:
+    """Return the revision of the mappings, which changes whenever the
+    sample of a user is changed or deleted, e.g. by an operator.
+
+    The revision is read at most every `data.revision_interval` seconds per
+    process, from the assignment service if `service.url` is set. If reading
+    it fails, the error is raised once and the last known revision, None if
+    there is none, is returned until the interval has passed."""
+    now = time.monotonic()
+    cached = _revisions.get(config.paths.db)
+    if cached is not None and now - cached[0] < config.data.get("revision_interval", 1):
+        return cached[1]
+
+    try:
+        service = config.get("service", {})
+        revision = None
+        if service.get("url"):
+            try:
+                revision = _request_service(config, "/revision")["revision"]
+            except ConnectionRefusedError:
+                if not service.get("fallback", True):
+                    raise
+        if revision is None:
+            database = db.get_database(config.paths.db)
+            with database.connect() as con:
+                revision = read_mapping_revision(con)
+    except:
+        # don't retry on every rerun
+        _revisions[config.paths.db] = (now, cached[1] if cached is not None else None)
+        raise
+
+    _revisions[config.paths.db] = (now, revision)
+    return revision
+
+
+def get_session_instances(session_state, config, dataset, user_id: str):
+    """Return the instances and attention instances of `user_id`, looked up
+    once per session with `get_user_instances`.
+
+    The sample of a user never changes unless an operator changes it in the
+    database, so it is kept in `session_state` until the revision of the
+    mappings changes, see `get_mapping_revision`."""
+    key = f"_instances:{config.paths.db}:{user_id}"
+    cached = session_state.get(key)
+    # read first, so changes while looking up the sample are noticed next time
+    try:
+        revision = get_mapping_revision(config)
+    except Exception:
+        logger.warning("could not read the revision of the mappings", exc_info=True)
+        revision = None
+    # keep the sample while the revision is unknown
+    if cached is not None and (revision is None or cached[0] == revision):
+        return cached[1], cached[2]
+
+    instances = get_user_instances(config, dataset, user_id)
+    attentions = get_attention_instances(config)
+    session_state[key] = (revision, instances, attentions)
+    return instances, attentions
 
 
 def get_user_instances(
@@ -156,113 +1137,100 @@ def get_user_instances(
     """Retrieve `instance_ids` from the dataset for the given `user_id`.
 
     This function makes use of:
-    - The prolific Api to query the completion status of `user_id`s
+    - The prolific Api to query the completion status of `user_id`s, which
+      is polled in the background by a `DemographicsRefresher`
     - A database to cache the mapping from known `user_id`s to their
       assigned `instance_ids` locally
 
+    If `service.url` is configured, the sample is requested from the
+    assignment service instead, see `assignment_service.py`. Only if the
+    service is not running, the sample is assigned in-process as below.
+
     The logic is as follows:
     - If a `user_id` has been encountered before, retrieve the assigned
     `instance_ids` and return them
     - If a `user_id` is encountered for the first time,
-      - query the prolific Api for the latest demgraphic data including
-        study completion status
+      - take the latest demographic data including study completion status
+        from the refresher, or from the demographics cache at cold start
       - inform the sample the about rejected the `user_id`s and assign
         `instance_ids` to the requested `user_id`"""
 
+    service = config.get("service", {})
+    if service.get("url") and not dry_run:
+        try:
+            with metrics.span("assignment_service"):
+                sample = request_assignment(config, user_id)
+        except ConnectionRefusedError:
+            if not service.get("fallback", True):
+                raise
+            metrics.count("service_fallbacks")
+            if _service_reachable.get(config.paths.db, True):
+                logger.warning(
+                    "assignment service at %s is not running, assigning in-process",
+                    service.url,
+                )
+                # the service may have assigned samples since the sampler of
+                # this process was loaded, reload it once per outage before
+                # the next sample is assigned here
+                _stale_samplers.add(config.paths.db)
+            _service_reachable[config.paths.db] = False
+        else:
+            if not _service_reachable.get(config.paths.db, True):
+                logger.info("assignment service at %s is reachable again", service.url)
+                # the service polls the demographics and fills the pool itself
+                _stop_background(config, join=False)
+            _service_reachable[config.paths.db] = True
+            logger.info("sample stats: len %s, instances %s", len(sample), sample)
+            return sample
+
     # assume the database already exists
     # maybe check for this earlier
     assert os.path.exists(config.paths.db)
 
-    con = sqlite3.connect(config.paths.db)
-
-    # keep db locked while figuring out the mapping for this user
-    logger.debug("acquiring db lock")
-    with con:
-        logger.debug("db lock acquired")
-        cur = con.cursor()
-
-        # logger.debug('loading table "data" from DB')
-        # res = cur.execute("SELECT bin_id, image_ids FROM data")
-        # _data = res.fetchall()
-        # data = {}
-        # for _bin_id, _user_ids in _data:
-        #     user_ids = json.loads(_user_ids)
-        #     data[_bin_id] = user_ids
-
-        logger.debug('loading table "mapping" from DB')
-        res = cur.execute("SELECT user_id, instance_ids FROM mapping")
-        _data = res.fetchall()
-        mapping = {}
-        for _user_id, _instance_ids in _data:
-            instance_ids = json.loads(_instance_ids)
-            mapping[_user_id] = instance_ids
-
-        logger.debug('loading table "participant_status" from DB')
-        res = cur.execute("SELECT user_id, status FROM participant_status")
-        _data = res.fetchall()
-        participant_status = {}
-        for _user_id, _status in _data:
-            participant_status[_user_id] = _status
-
-        # logger.debug("loading rejected PROLIFIC_PIDS from `rejected.txt`")
-        # rejected = set()
-        # with open("/home/frgl/figure_caption_user_study/rejected.txt") as h:
-        #     for line in h:
-        #         line = line.strip()
-        #         rejected_id, comment = line.split("#")
-        #         rejected.add(rejected_id.strip())
-
-        if user_id in mapping:
+    if config.data.get("pool_size", 0):
+        # start filling the pool before the first new users arrive
+        get_reservation_pool(config)
+
+    database = db.get_database(config.paths.db)
+    with database.connect() as con:
+        # reads don't take the db lock
+        logger.debug("looking up PROLIFIC_PID %s in DB", user_id)
+        sample = get_assigned_instances(con, user_id)
+
+        if sample is not None:
+            metrics.count("users_returning")
             logger.info("user_id '%s' found in db, loading sample", user_id)
-            sample = mapping[user_id]
         else:
+            metrics.count("users_new")
             logger.info("new user_id '%s', creating sample", user_id)
-            
-            demographics = None
-            # try loading demographics from API
-            try:
-                demographics = get_demographics_from_api(config)
-            except:
-                logger.warning("could not load demographics from API")
-                # try loading cached demographics
-                try:
-                    demographics = load_demographics_cache(config)
-                except:
-                    logger.warning("could not load demographics from cache")
-                    pass
-            # save new demographics from API
-            else:
-                save_demographics_cache(config, demographics)
-                
-            if demographics is not None:
-                participant_status = parse_demographics(demographics)
-            # happens if both API and cache failed
-            else:
-                logger.warning("!!! COULD NOT LOAD DEMOGRAPHICS FROM API OR CACHE, NOT REJECTING !!!")
-                participant_status = {}
-            rejected = get_rejected(config, participant_status)
 
-            frequencies = get_frequencies(config, dataset, mapping, rejected)
-            sample = get_sample(config, user_id, frequencies)
+            # rejections are applied by the background refresher, only at cold
+            # start the cached demographics have to be applied here
+            apply_participant_status(config)
 
             if dry_run:
-                logger.info("DRY RUN not saving to DB")
+                # keep db locked only while figuring out the mapping for this user
+                logger.debug("acquiring db lock")
+                with metrics.span("assignment_lock_wait"):
+                    _assignment_lock.acquire()
+                try:
+                    with metrics.span("create_sample"):
+                        sample = _create_sample(config, con, dataset, user_id, dry_run)
+                finally:
+                    _assignment_lock.release()
+                logger.debug("db lock released")
             else:
-                logger.info("saving sample to db")
-                # save the sample to the database
-                cur.execute(
-                    f"INSERT INTO mapping VALUES('{user_id}', '{json.dumps(sample)}')",
-                )
-                # TODO update participant_status in DB as well
-                con.commit()
-        # logger.debug("sample: %s", sample)
-        logger.info(
-            "sample stats: len %s, unique len %s, instances %s",
-            len(sample),
-            len(set(sample)),
-            sample,
-        )
-    logger.debug("db lock released")
+                # assigned together with the other new users arriving now
+                with metrics.span("create_sample"):
+                    sample = get_admission_queue(config).assign(con, dataset, user_id)
+
+    # logger.debug("sample: %s", sample)
+    logger.info(
+        "sample stats: len %s, unique len %s, instances %s",
+        len(sample),
+        len(set(sample)),
+        sample,
+    )
 
     return sample
 
@@ -0,0 +1,329 @@
+from contextlib import contextmanager
+import logging
+import queue
+import sqlite3
+import threading
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# stored in `PRAGMA user_version`, databases with an older version have to be
+# upgraded with `python migrate_db.py config.yml`
+SCHEMA_VERSION = 7
+
+# prolific statuses of rejected participants, whose samples are not counted
+# in `instance_frequency`
+STATUS_BAD = set(["RETURNED", "TIMED-OUT", "REJECTED"])
+
+
+def create_schema(cur):
+    """Create all tables of the latest schema version in an empty database
+
+    - `mapping`: the `instance_ids` assigned to each `user_id` as JSON, the
+      source of truth for the assignments, see `create_mapping_triggers`
+    - `assignment`: the same mapping normalized to one row per instance so
+      the sample of a single user or all users of an instance are looked up
+      by index, only written by `data.save_assignment` and the triggers
+    - `participant_status`: the latest prolific status of each `user_id`
+    - `instance_frequency`: the number of non-rejected users each instance is
+      assigned to, including samples reserved for future users
+    - `reservation`: pre-computed samples, unclaimed while `user_id` is NULL
+    - `results`: the survey responses of each `user_id` as JSON, if
+      `results.backend` is `db`
+    - `mapping_revision`: a single counter incremented by triggers whenever
+      a row of `mapping` is changed or deleted, so sessions caching a sample
+      notice when an operator reassigns it
+    - `frequency_histogram`, `status_count` and `arrival`: aggregates of
+      `instance_frequency`, `participant_status` and `mapping` maintained by
+      triggers for the dashboard, see `create_aggregates`
+
+    Instance ids have no type affinity so integer and string ids from the
+    dataset round-trip unchanged.
+    """
+    cur.execute("CREATE TABLE mapping(user_id TEXT PRIMARY KEY, instance_ids JSON1)")
+    cur.execute(
+        "CREATE TABLE assignment("
+        "user_id TEXT NOT NULL, position INTEGER NOT NULL, instance_id NOT NULL, "
+        "PRIMARY KEY (user_id, position)) WITHOUT ROWID"
+    )
+    cur.execute("CREATE INDEX assignment_instance_id ON assignment(instance_id)")
+    cur.execute(
+        "CREATE TABLE participant_status(user_id TEXT PRIMARY KEY, status TEXT)"
+    )
+    cur.execute(
+        "CREATE TABLE instance_frequency(instance_id PRIMARY KEY, frequency INTEGER NOT NULL DEFAULT 0)"
+    )
+    create_reservation(cur)
+    create_results(cur)
+    create_mapping_revision(cur)
+    create_aggregates(cur)
+    create_mapping_triggers(cur)
+    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def create_reservation(cur):
+    cur.execute(
+        "CREATE TABLE reservation("
+        "id INTEGER PRIMARY KEY, instance_ids JSON1 NOT NULL, user_id TEXT UNIQUE)"
+    )
+    cur.execute(
+        "CREATE INDEX reservation_unclaimed ON reservation(id) WHERE user_id IS NULL"
+    )
+
+
+def create_results(cur):
+    cur.execute(
+        "CREATE TABLE results(user_id TEXT PRIMARY KEY, data JSON1 NOT NULL, updated REAL NOT NULL)"
+    )
+
+
+def create_mapping_revision(cur):
+    cur.execute("CREATE TABLE mapping_revision(revision INTEGER NOT NULL)")
+    cur.execute("INSERT INTO mapping_revision VALUES(0)")
+    # assigning samples only inserts rows
+    for event in ("UPDATE", "DELETE"):
+        cur.execute(
+            f"CREATE TRIGGER mapping_{event.lower()} AFTER {event} ON mapping "
+            "BEGIN UPDATE mapping_revision SET revision = revision + 1; END"
+        )
+
+
+def _counted(user_id):
+    """SQL condition whether the sample of `user_id` is counted in
+    `instance_frequency`"""
+    statuses = ", ".join(f"'{status}'" for status in sorted(STATUS_BAD))
+    return (
+        "NOT EXISTS (SELECT 1 FROM participant_status "
+        f"WHERE user_id = {user_id} AND status IN ({statuses}))"
+    )
+
+
+def create_mapping_triggers(cur):
+    """Create the triggers that keep the other tables in line with `mapping`
+
+    Operators reassign a user by deleting or updating their row in
+    `mapping` only, e.g. with
+    `sqlite3 study.sqlite "DELETE FROM mapping WHERE user_id = '...'"`.
+    The triggers then, in the same transaction
+
+    - replace the rows of the user in `assignment`
+    - decrement the frequencies of the old instances and increment those of
+      the new ones, unless the user is rejected and not counted anyway
+    - release the reserved sample the user claimed, so they can claim
+      another one
+
+    Samples of rejected users that were put back into the reservation pool
+    stay in the pool.
+    """
+    remove = (
+        "DELETE FROM assignment WHERE user_id = OLD.user_id; "
+        "DELETE FROM reservation WHERE user_id = OLD.user_id; "
+        "UPDATE instance_frequency SET frequency = frequency - 1 "
+        "WHERE instance_id IN (SELECT value FROM json_each(OLD.instance_ids)) "
+        f"AND {_counted('OLD.user_id')};"
+    )
+    add = (
+        "INSERT INTO assignment "
+        "SELECT NEW.user_id, key, value FROM json_each(NEW.instance_ids); "
+        "INSERT INTO instance_frequency "
+        "SELECT value, 1 FROM json_each(NEW.instance_ids) "
+        f"WHERE {_counted('NEW.user_id')} "
+        "ON CONFLICT(instance_id) DO UPDATE SET frequency = frequency + 1;"
+    )
+    cur.execute(
+        "CREATE TRIGGER mapping_delete_sync AFTER DELETE ON mapping "
+        f"BEGIN {remove} END"
+    )
+    cur.execute(
+        "CREATE TRIGGER mapping_update_sync AFTER UPDATE ON mapping "
+        f"BEGIN {remove} {add} END"
+    )
+
+
+def create_aggregates(cur):
+    """Create the aggregates read by `dashboard.py` and fill them from the
+    existing rows
+
+    - `frequency_histogram`: the number of instances per frequency
+    - `status_count`: the number of participants per prolific status
+    - `arrival`: the number of users assigned a sample per minute since the
+      epoch, only counted from the creation of the table on
+
+    Each trigger updates a single row, so the aggregates cost a few row
+    updates per write and reading them does not scan any table.
+    """
+    cur.execute(
+        "CREATE TABLE frequency_histogram("
+        "frequency INTEGER PRIMARY KEY, instances INTEGER NOT NULL)"
+    )
+    cur.execute(
+        "INSERT INTO frequency_histogram "
+        "SELECT frequency, COUNT(*) FROM instance_frequency GROUP BY frequency"
+    )
+    cur.execute(
+        "CREATE TABLE status_count(status TEXT PRIMARY KEY, participants INTEGER NOT NULL)"
+    )
+    cur.execute(
+        "INSERT INTO status_count "
+        "SELECT status, COUNT(*) FROM participant_status GROUP BY status"
+    )
+    cur.execute(
+        "CREATE TABLE arrival(minute INTEGER PRIMARY KEY, users INTEGER NOT NULL)"
+    )
+
+    # (table, aggregate, key column of the aggregate, column, count column)
+    for table, aggregate, key, column, count in (
+        ("instance_frequency", "frequency_histogram", "frequency", "frequency", "instances"),
+        ("participant_status", "status_count", "status", "status", "participants"),
+    ):
+        increment = (
+            f"INSERT INTO {aggregate} VALUES(NEW.{column}, 1) "
+            f"ON CONFLICT({key}) DO UPDATE SET {count} = {count} + 1;"
+        )
+        decrement = (
+            f"UPDATE {aggregate} SET {count} = {count} - 1 WHERE {key} = OLD.{column};"
+        )
+        cur.execute(
+            f"CREATE TRIGGER {table}_insert_{aggregate} AFTER INSERT ON {table} "
+            f"BEGIN {increment} END"
+        )
+        cur.execute(
+            f"CREATE TRIGGER {table}_update_{aggregate} AFTER UPDATE OF {column} ON {table} "
+            f"WHEN OLD.{column} IS NOT NEW.{column} BEGIN {decrement} {increment} END"
+        )
+        cur.execute(
+            f"CREATE TRIGGER {table}_delete_{aggregate} AFTER DELETE ON {table} "
+            f"BEGIN {decrement} END"
+        )
+
+    cur.execute(
+        "CREATE TRIGGER mapping_insert_arrival AFTER INSERT ON mapping BEGIN "
+        "INSERT INTO arrival VALUES(CAST(strftime('%s', 'now') AS INTEGER) / 60, 1) "
+        "ON CONFLICT(minute) DO UPDATE SET users = users + 1; END"
+    )
+
+
+def get_schema_version(con) -> int:
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def check_schema(con, path):
+    """Raise if the database at `path` has not been upgraded to the latest
+    schema version"""
+    version = get_schema_version(con)
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(
+            f"database {path} has schema version {version} but {SCHEMA_VERSION} "
+            "is required, upgrade it with `python migrate_db.py <config>`"
+        )
+
+
+class Database:
+    """Connections to a study database shared by all sessions of the server
+    process.
+
+    Streamlit runs every rerun in a new thread, so instead of one connection
+    per thread, idle connections are kept in a pool and lent out by
+    `connect`. Each connection is opened once with WAL journaling, so
+    readers never block behind a writer, and a `busy_timeout`, so writers
+    wait for the lock instead of failing. Connections are in autocommit mode
+    and reuse their prepared statements across reruns, writes are grouped
+    explicitly with `transaction`.
+    """
+
+    def __init__(self, path, busy_timeout: int = 5000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._idle = queue.SimpleQueue()
+
+    def _open(self):
+        logger.debug("opening connection to %s", self.path)
+        con = sqlite3.connect(
+            self.path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        con.execute("PRAGMA journal_mode = WAL")
+        # durable at checkpoints, which is safe in WAL mode
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        check_schema(con, self.path)
+        return con
+
+    @contextmanager
+    def connect(self):
+        """Borrow a connection from the pool for the duration of the block"""
+        with metrics.span("db_connect"):
+            try:
+                con = self._idle.get_nowait()
+            except queue.Empty:
+                con = self._open()
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            self._idle.put(con)
+
+    @contextmanager
+    def transaction(self, con=None):
+        """Run the block in a write transaction and yield a cursor.
+
+        `BEGIN IMMEDIATE` takes the write lock upfront, so the transaction
+        cannot fail halfway on a lock upgrade and should only wrap the
+        read-modify-write itself. It is committed at the end of the block
+        unless it has been rolled back inside, and rolled back on errors."""
+        if con is None:
+            with self.connect() as con:
+                with self.transaction(con) as cur:
+                    yield cur
+            return
+
+        cur = con.cursor()
+        self._begin(cur)
+        try:
+            yield cur
+        except:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        if con.in_transaction:
+            con.commit()
+
+    def _begin(self, cur):
+        with metrics.span("db_lock_wait"):
+            cur.execute("BEGIN IMMEDIATE")
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path) -> Database:
+    """Return the process-wide `Database` for `path`"""
+    with _databases_lock:
+        database = _databases.get(path)
+        if database is None:
+            database = _databases[path] = Database(path)
+    return database
+
+
+def close_database(path):
+    """Close the idle connections of the process-wide `Database` for `path`
+    and forget it, it is opened again on next use"""
+    with _databases_lock:
+        database = _databases.pop(path, None)
+    if database is not None:
+        database.close()
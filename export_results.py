@@ -0,0 +1,255 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import sqlite3
+
+from munch import Munch
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+import data
+import results
+
+
+logger = logging.getLogger(__name__)
+
+
+# answers on instance and attention pages, see `content.answer_key`
+ANSWER_KEY = re.compile(r"^(?P<kind>instance|attention)_(?P<position>\d+)\.(?P<question>.+)$")
+
+COLUMNS = ["user_id", "status", "kind", "position", "instance_id", "question", "value"]
+
+
+def flatten(serialized: str) -> list[tuple]:
+    """Flatten the serialized survey data of a user into
+    `(kind, position, question, value)` rows. Answers that don't belong to an
+    instance or attention page have kind `study` and no position. Values
+    other than strings are JSON encoded."""
+    rows = []
+    for key, entry in json.loads(serialized).items():
+        if not isinstance(entry, dict) or "value" not in entry:
+            continue
+        value = entry["value"]
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        match = ANSWER_KEY.match(key)
+        if match is None:
+            rows.append(("study", None, key, value))
+        else:
+            rows.append(
+                (match["kind"], int(match["position"]), match["question"], value)
+            )
+    return rows
+
+
+def _read_file(path):
+    with open(path) as h:
+        return flatten(h.read())
+
+
+def read_changed(location, manifest, executor):
+    """Return the flattened answers of all users whose results changed since
+    they were recorded in `manifest`, the users whose results have been
+    removed, and the updated manifest"""
+    backend, where = location
+    if backend == "files":
+        versions = {}
+        paths = {}
+        if os.path.isdir(where):
+            for entry in os.scandir(where):
+                if entry.name.endswith(".json"):
+                    user_id = entry.name[: -len(".json")]
+                    versions[user_id] = entry.stat().st_mtime_ns
+                    paths[user_id] = entry.path
+        changed = [u for u, version in versions.items() if manifest.get(u) != version]
+        logger.info("reading %s of %s result files", len(changed), len(versions))
+        flattened = executor.map(
+            _read_file, [paths[u] for u in changed], chunksize=64
+        )
+    else:
+        con = sqlite3.connect(f"file:{where}?mode=ro", uri=True)
+        versions = dict(con.execute("SELECT user_id, updated FROM results"))
+        changed = [u for u, version in versions.items() if manifest.get(u) != version]
+        logger.info("reading %s of %s results", len(changed), len(versions))
+        serialized = []
+        for user_id in changed:
+            row = con.execute("SELECT data FROM results WHERE user_id = ?", (user_id,))
+            serialized.append(row.fetchone()[0])
+        con.close()
+        flattened = executor.map(flatten, serialized, chunksize=64)
+
+    answers = dict(zip(changed, flattened))
+    removed = set(manifest) - set(versions)
+    return answers, removed, versions
+
+
+def read_export(path, export_format):
+    """Read the rows of a previous export as dicts"""
+    if export_format == "parquet":
+        return pq.read_table(path).to_pylist()
+    with gzip.open(path, "rt", newline="") as h:
+        rows = list(csv.DictReader(h))
+    # csv has no types, restore the position column
+    for row in rows:
+        row["position"] = int(row["position"]) if row["position"] else None
+    return rows
+
+
+def write_export(path, export_format, rows, columns):
+    """Write `rows` atomically, so an interrupted export keeps the previous
+    file"""
+    tmp_path = f"{path}.tmp"
+    if export_format == "parquet":
+        table = pa.Table.from_pylist(rows)
+        pq.write_table(table.select(columns), tmp_path, compression="zstd")
+    else:
+        with gzip.open(tmp_path, "wt", newline="") as h:
+            writer = csv.DictWriter(h, columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def main(
+    config_path,
+    output=None,
+    export_format=None,
+    workers=None,
+    full=False,
+    dataset_fields=(),
+):
+    """Exports the answers of all users of the study implemented in
+    config_path to a columnar file with one row per user, page and question.
+
+    Answers on instance pages are joined with the assigned instance id (and
+    `dataset_fields` of the instance), all rows with the latest participant
+    status. Result files are parsed in parallel by `workers` processes.
+
+    Re-runs are incremental: a manifest next to the output records the
+    version of the results of each user, only changed results are read again
+    and merged into the previous export. Statuses are always updated.
+    """
+    # parse the config file to get the configured paths
+    config = Munch.fromYAML(open(config_path))
+
+    if export_format is None:
+        export_format = "parquet" if pa is not None else "csv"
+    if export_format == "parquet" and pa is None:
+        raise RuntimeError("exporting to parquet requires pyarrow")
+    if output is None:
+        suffix = "parquet" if export_format == "parquet" else "csv.gz"
+        output = f"results/{config_path}.{suffix}"
+    manifest_path = f"{output}.manifest.json"
+
+    manifest = {}
+    columns = COLUMNS + list(dataset_fields)
+    if not full and os.path.exists(output) and os.path.exists(manifest_path):
+        with open(manifest_path) as h:
+            previous = json.load(h)
+        if previous["format"] == export_format and previous["columns"] == columns:
+            manifest = previous["users"]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        answers, removed, versions = read_changed(
+            results.get_location(config, config_path), manifest, executor
+        )
+
+    # join with the assignments and participant statuses
+    con = sqlite3.connect(f"file:{config.paths.db}?mode=ro", uri=True)
+    assignments = {}
+    for user_id, position, instance_id in con.execute(
+        "SELECT user_id, position, instance_id FROM assignment"
+    ):
+        assignments[(user_id, position)] = instance_id
+    statuses = dict(con.execute("SELECT user_id, status FROM participant_status"))
+    con.close()
+
+    dataset = None
+    if dataset_fields:
+        dataset = data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+
+    rows = []
+    if manifest:
+        # keep the rows of unchanged users from the previous export
+        for row in read_export(output, export_format):
+            if row["user_id"] not in answers and row["user_id"] not in removed:
+                rows.append(row)
+    for user_id, user_answers in answers.items():
+        for kind, position, question, value in user_answers:
+            instance_id = None
+            if kind == "instance":
+                instance_id = assignments.get((user_id, position))
+            row = {
+                "user_id": user_id,
+                "kind": kind,
+                "position": position,
+                "instance_id": instance_id,
+                "question": question,
+                "value": value,
+            }
+            if dataset is not None:
+                instance = dataset.get(instance_id, {})
+                for field in dataset_fields:
+                    row[field] = instance.get(field)
+            rows.append(row)
+    for row in rows:
+        row["status"] = statuses.get(row["user_id"])
+
+    logger.info("writing %s rows to %s", len(rows), output)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    write_export(output, export_format, rows, columns)
+
+    with open(f"{manifest_path}.tmp", "w") as h:
+        json.dump({"format": export_format, "columns": columns, "users": versions}, h)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(asctime)s  %(levelname)s  %(name)s  %(funcName)16s()]:  %(message)s",
+        datefmt="%d.%m. %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path")
+    parser.add_argument(
+        "--output", help="defaults to results/<config_path>.parquet or .csv.gz"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["parquet", "csv"],
+        help="defaults to parquet if pyarrow is installed, otherwise gzipped csv",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="processes reading results, defaults to the CPU count"
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="re-read all results instead of only changed ones"
+    )
+    parser.add_argument(
+        "--dataset-fields",
+        nargs="+",
+        default=[],
+        help="fields of the instances to add as columns",
+    )
+
+    args = parser.parse_args()
+
+    main(
+        args.config_path,
+        args.output,
+        args.format,
+        args.workers,
+        args.full,
+        args.dataset_fields,
+    )
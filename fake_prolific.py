@@ -0,0 +1,103 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import random
+import re
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+EXPORT_PATH = re.compile(r"^/api/v1/studies/(?P<study_id>[^/]+)/export/?(\?.*)?$")
+
+
+class FakeProlificHandler(BaseHTTPRequestHandler):
+    """Serves the contents of `demographics_path` for the study export
+    endpoint used by `data.get_demographics_from_api`. The file is re-read on
+    every request so participant statuses can be changed while it runs.
+
+    Each export is delayed by `latency` seconds and fails with a server error
+    with probability `failure_rate`, to test how the study copes with a slow
+    or flaky API."""
+
+    demographics_path = None
+    latency = 0.0
+    failure_rate = 0.0
+
+    def do_GET(self):
+        match = EXPORT_PATH.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        if not self.headers.get("Authorization", "").startswith("Token "):
+            self.send_error(401)
+            return
+
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.send_error(503)
+            return
+
+        with open(self.demographics_path, "rb") as h:
+            body = h.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(
+    demographics_path,
+    host: str = "localhost",
+    port: int = 0,
+    latency: float = 0.0,
+    failure_rate: float = 0.0,
+):
+    """Create a fake prolific API server, call `serve_forever` on the result
+    to run it. With port 0 a free port is picked, see `server_address`."""
+    handler = type(
+        "Handler",
+        (FakeProlificHandler,),
+        {
+            "demographics_path": demographics_path,
+            "latency": latency,
+            "failure_rate": failure_rate,
+        },
+    )
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(demographics_path, host, port, latency=0.0, failure_rate=0.0):
+    """Runs a local stand-in for the prolific study export, point `api.url`
+    in the study config to the printed url to use it"""
+    server = serve(demographics_path, host, port, latency, failure_rate)
+    print(f"serving {demographics_path} on http://{host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "demographics_path", help="CSV file with 'Participant id' and 'Status' columns"
+    )
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds to delay each export"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="fraction of exports that fail with 503",
+    )
+
+    args = parser.parse_args()
+
+    main(args.demographics_path, args.host, args.port, args.latency, args.failure_rate)
@@ -4,13 +4,19 @@ import sqlite3
 
 from munch import Munch
 
+import data
+import db
+
 
 def main(config_path):
     """Creates a new empty database for the study implemented in config_path
 
     This database keeps track of known mappings between user_id and their
-    assigned instance_ids in a table called `mapping` as well as the
-    participant completion status in a table called `participant_status`
+    assigned instance_ids in the tables `mapping` and `assignment` as well as
+    the participant completion status in a table called `participant_status`.
+    The number of non-rejected users each instance is assigned to is kept in
+    a table called `instance_frequency`, pre-filled with all instances of the
+    configured dataset. See `db.create_schema` for details.
     """
     # parse the config file to get the configured db path
     config = Munch.fromYAML(open(config_path))
@@ -22,11 +28,18 @@ def main(config_path):
     with con:
         cur = con.cursor()
 
-        # create empty mapping table
-        cur.execute("CREATE TABLE mapping(user_id TEXT, instance_ids JSON1)")
-
-        # create pre-filled data table
-        cur.execute("CREATE TABLE participant_status(user_id TEXT, status TEXT)")
+        # create empty tables of the latest schema version
+        db.create_schema(cur)
+
+        # pre-fill frequency table
+        if os.path.exists(config.paths.dataset):
+            dataset = data.get_dataset(
+                config.paths.dataset, config.data.instance_id_key
+            )
+            cur.executemany(
+                "INSERT INTO instance_frequency VALUES(?, 0)",
+                [(instance_id,) for instance_id in dataset],
+            )
 
 
 if __name__ == "__main__":
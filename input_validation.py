@@ -21,22 +21,29 @@ class Validator:
         """Register a new condition for the given page number"""
         self.conditions[page_number].append(condition)
 
+    def is_valid(self, page_number):
+        """Evaluate the conditions registered for the given page number until
+        the first one that does not hold"""
+        for con in self.conditions[page_number]:
+            if not con():
+                return False
+        return True
+
     def __call__(self, page_number, button_text, **kwargs):
         """When an instance of the input validator is called with a page number,
         evaluate all conditions that have been registered for this page number
         and return an enabled button if all conditions evaluate to True and a
         disabled button otherwise.
         """
-        for con in self.conditions[page_number]:
-            if not con():
-                return st.button(
-                    button_text,
-                    key="foo",
-                    type="primary",
-                    use_container_width=True,
-                    disabled=True,
-                    **kwargs,
-                )
+        if not self.is_valid(page_number):
+            return st.button(
+                button_text,
+                key="foo",
+                type="primary",
+                use_container_width=True,
+                disabled=True,
+                **kwargs,
+            )
 
         return st.button(
             button_text, key="bar", type="primary", use_container_width=True, **kwargs
@@ -1,15 +1,17 @@
 import argparse
-from functools import partial
+import io
 import logging
-import os
 
-from munch import Munch
 import streamlit as st
 import streamlit_survey as ss
 
 import data
-import content
 import input_validation
+import media
+import metrics
+import plan as study_plan
+import results
+import studies
 import utils
 
 logging.basicConfig(
@@ -17,30 +19,37 @@ logging.basicConfig(
     datefmt="%d.%m. %H:%M:%S",
     level=logging.INFO,
 )
+logger = logging.getLogger(__name__)
 
 
-def surveyflow(config, config_path, user_id, instances, attentions):
+def surveyflow(config, config_path, user_id, dataset, instances, attentions):
     survey = ss.StreamlitSurvey(config.study.title)
+    store = results.get_results_store(config, config_path)
 
     # restore session state
     if not survey.data:
-        os.makedirs(f"results/{config_path}/", exist_ok=True)
-        try:
-            survey.from_json(f"results/{config_path}/{user_id}.json")
-        except:
-            pass
+        saved = store.load(user_id)
+        if saved is not None:
+            with metrics.span("survey_restore"):
+                try:
+                    survey.from_file(io.StringIO(saved))
+                except Exception:
+                    # e.g. torn by a crash of an older version, don't lock the
+                    # user out of the study
+                    logger.warning(
+                        "could not restore the responses of user_id %s, starting over",
+                        user_id,
+                        exc_info=True,
+                    )
+                    survey.data.clear()
+                    store.set_aside(user_id)
 
     validator = input_validation.Validator()
 
-    num_pages = (
-        len(content.intro)
-        + len(instances)
-        + config.data.attention_per_annotator
-        + len(content.outro)
-    )
+    plan = study_plan.get_study_plan(config_path, len(instances))
 
     pages = survey.pages(
-        num_pages,
+        plan.num_pages,
         on_submit=lambda: st.markdown(
             f"<div style='text-align: center'>Thank you for your participation, your responses have been recorded.</div>\n\n<div style='text-align: center'>Please click the following link or use completion code <b>{config.study.completion_code}</b> to finish the study:</div>\n\n<div style='text-align: center'><b><a href=https://app.prolific.com/submissions/complete?cc={config.study.completion_code}>complete study</a></b></div>",
             unsafe_allow_html=True,
@@ -58,68 +67,96 @@ def surveyflow(config, config_path, user_id, instances, attentions):
     # )
 
     with pages:
-        if pages.current < len(content.intro):
-            intro_index = pages.current
-            content.intro[intro_index](config, survey, validator, pages.current)
-        elif (
-            pages.current
-            < len(content.intro) + len(instances) + config.data.attention_per_annotator
-        ):
-            instance_index = pages.current - len(content.intro)
-            attention_indices, attention_offsets = utils.get_attention_indices_offsets(
-                len(instances), config.data.attention_per_annotator
-            )
-            if instance_index in attention_indices:
-                content.attention_page(
-                    config,
-                    survey,
-                    validator,
-                    attention_offsets[instance_index],
-                    attentions[attention_offsets[instance_index]],
-                )
+        page = plan.get(pages.current)
+        if page is not None:
+            if page.kind == study_plan.INSTANCE:
+                item = dataset[instances[page.index]]
+            elif page.kind == study_plan.ATTENTION:
+                item = attentions[page.index]
             else:
-                content.instance_page(
-                    config,
-                    survey,
-                    validator,
-                    instance_index - attention_offsets[instance_index],
-                    instances[instance_index - attention_offsets[instance_index]],
-                )
-        elif pages.current < len(content.intro) + len(
-            instances
-        ) + config.data.attention_per_annotator + len(content.outro):
-            outro_index = pages.current - (
-                len(content.intro)
-                + len(instances)
-                + config.data.attention_per_annotator
-            )
-            content.outro[outro_index](config, survey, validator, pages.current)
-
-    # save session state
-    survey.to_json(f"results/{config_path}/{user_id}.json")
-
-
-def main(config_path):
-    # parse the config file
-    config = Munch.fromYAML(open(config_path))
+                item = None
+            with metrics.span(f"render_{page.kind}"):
+                page.render(config, survey, validator, page.index, item)
+
+        # decode the instances of the next pages while this one is answered
+        upcoming = plan.upcoming_instances(
+            pages.current, config.data.get("prefetch_pages", 2)
+        )
+        dataset.prefetch([instances[index] for index in upcoming])
+        cache = media.get_media_cache(config)
+        if cache is not None:
+            cache.prefetch(dataset, [instances[index] for index in upcoming])
+
+    utils.scroll_to_top()
+
+    # save session state, only written if it changed
+    with metrics.span("survey_save"):
+        store.save(user_id, survey.data)
+
+
+def run_study(config, config_path, dataset):
+    metrics.configure(config)
 
     # Prolific provides the user id as parameter in the URL
     user_id = st.query_params["PROLIFIC_PID"]
 
-    dataset = data.load_jsonl(config.paths.dataset)
-
-    # get the instances assigned to user_id or assign them if they are new.
-    instances = data.get_user_instances(config, dataset, user_id)
-    attentions = data.get_attention_instances(config)
+    # get the instances assigned to user_id or assign them if they are new,
+    # only once per session
+    with metrics.span("get_user_instances"):
+        instances, attentions = data.get_session_instances(
+            st.session_state, config, dataset, user_id
+        )
 
     # run the main survey
-    surveyflow(config, config_path, user_id, instances, attentions)
+    with metrics.span("surveyflow"):
+        surveyflow(config, config_path, user_id, dataset, instances, attentions)
+
+
+def main(config_paths, max_studies=None, max_memory_mb=None, min_idle=60):
+    """Serves the studies implemented in config_paths, the `study` URL
+    parameter selects one by the name of its config file without extension.
+    It can be omitted if there is only one study.
+
+    The parsed config and dataset index of each study are shared between
+    sessions, studies that have been idle for `min_idle` seconds are evicted
+    while more than `max_studies` are loaded or they hold more than
+    `max_memory_mb` in total."""
+    registry = studies.get_registry(
+        config_paths,
+        max_studies,
+        max_memory_mb * 2**20 if max_memory_mb is not None else None,
+        min_idle,
+    )
+
+    name = st.query_params.get("study")
+    if name is None and len(registry.config_paths) == 1:
+        name = next(iter(registry.config_paths))
+    if name not in registry:
+        st.error("Unknown study, please check the link you were given.")
+        return
+
+    with registry.use(name) as study:
+        run_study(study.config, study.config_path, study.dataset)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("config_path")
+    parser.add_argument("config_paths", nargs="+")
+    parser.add_argument(
+        "--max-studies", type=int, help="studies kept loaded, unlimited by default"
+    )
+    parser.add_argument(
+        "--max-memory-mb",
+        type=float,
+        help="estimated memory of the loaded studies, unlimited by default",
+    )
+    parser.add_argument(
+        "--min-idle",
+        type=float,
+        default=60,
+        help="seconds without participants before a study may be evicted",
+    )
 
     args = parser.parse_args()
 
-    main(args.config_path)
+    main(args.config_paths, args.max_studies, args.max_memory_mb, args.min_idle)
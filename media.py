@@ -0,0 +1,308 @@
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import io
+import logging
+import os
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+import data
+import metrics
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+def _render_file(source, target, max_size, image_format, quality):
+    """Write a copy of the image `source` to `target` that is at most
+    `max_size` pixels wide and high, compressed as `image_format`"""
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, quality=quality)
+
+    # other processes may render the same image at the same time
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as h:
+        h.write(buffer.getvalue())
+    os.replace(tmp_path, target)
+    return target
+
+
+class MediaCache:
+    """Resized and compressed renditions of the images of the instances.
+
+    The instance fields `fields` hold the path of an image or a list of
+    them, relative to `root`. Every image is rendered once to a file in
+    `cache_dir`, named after the path, size and modification time of the
+    original, so renditions of changed images are rendered again.
+    `python media.py config.yml` renders all of them at study setup, images
+    added later are rendered the first time they are shown.
+
+    The renditions of the last shown instances are kept in memory, up to
+    `max_bytes` in total, and shared between all sessions. Reruns of a page
+    never read the original images.
+    """
+
+    def __init__(
+        self,
+        root,
+        cache_dir,
+        fields,
+        key,
+        max_size: int = 1024,
+        image_format: str = "webp",
+        quality: int = 80,
+        max_bytes: int = 64 * 2**20,
+    ):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.fields = fields
+        self.key = key
+        self.max_size = max_size
+        self.image_format = image_format
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # instance ids queued for loading in the background
+        self._prefetching = set()
+        self._executor = None
+        self._warned = False
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def sources(self, instance) -> list[str]:
+        """Return the paths of the images of `instance`"""
+        paths = []
+        for field in self.fields:
+            value = instance.get(field)
+            if value is None:
+                continue
+            if isinstance(value, str):
+                value = [value]
+            paths.extend(os.path.join(self.root, path) for path in value)
+        return paths
+
+    def rendition_path(self, source) -> str:
+        stat = os.stat(source)
+        name = hashlib.sha1(
+            f"{source}\0{stat.st_size}\0{stat.st_mtime_ns}\0{self.max_size}"
+            f"\0{self.quality}".encode()
+        ).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.{self.image_format}")
+
+    def render_args(self, source):
+        """Arguments of `_render_file` for `source`"""
+        return (
+            source,
+            self.rendition_path(source),
+            self.max_size,
+            self.image_format,
+            self.quality,
+        )
+
+    def _load(self, source) -> bytes:
+        target = self.rendition_path(source)
+        if not os.path.exists(target):
+            if Image is None:
+                if not self._warned:
+                    logger.warning(
+                        "no rendition of %s and Pillow is not installed,"
+                        " serving the original images",
+                        source,
+                    )
+                    self._warned = True
+                target = source
+            else:
+                logger.info("rendering %s", source)
+                metrics.count("media_rendered")
+                _render_file(*self.render_args(source))
+        with open(target, "rb") as h:
+            return h.read()
+
+    def get(self, instance) -> list[bytes]:
+        """Return the renditions of the images of `instance`"""
+        instance_id = instance[self.key]
+        with self._lock:
+            images = self._cache.get(instance_id)
+            if images is not None:
+                self._cache.move_to_end(instance_id)
+                return images
+
+        metrics.count("media_cache_misses")
+        images = [self._load(source) for source in self.sources(instance)]
+        self._remember(instance_id, images)
+        return images
+
+    def _remember(self, instance_id, images):
+        with self._lock:
+            if instance_id in self._cache:
+                return
+            self._cache[instance_id] = images
+            self.size += sum(len(image) for image in images)
+            # keep at least the instance just loaded
+            while self.size > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self.size -= sum(len(image) for image in evicted)
+
+    def _prefetch(self, dataset, instance_id):
+        try:
+            self.get(dataset[instance_id])
+        except Exception:
+            logger.warning(
+                "could not prefetch media of instance %s", instance_id, exc_info=True
+            )
+        finally:
+            with self._lock:
+                self._prefetching.discard(instance_id)
+
+    def prefetch(self, dataset, instance_ids):
+        """Load the renditions of the `instance_ids` that are not cached yet
+        in a background thread"""
+        with self._lock:
+            missing = [
+                instance_id
+                for instance_id in instance_ids
+                if instance_id not in self._cache
+                and instance_id not in self._prefetching
+            ]
+            self._prefetching.update(missing)
+            if missing and self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=2, thread_name_prefix="media"
+                )
+        for instance_id in missing:
+            self._executor.submit(self._prefetch, dataset, instance_id)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            self._cache.clear()
+            self.size = 0
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _get_cache_dir(config):
+    return config.get("media", {}).get("cache_dir") or f"{config.paths.dataset}.media"
+
+
+def get_media_cache(config):
+    """Return the process-wide `MediaCache` of the study, or None if
+    `media.fields` is not configured"""
+    options = config.get("media", {})
+    if not options.get("fields"):
+        return None
+    cache_dir = _get_cache_dir(config)
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = MediaCache(
+                options.get("root", "."),
+                cache_dir,
+                options.fields,
+                config.data.instance_id_key,
+                options.get("max_size", 1024),
+                options.get("format", "webp"),
+                options.get("quality", 80),
+                int(options.get("cache_mb", 64) * 2**20),
+            )
+            _caches[cache_dir] = cache
+    return cache
+
+
+def get_instance_media(config, instance) -> list[bytes]:
+    """Return the images of `instance` to show on its page, e.g. with
+    `st.image`, empty if no media is configured"""
+    cache = get_media_cache(config)
+    if cache is None:
+        return []
+    return cache.get(instance)
+
+
+def get_memory(config) -> int:
+    """Return the bytes of renditions the study keeps in memory"""
+    with _caches_lock:
+        cache = _caches.get(_get_cache_dir(config))
+    return cache.size if cache is not None else 0
+
+
+def close_media_cache(config):
+    """Stop the prefetching of the study and drop its cached renditions,
+    the files in `media.cache_dir` are kept"""
+    with _caches_lock:
+        cache = _caches.pop(_get_cache_dir(config), None)
+    if cache is not None:
+        cache.close()
+
+
+def main(config_path, workers=None, force=False):
+    """Renders the images of all instances of the study implemented in
+    config_path to `media.cache_dir` with `workers` processes, skipping
+    those that have been rendered before unless `force` is set"""
+    if Image is None:
+        raise RuntimeError("rendering media requires Pillow")
+
+    config = utils.load_config(config_path)
+    cache = get_media_cache(config)
+    if cache is None:
+        raise ValueError(f"media.fields is not set in {config_path}")
+
+    dataset = data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+    jobs = {}
+    missing = 0
+    for instance_id in dataset:
+        for source in cache.sources(dataset[instance_id]):
+            if not os.path.exists(source):
+                missing += 1
+                logger.warning("image %s of instance %s does not exist", source, instance_id)
+                continue
+            args = cache.render_args(source)
+            if force or not os.path.exists(args[1]):
+                jobs[args[1]] = args
+    if missing:
+        logger.warning("%s images do not exist", missing)
+
+    logger.info("rendering %s images to %s", len(jobs), cache.cache_dir)
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rendered = executor.map(_render_file, *zip(*jobs.values()), chunksize=16)
+            for done, _ in enumerate(rendered, 1):
+                if done % 1000 == 0:
+                    logger.info("rendered %s of %s images", done, len(jobs))
+    logger.info("done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(asctime)s  %(levelname)s  %(name)s  %(funcName)16s()]:  %(message)s",
+        datefmt="%d.%m. %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path")
+    parser.add_argument(
+        "--workers", type=int, help="rendering processes, defaults to the CPU count"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="render images that have been rendered before"
+    )
+
+    args = parser.parse_args()
+
+    main(args.config_path, args.workers, args.force)
@@ -0,0 +1,181 @@
+from bisect import bisect_left
+from contextlib import nullcontext
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# upper bounds in seconds of the histogram buckets of spans
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# everything is a no-op until enabled with `configure`
+_enabled = False
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_NULL_SPAN = nullcontext()
+
+
+class _Histogram:
+    __slots__ = ("count", "sum", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # the last bucket counts values above the largest bound
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+def span(name: str):
+    """Context manager recording the duration of the block under `name`"""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name: str):
+    """Decorator recording the duration of each call under `name`"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe(name: str, seconds: float):
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.observe(seconds)
+
+
+def count(name: str, value: int = 1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for name, histogram in sorted(_histograms.items()):
+            metric = f"survey_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), histogram.buckets):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {histogram.count}")
+        for name, value in sorted(_counters.items()):
+            lines.append(f"# TYPE survey_{name}_total counter")
+            lines.append(f"survey_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """Return a human readable summary of all metrics"""
+    lines = []
+    with _lock:
+        for name, histogram in sorted(_histograms.items()):
+            lines.append(
+                f"{name}: n {histogram.count}, mean {histogram.sum / histogram.count * 1e3:.2f}ms,"
+                f" max {histogram.max * 1e3:.2f}ms"
+            )
+        for name, value in sorted(_counters.items()):
+            lines.append(f"{name}: {value}")
+    return "\n".join(lines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def _log_summaries(interval):
+    while True:
+        time.sleep(interval)
+        logger.info("metrics summary\n%s", summary())
+
+
+_configured = False
+
+
+def configure(config):
+    """Enable metrics for the process as set in the `metrics` section of the
+    config, only the first call has an effect.
+
+    With `metrics.port` the metrics are served at `/metrics` for Prometheus
+    to scrape, with `metrics.log_interval` a summary is logged periodically.
+    """
+    global _configured, _enabled
+    with _lock:
+        if _configured:
+            return
+        _configured = True
+
+    options = config.get("metrics", {})
+    if not options.get("enabled", False):
+        return
+    _enabled = True
+
+    port = options.get("port", 0)
+    if port:
+        server = ThreadingHTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("serving metrics on port %s", port)
+
+    log_interval = options.get("log_interval", 0)
+    if log_interval:
+        threading.Thread(
+            target=_log_summaries, args=(log_interval,), name="metrics-log", daemon=True
+        ).start()
@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+
+from munch import Munch
+
+import data
+import db
+
+
+logger = logging.getLogger(__name__)
+
+
+def _add_instance_frequency(config, cur):
+    """Version 0 -> 1: count the assignments of non-rejected users per
+    instance in `instance_frequency`
+
+    Databases created shortly before schema versions were introduced may
+    already contain the table, it is rebuilt from the mapping in any case.
+    """
+    # like `_add_keys_and_assignment`, only count the first mapping of each
+    # user_id
+    mapping = {}
+    res = cur.execute("SELECT user_id, instance_ids FROM mapping ORDER BY rowid")
+    for user_id, instance_ids in res.fetchall():
+        mapping.setdefault(user_id, json.loads(instance_ids))
+    participant_status = dict(
+        cur.execute("SELECT user_id, status FROM participant_status").fetchall()
+    )
+    rejected = data.get_rejected(config, participant_status)
+
+    # also count instances that have since been removed from the dataset
+    instance_ids = {
+        instance_id for instance_ids in mapping.values() for instance_id in instance_ids
+    }
+    if os.path.exists(config.paths.dataset):
+        instance_ids.update(
+            data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+        )
+    frequencies = data.get_frequencies(
+        config, dict.fromkeys(instance_ids), mapping, rejected
+    )
+
+    cur.execute("DROP TABLE IF EXISTS instance_frequency")
+    cur.execute(
+        "CREATE TABLE instance_frequency(instance_id PRIMARY KEY, frequency INTEGER NOT NULL DEFAULT 0)"
+    )
+    cur.executemany(
+        "INSERT INTO instance_frequency VALUES(?, ?)", frequencies.items()
+    )
+
+
+def _add_keys_and_assignment(config, cur):
+    """Version 1 -> 2: primary keys on `user_id` and the normalized
+    `assignment` table
+
+    SQLite cannot add a primary key to an existing table, so `mapping` and
+    `participant_status` are copied into new tables. Only the first mapping
+    and the last status of each `user_id` are kept.
+    """
+    cur.execute("ALTER TABLE mapping RENAME TO mapping_old")
+    cur.execute("ALTER TABLE participant_status RENAME TO participant_status_old")
+
+    cur.execute("CREATE TABLE mapping(user_id TEXT PRIMARY KEY, instance_ids JSON1)")
+    cur.execute(
+        "INSERT OR IGNORE INTO mapping SELECT user_id, instance_ids FROM mapping_old ORDER BY rowid"
+    )
+    duplicates = cur.execute(
+        "SELECT (SELECT COUNT(*) FROM mapping_old) - (SELECT COUNT(*) FROM mapping)"
+    ).fetchone()[0]
+    if duplicates:
+        logger.warning("dropped %s duplicate rows from mapping", duplicates)
+
+    cur.execute(
+        "CREATE TABLE participant_status(user_id TEXT PRIMARY KEY, status TEXT)"
+    )
+    cur.execute(
+        "INSERT OR REPLACE INTO participant_status SELECT user_id, status FROM participant_status_old ORDER BY rowid"
+    )
+
+    cur.execute(
+        "CREATE TABLE assignment("
+        "user_id TEXT NOT NULL, position INTEGER NOT NULL, instance_id NOT NULL, "
+        "PRIMARY KEY (user_id, position)) WITHOUT ROWID"
+    )
+    rows = []
+    for user_id, instance_ids in cur.execute("SELECT user_id, instance_ids FROM mapping").fetchall():
+        for position, instance_id in enumerate(json.loads(instance_ids)):
+            rows.append((user_id, position, instance_id))
+    cur.executemany("INSERT INTO assignment VALUES(?, ?, ?)", rows)
+    cur.execute("CREATE INDEX assignment_instance_id ON assignment(instance_id)")
+
+    cur.execute("DROP TABLE mapping_old")
+    cur.execute("DROP TABLE participant_status_old")
+
+
+def _add_reservation(config, cur):
+    """Version 2 -> 3: the `reservation` table for pre-computed samples"""
+    db.create_reservation(cur)
+
+
+def _add_results(config, cur):
+    """Version 3 -> 4: the `results` table for survey responses"""
+    db.create_results(cur)
+
+
+def _add_mapping_revision(config, cur):
+    """Version 4 -> 5: the `mapping_revision` counter and its triggers"""
+    db.create_mapping_revision(cur)
+
+
+def _add_aggregates(config, cur):
+    """Version 5 -> 6: the aggregates of the dashboard, filled from the
+    existing rows except for the arrivals"""
+    db.create_aggregates(cur)
+
+
+def _add_mapping_triggers(config, cur):
+    """Version 6 -> 7: `mapping` is the source of truth, `assignment` is
+    rebuilt from it and kept in line by triggers
+
+    Rows only deleted from `assignment` before, leaving a user who could
+    neither be looked up nor be assigned again, are restored. The
+    frequencies are not changed."""
+    cur.execute("DROP TRIGGER IF EXISTS assignment_update")
+    cur.execute("DROP TRIGGER IF EXISTS assignment_delete")
+    cur.execute("DELETE FROM assignment")
+    cur.execute(
+        "INSERT INTO assignment "
+        "SELECT user_id, key, value FROM mapping, json_each(mapping.instance_ids)"
+    )
+    db.create_mapping_triggers(cur)
+
+
+# MIGRATIONS[i] upgrades a database from schema version i to i + 1
+MIGRATIONS = [
+    _add_instance_frequency,
+    _add_keys_and_assignment,
+    _add_reservation,
+    _add_results,
+    _add_mapping_revision,
+    _add_aggregates,
+    _add_mapping_triggers,
+]
+assert len(MIGRATIONS) == db.SCHEMA_VERSION
+
+
+def main(config_path, backup: bool = True):
+    """Upgrades the database of the study implemented in config_path in place
+    to the latest schema version
+
+    Each migration runs in its own transaction. Unless disabled, a copy of
+    the database is saved next to it before the first migration.
+    """
+    # parse the config file to get the configured db path
+    config = Munch.fromYAML(open(config_path))
+
+    assert os.path.exists(config.paths.db)
+    # transactions are managed explicitly so schema changes are covered too
+    con = sqlite3.connect(config.paths.db, isolation_level=None)
+
+    version = db.get_schema_version(con)
+    if version == db.SCHEMA_VERSION:
+        logger.info("%s is already at schema version %s", config.paths.db, version)
+        return
+    if version > db.SCHEMA_VERSION:
+        raise RuntimeError(
+            f"{config.paths.db} has schema version {version}, newer than {db.SCHEMA_VERSION}"
+        )
+
+    if backup:
+        backup_path = f"{config.paths.db}.v{version}.bak"
+        logger.info("saving backup to %s", backup_path)
+        with sqlite3.connect(backup_path) as backup_con:
+            con.backup(backup_con)
+        backup_con.close()
+
+    for version in range(version, db.SCHEMA_VERSION):
+        logger.info("migrating from schema version %s to %s", version, version + 1)
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            MIGRATIONS[version](config, cur)
+            cur.execute(f"PRAGMA user_version = {version + 1}")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+
+    con.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(asctime)s  %(levelname)s  %(name)s  %(funcName)16s()]:  %(message)s",
+        datefmt="%d.%m. %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_path")
+    parser.add_argument(
+        "--no-backup",
+        action="store_true",
+        help="don't save a copy of the database before migrating",
+    )
+
+    args = parser.parse_args()
+
+    main(args.config_path, backup=not args.no_backup)
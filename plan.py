@@ -0,0 +1,86 @@
+from dataclasses import dataclass
+from functools import lru_cache
+import os
+from typing import Callable, NamedTuple, Optional
+
+import content
+import utils
+
+
+INTRO = "intro"
+INSTANCE = "instance"
+ATTENTION = "attention"
+OUTRO = "outro"
+
+
+class Page(NamedTuple):
+    kind: str
+    # called as render(config, survey, validator, index, item)
+    render: Callable
+    # page number for intro and outro pages, otherwise the index into the
+    # instances or attention checks of the user
+    index: int
+
+
+@dataclass(frozen=True)
+class StudyPlan:
+    """The page sequence of a study, so routing a rerun is a single lookup
+    in `pages` by page number"""
+
+    pages: tuple[Page, ...]
+
+    @property
+    def num_pages(self):
+        return len(self.pages)
+
+    def get(self, page_number) -> Optional[Page]:
+        if 0 <= page_number < len(self.pages):
+            return self.pages[page_number]
+        return None
+
+    def upcoming_instances(self, page_number, n) -> list[int]:
+        """Return the indices of the instances shown on the next `n` instance
+        pages after `page_number`"""
+        indices = []
+        for page in self.pages[page_number + 1 :]:
+            if len(indices) == n:
+                break
+            if page.kind == INSTANCE:
+                indices.append(page.index)
+        return indices
+
+
+def build_plan(num_instances, num_attention) -> StudyPlan:
+    """Lay out the intro pages, the instances with equally spaced attention
+    checks and the outro pages"""
+    pages = []
+    for render in content.intro:
+        pages.append(Page(INTRO, render, len(pages)))
+
+    attention_indices, attention_offsets = utils.get_attention_indices_offsets(
+        num_instances, num_attention
+    )
+    for i in range(num_instances + num_attention):
+        if i in attention_indices:
+            pages.append(Page(ATTENTION, content.attention_page, attention_offsets[i]))
+        else:
+            pages.append(
+                Page(INSTANCE, content.instance_page, i - attention_offsets[i])
+            )
+
+    for render in content.outro:
+        pages.append(Page(OUTRO, render, len(pages)))
+
+    return StudyPlan(tuple(pages))
+
+
+@lru_cache(maxsize=32)
+def _get_plan(config_path, mtime, num_instances):
+    config = utils.load_config(config_path)
+    return build_plan(num_instances, config.data.attention_per_annotator)
+
+
+def get_study_plan(config_path, num_instances) -> StudyPlan:
+    """Return the cached plan for users with `num_instances` instances, which
+    is rebuilt when the config file changes"""
+    return _get_plan(config_path, os.stat(config_path).st_mtime_ns, num_instances)
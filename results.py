@@ -0,0 +1,220 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+import db
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResultsStore:
+    """Write-behind storage for the survey responses of each user.
+
+    `save` is called at the end of every rerun but only queues the
+    responses if they changed since they were last saved. A background
+    writer flushes the queue every `flush_interval` seconds, so several
+    reruns of the same user in quick succession result in a single write.
+
+    Responses are either written to one JSON file per user in `directory`,
+    atomically by replacing the file with a completely written and synced
+    temporary file, or to the `results` table of the study database.
+    """
+
+    def __init__(self, directory=None, database=None, flush_interval: float = 0.5):
+        assert (directory is None) != (database is None)
+        self.directory = directory
+        self.database = database
+        self.flush_interval = flush_interval
+
+        # user_id -> serialized responses waiting to be written
+        self._pending = {}
+        # user_id -> hash of the responses last queued, to skip unchanged ones
+        self._saved = {}
+        self._lock = threading.Lock()
+        # serializes flushes of the writer thread and `flush` calls
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+        self._writer = threading.Thread(
+            target=self._run, name=f"results-{directory or database.path}", daemon=True
+        )
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def load(self, user_id: str):
+        """Return the serialized responses of `user_id` or None if there are
+        none yet"""
+        with self._lock:
+            if user_id in self._pending:
+                return self._pending[user_id]
+
+        if self.database is not None:
+            with self.database.connect() as con:
+                res = con.execute("SELECT data FROM results WHERE user_id = ?", (user_id,))
+                row = res.fetchone()
+            serialized = row[0] if row is not None else None
+        else:
+            try:
+                with open(self._path(user_id)) as h:
+                    serialized = h.read()
+            except FileNotFoundError:
+                serialized = None
+
+        if serialized is not None:
+            with self._lock:
+                self._saved.setdefault(user_id, hash(serialized))
+        return serialized
+
+    def set_aside(self, user_id: str):
+        """Give up the saved responses of `user_id` that could not be
+        restored, so the user starts over. A results file is kept next to
+        the others with the suffix `.corrupt`, a row in the results table is
+        overwritten by the next save."""
+        with self._lock:
+            self._saved.pop(user_id, None)
+            self._pending.pop(user_id, None)
+        if self.database is None:
+            path = self._path(user_id)
+            try:
+                os.replace(path, f"{path}.{int(time.time())}.corrupt")
+            except FileNotFoundError:
+                pass
+
+    def save(self, user_id: str, responses: dict):
+        """Queue `responses` of `user_id` for writing unless they are
+        unchanged"""
+        serialized = json.dumps(responses)
+        digest = hash(serialized)
+        with self._lock:
+            if self._saved.get(user_id) == digest:
+                return
+            self._saved[user_id] = digest
+            self._pending[user_id] = serialized
+        self._wake.set()
+
+    def flush(self):
+        """Write all queued responses now"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                self._write(pending)
+            except:
+                # queue the responses again unless newer ones arrived since
+                with self._lock:
+                    for user_id, serialized in pending.items():
+                        self._pending.setdefault(user_id, serialized)
+                raise
+        logger.debug("wrote responses of %s users", len(pending))
+
+    def _write(self, pending):
+        if self.database is not None:
+            with self.database.transaction() as cur:
+                cur.executemany(
+                    "INSERT INTO results VALUES(?, ?, ?) ON CONFLICT(user_id) "
+                    "DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                    [
+                        (user_id, serialized, time.time())
+                        for user_id, serialized in pending.items()
+                    ],
+                )
+        else:
+            for user_id, serialized in pending.items():
+                path = self._path(user_id)
+                with open(f"{path}.tmp", "w") as h:
+                    h.write(serialized)
+                    # the contents must be on disk before the rename, or the
+                    # file may be empty after a power loss
+                    h.flush()
+                    os.fsync(h.fileno())
+                os.replace(f"{path}.tmp", path)
+            # persist the renames
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """Write all queued responses and stop the writer"""
+        self._stopped.set()
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait()
+            # coalesce the writes of reruns in quick succession, `close`
+            # flushes right away
+            self._stopped.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.warning("could not write responses, retrying", exc_info=True)
+                self._wake.set()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_location(config, config_path) -> tuple[str, str]:
+    """Return the results backend of the study and where it stores the
+    responses, either `("files", directory)` or `("db", db_path)`.
+
+    With `results.backend: files` (the default) responses are written to
+    `results/<config_path>/<user_id>.json`, with `results.backend: db` to the
+    `results` table of the study database."""
+    backend = config.get("results", {}).get("backend", "files")
+    if backend == "db":
+        return ("db", config.paths.db)
+    elif backend == "files":
+        return ("files", f"results/{config_path}/")
+    raise ValueError(f"unknown results.backend {backend}")
+
+
+def get_results_store(config, config_path) -> ResultsStore:
+    """Return the process-wide `ResultsStore` of the study, see
+    `get_location`"""
+    options = config.get("results", {})
+    key = get_location(config, config_path)
+    backend = key[0]
+
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            flush_interval = options.get("flush_interval", 0.5)
+            if backend == "db":
+                store = ResultsStore(
+                    database=db.get_database(config.paths.db),
+                    flush_interval=flush_interval,
+                )
+            else:
+                store = ResultsStore(directory=key[1], flush_interval=flush_interval)
+            _stores[key] = store
+    return store
+
+
+def close_results_store(config, config_path):
+    """Write the queued responses of the study and stop its writer, a new
+    `ResultsStore` is created on next use"""
+    with _stores_lock:
+        store = _stores.pop(get_location(config, config_path), None)
+    if store is not None:
+        store.close()
@@ -0,0 +1,365 @@
+from abc import ABC, abstractmethod
+import heapq
+import itertools
+import logging
+import random
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Bucket:
+    """Set of instance ids with O(1) insertion and removal that can be
+    sampled from by position, implemented as a list plus a position index"""
+
+    __slots__ = ("items", "positions")
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def remove(self, item):
+        position = self.positions.pop(item)
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+
+class Sampler(ABC):
+    """Interface of the samplers assigning instances to participants.
+
+    A sampler is built from the persisted frequencies of all instances and
+    kept up to date in memory by `data.update_frequencies`. It is selected
+    with `sampler.type` in the config, see `SAMPLERS`.
+    """
+
+    @classmethod
+    @abstractmethod
+    def from_config(cls, options, frequencies, dataset):
+        """Build the sampler from the `sampler` section of the config. The
+        `dataset` index provides fields of the instances by `get_field`."""
+
+    @abstractmethod
+    def __len__(self):
+        ...
+
+    @abstractmethod
+    def __contains__(self, instance_id):
+        ...
+
+    @abstractmethod
+    def add(self, instance_id, frequency: int = 0):
+        """Register a new instance with the given frequency"""
+
+    @abstractmethod
+    def remove(self, instance_id):
+        """Remove an instance so it is never sampled again"""
+
+    @abstractmethod
+    def update(self, instance_ids, delta: int = 1):
+        """Add `delta` to the frequency of each of the `instance_ids`"""
+
+    @abstractmethod
+    def sample(self, k: int) -> list:
+        """Draw `k` distinct instances and increment their frequencies"""
+
+
+class LeastFrequentSampler(Sampler):
+    """Least frequent sampling of instance ids.
+
+    Instances are kept in buckets by their current frequency, the non-empty
+    frequencies are tracked in a heap. Drawing a sample repeatedly takes
+    instances from the least frequent bucket, so a sample of size k costs
+    O(k log F) where F is the number of distinct frequencies, instead of
+    scanning all instances for every pick.
+
+    The semantics match the original `data.get_sample`: ties between equally
+    frequent instances are broken uniformly at random, a sample never
+    contains duplicates and the frequencies of the sampled instances are
+    incremented.
+    """
+
+    def __init__(self, frequencies=None, rng=random):
+        self.rng = rng
+        self.frequencies = {}
+        self._buckets = {}
+        # may contain frequencies whose bucket has been removed since
+        self._heap = []
+        for instance_id, frequency in (frequencies or {}).items():
+            self.add(instance_id, frequency)
+
+    @classmethod
+    def from_config(cls, options, frequencies, dataset):
+        return cls(frequencies)
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    def __contains__(self, instance_id):
+        return instance_id in self.frequencies
+
+    def _insert(self, instance_id, frequency):
+        bucket = self._buckets.get(frequency)
+        if bucket is None:
+            bucket = self._buckets[frequency] = _Bucket()
+            heapq.heappush(self._heap, frequency)
+        bucket.add(instance_id)
+        self.frequencies[instance_id] = frequency
+
+    def _discard(self, instance_id):
+        frequency = self.frequencies.pop(instance_id)
+        bucket = self._buckets[frequency]
+        bucket.remove(instance_id)
+        if not bucket:
+            del self._buckets[frequency]
+        return frequency
+
+    def min_frequency(self):
+        """Return the frequency of the least frequent instances"""
+        while self._heap[0] not in self._buckets:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def add(self, instance_id, frequency: int = 0):
+        """Register a new instance with the given frequency"""
+        if instance_id in self.frequencies:
+            raise KeyError(f"instance {instance_id} already registered")
+        self._insert(instance_id, frequency)
+
+    def remove(self, instance_id):
+        """Remove an instance so it is never sampled again"""
+        self._discard(instance_id)
+
+    def update(self, instance_ids, delta: int = 1):
+        """Add `delta` to the frequency of each of the `instance_ids`"""
+        for instance_id in instance_ids:
+            self._insert(instance_id, self._discard(instance_id) + delta)
+
+    def take(self, exclude=None):
+        """Take out a least frequent instance for which `exclude` is false,
+        ties broken uniformly at random, and return it with its frequency.
+        Returns None if all instances are excluded.
+
+        The instance is not sampled again until it is added back. Excluded
+        instances are skipped one at a time, so the cost grows with the
+        number of excluded instances at the lowest frequencies only."""
+        skipped = []
+        try:
+            while self.frequencies:
+                frequency = self.min_frequency()
+                bucket = self._buckets[frequency]
+                instance_id = bucket.items[self.rng.randrange(len(bucket))]
+                self._discard(instance_id)
+                if exclude is not None and exclude(instance_id):
+                    skipped.append((instance_id, frequency))
+                    continue
+                return instance_id, frequency
+            return None
+        finally:
+            for instance_id, frequency in skipped:
+                self._insert(instance_id, frequency)
+
+    def sample(self, k: int) -> list:
+        """Draw `k` distinct least frequent instances and increment their
+        frequencies"""
+        if k > len(self.frequencies):
+            raise ValueError(
+                f"cannot sample {k} instances from {len(self.frequencies)}"
+            )
+
+        sample = []
+        # sampled instances are taken out of the buckets until the sample is
+        # complete so they cannot be drawn twice
+        taken = []
+        while len(sample) < k:
+            frequency = self.min_frequency()
+            bucket = self._buckets[frequency]
+            if len(sample) + len(bucket) <= k:
+                candidates = list(bucket.items)
+            else:
+                positions = self.rng.sample(range(len(bucket)), k - len(sample))
+                candidates = [bucket.items[position] for position in positions]
+            for candidate in candidates:
+                self._discard(candidate)
+                taken.append((candidate, frequency))
+            sample.extend(candidates)
+            logger.debug("took %s instances with frequency %s", len(candidates), frequency)
+
+        for instance_id, frequency in taken:
+            self._insert(instance_id, frequency + 1)
+
+        return sample
+
+
+class StratifiedSampler(Sampler):
+    """Least frequent sampling balanced per stratum, with constraints on the
+    sample of each participant.
+
+    Every stratum, e.g. the category or source of the instances, has its own
+    `LeastFrequentSampler` and the sum of its frequencies. The places of a
+    sample are given one at a time to the stratum with the lowest mean
+    frequency, counting the places already given, so the strata are
+    annotated in proportion to their size and within each stratum the least
+    frequent instances are drawn. The cost of a sample depends on k and the
+    number of strata, not on the number of instances.
+
+    - `groups` maps instances to a group, e.g. the thread of a post. A
+      sample contains at most `max_per_group` instances of the same group,
+      instances without a group are unconstrained
+    - `anchors` are assigned to every participant in addition to the drawn
+      instances, so any two participants share at least these for measuring
+      agreement. They are not sampled and their frequencies are not tracked
+    """
+
+    def __init__(
+        self,
+        frequencies=None,
+        strata=None,
+        groups=None,
+        max_per_group: int = 1,
+        anchors=(),
+        rng=random,
+    ):
+        self.rng = rng
+        self.strata = strata or {}
+        self.groups = groups or {}
+        self.max_per_group = max_per_group
+        self.anchors = list(anchors)
+        self._samplers = {}
+        self._totals = {}
+        self._stratum_of = {}
+        anchors = set(self.anchors)
+        for instance_id, frequency in (frequencies or {}).items():
+            if instance_id not in anchors:
+                self.add(instance_id, frequency)
+
+    @classmethod
+    def from_config(cls, options, frequencies, dataset):
+        stratum_key = options.get("stratum_key")
+        group_key = options.get("group_key")
+        return cls(
+            frequencies,
+            strata=dataset.get_field(stratum_key) if stratum_key else None,
+            groups=dataset.get_field(group_key) if group_key else None,
+            max_per_group=options.get("max_per_group", 1),
+            # the first instances of the dataset
+            anchors=itertools.islice(dataset, options.get("anchors", 0)),
+        )
+
+    def __len__(self):
+        return len(self._stratum_of)
+
+    def __contains__(self, instance_id):
+        return instance_id in self._stratum_of
+
+    def add(self, instance_id, frequency: int = 0):
+        if instance_id in self._stratum_of:
+            raise KeyError(f"instance {instance_id} already registered")
+        stratum = self.strata.get(instance_id)
+        sampler = self._samplers.get(stratum)
+        if sampler is None:
+            sampler = self._samplers[stratum] = LeastFrequentSampler(rng=self.rng)
+            self._totals[stratum] = 0
+        sampler.add(instance_id, frequency)
+        self._totals[stratum] += frequency
+        self._stratum_of[instance_id] = stratum
+
+    def remove(self, instance_id):
+        stratum = self._stratum_of.pop(instance_id)
+        sampler = self._samplers[stratum]
+        self._totals[stratum] -= sampler.frequencies[instance_id]
+        sampler.remove(instance_id)
+        if not sampler:
+            del self._samplers[stratum]
+            del self._totals[stratum]
+
+    def update(self, instance_ids, delta: int = 1):
+        for instance_id in instance_ids:
+            stratum = self._stratum_of[instance_id]
+            self._samplers[stratum].update([instance_id], delta)
+            self._totals[stratum] += delta
+
+    def sample(self, k: int) -> list:
+        """Draw `k - len(anchors)` instances balanced over the strata under
+        the group constraint, increment their frequencies and return them
+        together with the anchors in random order"""
+        missing = k - len(self.anchors)
+        if missing < 0 or missing > len(self):
+            raise ValueError(
+                f"cannot sample {k} instances from {len(self)} and {len(self.anchors)} anchors"
+            )
+
+        group_counts = {}
+        for instance_id in self.anchors:
+            group = self.groups.get(instance_id)
+            if group is not None:
+                group_counts[group] = group_counts.get(group, 0) + 1
+
+        def exclude(instance_id):
+            group = self.groups.get(instance_id)
+            return group is not None and group_counts.get(group, 0) >= self.max_per_group
+
+        # (mean frequency including the places given, random tie break, stratum)
+        sizes = {stratum: len(sampler) for stratum, sampler in self._samplers.items()}
+        heap = [
+            (self._totals[stratum] / size, self.rng.random(), stratum)
+            for stratum, size in sizes.items()
+        ]
+        heapq.heapify(heap)
+        places = dict.fromkeys(sizes, 0)
+
+        taken = []
+        while len(taken) < missing and heap:
+            _, tie, stratum = heapq.heappop(heap)
+            drawn = self._samplers[stratum].take(exclude if self.groups else None)
+            if drawn is None:
+                # exhausted under the group constraint for this sample
+                continue
+            taken.append((stratum, *drawn))
+            group = self.groups.get(drawn[0])
+            if group is not None:
+                group_counts[group] = group_counts.get(group, 0) + 1
+            places[stratum] += 1
+            heapq.heappush(
+                heap,
+                ((self._totals[stratum] + places[stratum]) / sizes[stratum], tie, stratum),
+            )
+
+        complete = len(taken) == missing
+        for stratum, instance_id, frequency in taken:
+            if complete:
+                frequency += 1
+                self._totals[stratum] += 1
+            self._samplers[stratum].add(instance_id, frequency)
+        if not complete:
+            raise ValueError(
+                f"cannot sample {k} instances with at most {self.max_per_group} per group"
+            )
+
+        sample = self.anchors + [instance_id for _, instance_id, _ in taken]
+        self.rng.shuffle(sample)
+        return sample
+
+
+# sampler types selectable with `sampler.type`
+SAMPLERS = {
+    "least_frequent": LeastFrequentSampler,
+    "stratified": StratifiedSampler,
+}
+
+
+def create_sampler(options, frequencies, dataset) -> Sampler:
+    """Build the sampler selected in the `sampler` section of the config"""
+    name = options.get("type", "least_frequent")
+    if name not in SAMPLERS:
+        raise ValueError(f"unknown sampler type {name}, choose one of {list(SAMPLERS)}")
+    logger.info("creating %s sampler", name)
+    return SAMPLERS[name].from_config(options, frequencies, dataset)
@@ -0,0 +1,77 @@
+import argparse
+import importlib
+import logging
+import os
+import time
+
+import studies
+
+
+logger = logging.getLogger(__name__)
+
+
+def main(config_paths, max_studies=None, max_memory_mb=None, min_idle=60, streamlit_args=()):
+    """Warms up the studies implemented in config_paths and then starts the
+    Streamlit server for them in the same process, so the first participants
+    find the config parsed, the dataset indexed, the database open and the
+    demographics fetched.
+
+    Arguments for `streamlit run` such as `--server.port 8501` are passed
+    through in `streamlit_args`."""
+    start = time.perf_counter()
+
+    # import the modules of the study script, its first run only executes it
+    importlib.import_module("main")
+
+    # the same registry is used by the script, see `main.main`
+    registry = studies.get_registry(
+        config_paths,
+        max_studies,
+        max_memory_mb * 2**20 if max_memory_mb is not None else None,
+        min_idle,
+    )
+    for name in list(registry.config_paths)[:max_studies]:
+        registry.warm_up(name)
+    logger.info("ready after %.2fs, starting streamlit", time.perf_counter() - start)
+
+    from streamlit.web import cli
+
+    script_args = list(config_paths)
+    if max_studies is not None:
+        script_args += ["--max-studies", str(max_studies)]
+    if max_memory_mb is not None:
+        script_args += ["--max-memory-mb", str(max_memory_mb)]
+    script_args += ["--min-idle", str(min_idle)]
+    cli.main(
+        ["run", os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")]
+        + list(streamlit_args)
+        + ["--"]
+        + script_args,
+        prog_name="streamlit",
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(asctime)s  %(levelname)s  %(name)s  %(funcName)16s()]:  %(message)s",
+        datefmt="%d.%m. %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="all other arguments are passed to `streamlit run`"
+    )
+    parser.add_argument("config_paths", nargs="+")
+    parser.add_argument("--max-studies", type=int, help="see main.py")
+    parser.add_argument("--max-memory-mb", type=float, help="see main.py")
+    parser.add_argument("--min-idle", type=float, default=60, help="see main.py")
+
+    args, streamlit_args = parser.parse_known_args()
+
+    main(
+        args.config_paths,
+        args.max_studies,
+        args.max_memory_mb,
+        args.min_idle,
+        streamlit_args,
+    )
@@ -0,0 +1,438 @@
+"""Monte Carlo simulation of recruiting participants for a study.
+
+Estimates how many participants have to be recruited until every instance
+has been annotated `target` times by participants who complete the study,
+given `instances_per_annotator` and the rate at which participants return or
+time out. Returned participants are reclaimed like by the
+`DemographicsRefresher`: after a lag their instances are decremented and
+handed out again by the least frequent sampler.
+
+Many replicates are simulated at once with NumPy. Each replicate keeps the
+key `frequency + u` per instance, so ordering by key picks the least
+frequent instances with ties broken uniformly at random, exactly like
+`sampling.LeastFrequentSampler`. `u` is drawn anew whenever the frequency
+changes, uniformly above the largest `u` drawn so far at the new frequency:
+the instances left at a frequency are the ones with large `u`, so an
+instance joining it must not be favoured. The instances of the lowest frequency are
+kept in a small sorted buffer per replicate so a participant costs O(k)
+instead of a scan over all instances.
+
+    python simulate.py --instances 100000 -k 15 --target 3 --return-rate 0.1
+"""
+import argparse
+import logging
+import math
+import random
+import time
+
+import numpy as np
+
+import sampling
+
+
+logger = logging.getLogger(__name__)
+
+
+class Replicates:
+    """The least frequent sampler state of `n` replicates of a study"""
+
+    def __init__(self, n, num_instances, k, buffer_size, rng):
+        self.n = n
+        self.num_instances = num_instances
+        self.k = k
+        self.rng = rng
+        self.rows = np.arange(n)
+        self.keys = rng.random((n, num_instances))
+        # per replicate and frequency the number of instances and the
+        # largest u sampled so far
+        self.counts = np.zeros((n, 8), dtype=np.int64)
+        self.counts[:, 0] = num_instances
+        self.cursors = np.zeros((n, 8))
+        # instance ids of the least frequent instances sorted by key, the
+        # entries pos:fill of each row are valid
+        self.buffer_size = min(buffer_size, num_instances)
+        self.buffer = np.zeros((n, self.buffer_size), dtype=np.int64)
+        self.pos = np.zeros(n, dtype=np.int64)
+        self.fill = np.zeros(n, dtype=np.int64)
+        # all instances outside the buffer have keys >= threshold
+        self.threshold = np.zeros(n)
+
+    def refresh(self, rows):
+        """Refill the buffer of `rows` with the least frequent instances"""
+        keys = self.keys[rows]
+        size = self.buffer_size
+        if size < self.num_instances:
+            part = np.argpartition(keys, size, axis=1)
+            first_excluded = np.take_along_axis(keys, part[:, size : size + 1], axis=1)[:, 0]
+            part = part[:, :size]
+        else:
+            part = np.argsort(keys, axis=1)
+            first_excluded = np.full(len(rows), np.inf)
+        part_keys = np.take_along_axis(keys, part, axis=1)
+        order = np.argsort(part_keys, axis=1)
+        part = np.take_along_axis(part, order, axis=1)
+        part_keys = np.take_along_axis(part_keys, order, axis=1)
+
+        # only the lowest frequency, sampled instances move to the next one
+        threshold = np.minimum(np.floor(part_keys[:, 0]) + 1, first_excluded)
+        self.buffer[rows] = part
+        self.pos[rows] = 0
+        self.fill[rows] = (part_keys < threshold[:, None]).sum(axis=1)
+        self.threshold[rows] = threshold
+
+    def sample(self):
+        """Draw one sample of k distinct least frequent instances in every
+        replicate and increment their frequencies"""
+        fast = (self.fill - self.pos >= self.k).all()
+        if fast:
+            # all buffers hold enough instances, take k from each at once
+            sample = self.buffer[self.rows[:, None], self.pos[:, None] + np.arange(self.k)]
+            self.pos += self.k
+            frequencies = np.floor(self.keys[self.rows[:, None], sample])
+        else:
+            sample = np.empty((self.n, self.k), dtype=np.int64)
+            frequencies = np.empty((self.n, self.k))
+            refreshed = np.zeros(self.n, dtype=bool)
+            for j in range(self.k):
+                empty = self.pos >= self.fill
+                if empty.any():
+                    self.refresh(np.flatnonzero(empty))
+                    refreshed |= empty
+                instances = self.buffer[self.rows, self.pos]
+                self.pos += 1
+                sample[:, j] = instances
+                keys = self.keys[self.rows, instances]
+                frequencies[:, j] = np.floor(keys)
+                self.cursors[self.rows, frequencies[:, j].astype(np.int64)] = (
+                    keys - frequencies[:, j]
+                )
+                # taken out until the sample is complete, like the sampler
+                self.keys[self.rows, instances] = np.inf
+        if fast:
+            # the buffers only hold a single frequency, sorted by key
+            last = self.keys[self.rows, sample[:, -1]]
+            self.cursors[self.rows, frequencies[:, -1].astype(np.int64)] = (
+                last - frequencies[:, -1]
+            )
+        rows = np.broadcast_to(self.rows[:, None], sample.shape)
+        self.keys[rows, sample] = self._move_frequencies(
+            rows, frequencies.astype(np.int64), 1
+        )
+        if not fast:
+            # a refresh at the next frequency has left out the sampled
+            # instances, which have reached that frequency now
+            for row in np.flatnonzero(refreshed):
+                self._move(row, sample[row], np.full(self.k, np.inf))
+        return sample
+
+    def reclaim(self, row, instances):
+        """Decrement the frequencies of the `instances` of a rejected
+        participant in replicate `row`"""
+        keys = self.keys[row]
+        old_keys = keys[instances]
+        keys[instances] = self._move_frequencies(
+            np.full(len(instances), row), np.floor(old_keys).astype(np.int64), -1
+        )
+        self._move(row, instances, old_keys)
+
+    def _move_frequencies(self, rows, frequencies, delta):
+        """Update the counts for instances of `rows` moving from
+        `frequencies` by `delta` and return their new keys"""
+        if frequencies.max() + delta >= self.counts.shape[1]:
+            self.counts = np.pad(self.counts, ((0, 0), (0, self.counts.shape[1])))
+            self.cursors = np.pad(self.cursors, ((0, 0), (0, self.cursors.shape[1])))
+        np.add.at(self.counts, (rows, frequencies), -1)
+        frequencies = frequencies + delta
+        # the u of instances joining an empty frequency are unconstrained
+        joined = self.counts[rows, frequencies] == 0
+        self.cursors[rows[joined], frequencies[joined]] = 0
+        np.add.at(self.counts, (rows, frequencies), 1)
+        cursors = self.cursors[rows, frequencies]
+        return frequencies + cursors + (1 - cursors) * self.rng.random(frequencies.shape)
+
+    def _move(self, row, instances, old_keys):
+        """Update the buffer of `row` after the keys of `instances` changed
+        from `old_keys`"""
+        keys = self.keys[row]
+        threshold = self.threshold[row]
+        new_keys = keys[instances]
+
+        # the buffer holds exactly the instances with keys below the
+        # threshold, sorted by key
+        segment = self.buffer[row, self.pos[row] : self.fill[row]]
+        segment_keys = keys[segment]
+        if (old_keys < threshold).any():
+            keep = ~np.isin(segment, instances)
+            segment, segment_keys = segment[keep], segment_keys[keep]
+
+        inserted = new_keys < threshold
+        if inserted.any():
+            order = np.argsort(new_keys[inserted])
+            at = np.searchsorted(segment_keys, new_keys[inserted][order])
+            segment = np.insert(segment, at, instances[inserted][order])
+            segment_keys = np.insert(segment_keys, at, new_keys[inserted][order])
+
+            # instances of a lower frequency come strictly first
+            threshold = min(threshold, math.floor(segment_keys[0]) + 1)
+            if len(segment) > self.buffer_size:
+                threshold = min(threshold, segment_keys[self.buffer_size])
+            end = np.searchsorted(segment_keys, threshold)
+            segment = segment[:end]
+        self._set_buffer(row, segment, threshold)
+
+    def _set_buffer(self, row, instances, threshold):
+        self.buffer[row, : len(instances)] = instances
+        self.pos[row] = 0
+        self.fill[row] = len(instances)
+        self.threshold[row] = threshold
+
+
+def simulate_batch(
+    n,
+    num_instances,
+    k,
+    target,
+    return_rate,
+    return_lag,
+    sizes,
+    max_participants,
+    buffer_size,
+    rng,
+):
+    """Simulate `n` replicates until every instance reached `target`
+    annotations in all of them.
+
+    Returns the number of participants needed per replicate (-1 if not
+    reached within `max_participants`) and, for each recruitment size in
+    `sizes`, the annotation counts of all instances per replicate."""
+    replicates = Replicates(n, num_instances, k, buffer_size, rng)
+    # annotations by participants who complete the study, counted when they
+    # arrive because the outcome is drawn upfront
+    annotations = np.zeros((n, num_instances), dtype=np.int32)
+    done = np.zeros(n, dtype=np.int64)
+    needed = np.full(n, -1, dtype=np.int64)
+    coverage = {}
+
+    # returned participants waiting to be reclaimed
+    window = 2 * return_lag + 1
+    pending = np.zeros((n, window, k), dtype=np.int64)
+    due = np.full((n, window), -1, dtype=np.int64)
+
+    for t in range(max_participants):
+        # reclaim returned participants detected in this step
+        for row, slot in zip(*np.nonzero(due == t)):
+            replicates.reclaim(row, pending[row, slot])
+            due[row, slot] = -1
+
+        sample = replicates.sample()
+        returns = rng.random(n) < return_rate
+
+        completes = np.flatnonzero(~returns)
+        counts = annotations[completes[:, None], sample[completes]] + 1
+        annotations[completes[:, None], sample[completes]] = counts
+        done[completes] += (counts == target).sum(axis=1)
+
+        returned = np.flatnonzero(returns)
+        if len(returned):
+            slot = t % window
+            assert (due[returned, slot] == -1).all()
+            pending[returned, slot] = sample[returned]
+            due[returned, slot] = t + rng.integers(1, 2 * return_lag, len(returned), endpoint=True)
+
+        reached = (done == num_instances) & (needed == -1)
+        needed[reached] = t + 1
+
+        if t + 1 in sizes:
+            coverage[t + 1] = annotations.copy()
+        if (needed != -1).all() and t + 1 >= max(sizes, default=0):
+            break
+
+    return needed, coverage
+
+
+def simulate_reference(num_instances, k, target, return_rate, return_lag, max_participants, rng=random):
+    """Simulate one replicate with `sampling.LeastFrequentSampler`, for
+    validating the vectorized simulation on small studies"""
+    sampler = sampling.LeastFrequentSampler(dict.fromkeys(range(num_instances), 0), rng)
+    annotations = [0] * num_instances
+    done = 0
+    pending = {}
+    for t in range(max_participants):
+        for sample in pending.pop(t, []):
+            sampler.update(sample, -1)
+        sample = sampler.sample(k)
+        if rng.random() < return_rate:
+            pending.setdefault(t + rng.randint(1, 2 * return_lag), []).append(sample)
+        else:
+            for instance in sample:
+                annotations[instance] += 1
+                done += annotations[instance] == target
+        if done == num_instances:
+            return t + 1
+    return -1
+
+
+def main(
+    num_instances,
+    k,
+    target,
+    return_rate,
+    return_lag,
+    replicates,
+    batch_size,
+    sizes,
+    buffer_size,
+    seed,
+    reference,
+):
+    rng = np.random.default_rng(seed)
+
+    # every instance needs `target` completed annotations of k per participant
+    lower_bound = math.ceil(num_instances * target / k)
+    expected = math.ceil(lower_bound / (1 - return_rate))
+    if not sizes:
+        sizes = [expected, math.ceil(expected * 1.05), math.ceil(expected * 1.1)]
+    max_participants = max(sizes + [expected * 3])
+
+    print(
+        f"{num_instances} instances, {k} per participant, target {target},"
+        f" return rate {return_rate}, reclaimed after ~{return_lag} participants"
+    )
+    print(f"lower bound without returns: {lower_bound}, expected: {expected}")
+
+    start = time.perf_counter()
+    needed = []
+    # per size whether all instances reached the target, the number of
+    # instances below it and the histogram of annotations per instance
+    coverage = {size: ([], [], np.zeros(target + 2)) for size in sizes}
+    for batch_start in range(0, replicates, batch_size):
+        n = min(batch_size, replicates - batch_start)
+        batch_needed, batch_coverage = simulate_batch(
+            n,
+            num_instances,
+            k,
+            target,
+            return_rate,
+            return_lag,
+            set(sizes),
+            max_participants,
+            buffer_size,
+            rng,
+        )
+        needed.append(batch_needed)
+        for size, annotations in batch_coverage.items():
+            complete, below, histogram = coverage[size]
+            complete.append(annotations.min(axis=1) >= target)
+            below.append((annotations < target).sum(axis=1))
+            counts = np.bincount(annotations.ravel())
+            if len(counts) > len(histogram):
+                histogram = np.pad(histogram, (0, len(counts) - len(histogram)))
+            histogram[: len(counts)] += counts
+            coverage[size] = (complete, below, histogram)
+        logger.info("simulated %s of %s replicates", batch_start + n, replicates)
+    elapsed = time.perf_counter() - start
+    needed = np.concatenate(needed)
+
+    print(f"simulated {replicates} replicates in {elapsed:.2f}s")
+    reached = needed[needed != -1]
+    if len(reached) < len(needed):
+        print(f"{len(needed) - len(reached)} replicates did not reach the target within {max_participants} participants")
+    if len(reached):
+        p5, p50, p95, p99 = np.percentile(reached, [5, 50, 95, 99])
+        print(
+            f"participants needed: mean {reached.mean():.1f}, sd {reached.std():.1f},"
+            f" p5 {p5:.0f}, median {p50:.0f}, p95 {p95:.0f}, p99 {p99:.0f}, max {reached.max()}"
+        )
+
+    print(f"{'recruited':>10} {'P(all reach target)':>20} {'instances below target':>24}  annotations per instance")
+    for size in sizes:
+        complete, below, histogram = coverage[size]
+        if not complete:
+            continue
+        complete = np.concatenate(complete).mean()
+        below = np.concatenate(below)
+        histogram = histogram / histogram.sum()
+        shares = ", ".join(f"{i}: {share:.3f}" for i, share in enumerate(histogram) if share)
+        print(f"{size:>10} {complete:>20.3f} {below.mean():>17.1f} ± {below.std():<4.1f}  {shares}")
+
+    if reference:
+        reference_needed = [
+            simulate_reference(num_instances, k, target, return_rate, return_lag, max_participants)
+            for _ in range(reference)
+        ]
+        print(
+            f"reference with sampling.LeastFrequentSampler ({reference} replicates):"
+            f" mean {np.mean(reference_needed):.1f}, sd {np.std(reference_needed):.1f}"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="[%(asctime)s  %(levelname)s  %(name)s  %(funcName)16s()]:  %(message)s",
+        datefmt="%d.%m. %H:%M:%S",
+        level=logging.WARNING,
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instances", type=int, default=10_000)
+    parser.add_argument("-k", type=int, default=15, help="instances per annotator")
+    parser.add_argument(
+        "--target", type=int, default=3, help="annotations required per instance"
+    )
+    parser.add_argument(
+        "--return-rate",
+        type=float,
+        default=0.1,
+        help="fraction of participants returning or timing out",
+    )
+    parser.add_argument(
+        "--return-lag",
+        type=int,
+        default=20,
+        help="mean number of participants arriving until a returned "
+        "participant is reclaimed, i.e. arrival rate x (time until returning "
+        "+ api.refresh_interval)",
+    )
+    parser.add_argument("--replicates", type=int, default=100)
+    parser.add_argument(
+        "--batch-size", type=int, default=32, help="replicates simulated at once"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[],
+        help="recruitment sizes to report the coverage for, defaults to around "
+        "the expected number of participants",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=int,
+        default=4096,
+        help="least frequent instances kept sorted per replicate",
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--reference",
+        type=int,
+        default=0,
+        help="also simulate this many replicates with the sampler of the study for comparison",
+    )
+
+    args = parser.parse_args()
+    if args.return_lag < 1:
+        parser.error("--return-lag must be at least 1")
+
+    main(
+        args.instances,
+        args.k,
+        args.target,
+        args.return_rate,
+        args.return_lag,
+        args.replicates,
+        args.batch_size,
+        args.sizes,
+        args.buffer_size,
+        args.seed,
+        args.reference,
+    )
@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+import data
+import db
+import media
+import metrics
+import plan as study_plan
+import results
+import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_study_name(config_path) -> str:
+    """The name of the study in the `study` URL parameter, the file name of
+    its config without extension"""
+    return os.path.splitext(os.path.basename(config_path))[0]
+
+
+class Study:
+    """A study served by the process and the shared resources it has loaded:
+    the parsed config, the dataset index and, once participants arrive, the
+    sampler, database connections, results store and background threads,
+    which live in the process-wide caches of the other modules."""
+
+    def __init__(self, name, config_path):
+        self.name = name
+        self.config_path = config_path
+        self.config = None
+        self.dataset = None
+        self.last_used = time.monotonic()
+        # reruns currently using the study, which is never evicted meanwhile
+        self.active = 0
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        with self._load_lock:
+            self.config = utils.load_config(self.config_path)
+            self.dataset = data.get_dataset(
+                self.config.paths.dataset,
+                self.config.data.instance_id_key,
+                self.config.data.get("instance_cache_size", 1024),
+            )
+
+    def warm_up(self):
+        """Load everything the first participants need, see `data.warm_up`"""
+        metrics.configure(self.config)
+        data.warm_up(self.config, self.dataset)
+        media.get_media_cache(self.config)
+        results.get_results_store(self.config, self.config_path)
+        study_plan.get_study_plan(
+            self.config_path, self.config.data.instances_per_annotator
+        )
+
+    def memory(self) -> int:
+        """Estimate the memory held by the study in bytes"""
+        if self.dataset is None:
+            return 0
+        size = self.dataset.estimate_memory()
+        if data.has_sampler(self.config):
+            size += len(self.dataset) * data.SAMPLER_BYTES
+        size += media.get_memory(self.config)
+        return size
+
+    def close(self, release_dataset: bool = True):
+        """Release all resources of the study, they are loaded again if the
+        study is used afterwards"""
+        if self.config is None:
+            # never loaded
+            return
+        logger.info("closing study %s", self.name)
+        try:
+            data.stop_study(self.config)
+            media.close_media_cache(self.config)
+            results.close_results_store(self.config, self.config_path)
+            db.close_database(self.config.paths.db)
+            if release_dataset:
+                data.release_dataset(
+                    self.config.paths.dataset, self.config.data.instance_id_key
+                )
+        except Exception:
+            logger.warning("could not close study %s", self.name, exc_info=True)
+
+
+class StudyRegistry:
+    """The studies served by one Streamlit process, selected by the `study`
+    URL parameter.
+
+    Studies are loaded on first use. Afterwards the least recently used
+    studies are evicted while more than `max_studies` are loaded or their
+    estimated memory exceeds `max_memory` bytes, but only once they have
+    been idle for `min_idle` seconds. Evicted studies are closed in the
+    background and loaded again when the next participant arrives.
+    """
+
+    def __init__(
+        self, config_paths, max_studies=None, max_memory=None, min_idle: float = 60
+    ):
+        self.config_paths = {}
+        for config_path in config_paths:
+            name = get_study_name(config_path)
+            if name in self.config_paths:
+                raise ValueError(
+                    f"config files {config_path} and {self.config_paths[name]}"
+                    f" have the same study name {name}"
+                )
+            self.config_paths[name] = config_path
+        self.max_studies = max_studies
+        self.max_memory = max_memory
+        self.min_idle = min_idle
+        # name -> Study, least recently used first
+        self._loaded = OrderedDict()
+        self._closing = {}
+        self._lock = threading.Lock()
+        # notified when a study has been closed
+        self._closed = threading.Condition(self._lock)
+
+    def __contains__(self, name):
+        return name in self.config_paths
+
+    @contextmanager
+    def use(self, name):
+        """Load the study `name` if needed and keep it loaded for the
+        duration of the block"""
+        with self._lock:
+            # the previous instance of the study has to finish writing first
+            while name in self._closing:
+                self._closed.wait()
+            study = self._loaded.get(name)
+            if study is None:
+                study = self._loaded[name] = Study(name, self.config_paths[name])
+            self._loaded.move_to_end(name)
+            study.active += 1
+
+        try:
+            study.load()
+            yield study
+        finally:
+            with self._lock:
+                study.active -= 1
+                study.last_used = time.monotonic()
+            self.evict()
+
+    def warm_up(self, name):
+        """Load the study `name` and warm it up before participants arrive"""
+        start = time.perf_counter()
+        with self.use(name) as study:
+            study.warm_up()
+        logger.info("warmed up study %s in %.2fs", name, time.perf_counter() - start)
+
+    def evict(self):
+        """Evict idle studies while over the configured limits"""
+        now = time.monotonic()
+        with self._lock:
+            while self._over_limits():
+                idle = [
+                    study
+                    for study in self._loaded.values()
+                    if not study.active and now - study.last_used >= self.min_idle
+                ]
+                if not idle:
+                    break
+                study = idle[0]
+                del self._loaded[study.name]
+                self._closing[study.name] = study
+                # other studies may share the dataset file
+                shared = any(
+                    other.config is not None
+                    and other.config.paths.dataset == study.config.paths.dataset
+                    for other in self._loaded.values()
+                )
+                logger.info("evicting idle study %s", study.name)
+                threading.Thread(
+                    target=self._close,
+                    args=(study, not shared),
+                    name=f"close-{study.name}",
+                    daemon=True,
+                ).start()
+
+    def _close(self, study, release_dataset):
+        try:
+            study.close(release_dataset)
+        finally:
+            with self._lock:
+                if self._closing.get(study.name) is study:
+                    del self._closing[study.name]
+                self._closed.notify_all()
+
+    def _over_limits(self) -> bool:
+        if self.max_studies is not None and len(self._loaded) > self.max_studies:
+            return True
+        if self.max_memory is not None:
+            memory = sum(study.memory() for study in self._loaded.values())
+            return memory > self.max_memory
+        return False
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry(
+    config_paths, max_studies=None, max_memory=None, min_idle: float = 60
+) -> StudyRegistry:
+    """Return the process-wide `StudyRegistry`, created on first use"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = StudyRegistry(config_paths, max_studies, max_memory, min_idle)
+    return _registry
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sqlite3
+
+from munch import Munch
+import pytest
+
+import data
+import db
+
+
+def create_study(tmp_path, num_instances=40, k=5):
+    dataset_path = tmp_path / "dataset.jsonl"
+    with open(dataset_path, "w") as h:
+        for i in range(num_instances):
+            h.write(json.dumps({"post_id": i}) + "\n")
+    db_path = str(tmp_path / "study.sqlite")
+    con = sqlite3.connect(db_path)
+    with con:
+        db.create_schema(con.cursor())
+        con.executemany(
+            "INSERT INTO instance_frequency VALUES(?, 0)",
+            [(i,) for i in range(num_instances)],
+        )
+    con.close()
+    config = Munch.fromDict(
+        {
+            "paths": {"db": db_path, "dataset": str(dataset_path)},
+            "data": {
+                "instance_id_key": "post_id",
+                "instances_per_annotator": k,
+                "attention_per_annotator": 0,
+            },
+        }
+    )
+    dataset = data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+    return config, dataset
+
+
+def assign(config, dataset, user_id):
+    queue = data.get_admission_queue(config)
+    with db.get_database(config.paths.db).connect() as con:
+        return queue.assign(con, dataset, user_id)
+
+
+def get_frequencies(config):
+    con = sqlite3.connect(config.paths.db)
+    frequencies = dict(con.execute("SELECT instance_id, frequency FROM instance_frequency"))
+    con.close()
+    return frequencies
+
+
+def test_burst(tmp_path):
+    config, dataset = create_study(tmp_path)
+    user_ids = [f"user{i}" for i in range(32)]
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        samples = dict(
+            zip(user_ids, executor.map(lambda u: assign(config, dataset, u), user_ids))
+        )
+
+    assert all(len(set(sample)) == 5 for sample in samples.values())
+    frequencies = get_frequencies(config)
+    assert max(frequencies.values()) - min(frequencies.values()) <= 1
+    assert sum(frequencies.values()) == 32 * 5
+
+    con = sqlite3.connect(config.paths.db)
+    for user_id, sample in samples.items():
+        assert data.get_assigned_instances(con, user_id) == sample
+    con.close()
+
+
+def test_error_only_fails_its_user(tmp_path, monkeypatch):
+    config, dataset = create_study(tmp_path)
+    _assign = data._assign
+
+    def failing_assign(config, cur, dataset, user_id):
+        sample = _assign(config, cur, dataset, user_id)
+        if user_id == "broken":
+            raise RuntimeError("broken user")
+        return sample
+
+    monkeypatch.setattr(data, "_assign", failing_assign)
+    # a single batch
+    monkeypatch.setattr(data.get_admission_queue(config), "window", 1)
+    monkeypatch.setattr(data.get_admission_queue(config), "batch_size", 3)
+
+    user_ids = ["before", "broken", "after"]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = {
+            user_id: executor.submit(assign, config, dataset, user_id)
+            for user_id in user_ids
+        }
+    with pytest.raises(RuntimeError):
+        futures["broken"].result()
+    samples = [futures[user_id].result() for user_id in ("before", "after")]
+
+    con = sqlite3.connect(config.paths.db)
+    assert data.get_assigned_instances(con, "broken") is None
+    con.close()
+    frequencies = get_frequencies(config)
+    assert sum(frequencies.values()) == 10
+    assert set(samples[0]).isdisjoint(samples[1])
+
+    # the sampler was reloaded without the rolled back sample
+    sample = assign(config, dataset, "next")
+    assert set(sample).isdisjoint(samples[0] + samples[1])
@@ -0,0 +1,157 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import socket
+import sqlite3
+import threading
+import urllib.error
+
+from munch import Munch
+import pytest
+
+from assignment_service import AssignmentService
+import data
+import db
+
+
+def create_study(tmp_path, num_instances=30, k=5, pool_size=0):
+    dataset_path = tmp_path / "dataset.jsonl"
+    with open(dataset_path, "w") as h:
+        for i in range(num_instances):
+            h.write(json.dumps({"post_id": i}) + "\n")
+    db_path = str(tmp_path / "study.sqlite")
+    con = sqlite3.connect(db_path)
+    with con:
+        db.create_schema(con.cursor())
+        con.executemany(
+            "INSERT INTO instance_frequency VALUES(?, 0)",
+            [(i,) for i in range(num_instances)],
+        )
+    con.close()
+    return Munch.fromDict(
+        {
+            "paths": {"db": db_path, "dataset": str(dataset_path)},
+            "data": {
+                "instance_id_key": "post_id",
+                "instances_per_annotator": k,
+                "attention_per_annotator": 0,
+                "pool_size": pool_size,
+            },
+            # the refresher never reaches prolific in tests
+            "api": {
+                "study_id": str(tmp_path),
+                "token_file": str(tmp_path / "missing_token.txt"),
+                "refresh_interval": 3600,
+            },
+            "service": {"url": ""},
+        }
+    )
+
+
+def get_frequencies(config):
+    con = sqlite3.connect(config.paths.db)
+    frequencies = dict(con.execute("SELECT instance_id, frequency FROM instance_frequency"))
+    con.close()
+    return frequencies
+
+
+def start_service(config):
+    """Run an `AssignmentService` on a background thread, return its url"""
+    started = threading.Event()
+    ports = []
+
+    def on_started(port):
+        ports.append(port)
+        started.set()
+
+    service = AssignmentService(config)
+    threading.Thread(
+        target=asyncio.run,
+        args=(service.serve("localhost", 0, started=on_started),),
+        daemon=True,
+    ).start()
+    assert started.wait(10)
+    return f"http://localhost:{ports[0]}"
+
+
+def get_closed_url():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return f"http://localhost:{port}"
+
+
+def test_rejection_applied_once_by_two_refreshers(tmp_path):
+    config = create_study(tmp_path)
+    dataset = data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+    sample = data.get_user_instances(config, dataset, "u1")
+    data.stop_study(config)
+
+    # e.g. the assignment service and a worker that fell back to in-process
+    # assignment, each with its own snapshot
+    export = [("u1", "ACTIVE")], [("u1", "RETURNED")]
+    refreshers = [data.DemographicsRefresher(config, 60) for _ in range(2)]
+    for rows in export:
+        for refresher in refreshers:
+            refresher.apply(rows)
+
+    frequencies = get_frequencies(config)
+    assert all(frequencies[instance_id] == 0 for instance_id in sample)
+    assert min(frequencies.values()) == 0
+
+
+def test_fallback_stops_background_threads_once_service_is_back(tmp_path):
+    config = create_study(tmp_path, pool_size=2)
+    dataset = data.get_dataset(config.paths.dataset, config.data.instance_id_key)
+    key = (config.api.study_id, config.paths.db)
+
+    config.service.url = get_closed_url()
+    data.get_user_instances(config, dataset, "fallback")
+    # assigned in-process, which needs the refresher and the pool
+    assert key in data._refreshers
+    assert config.paths.db in data._pools
+    refresher = data._refreshers[key]
+    pool = data._pools[config.paths.db]
+
+    # the service runs its own, the worker's are stopped
+    service_config = Munch.fromDict(config.toDict())
+    service_config.service.url = ""
+    config.service.url = start_service(service_config)
+    data.get_user_instances(config, dataset, "served")
+    assert key not in data._refreshers
+    assert config.paths.db not in data._pools
+    refresher.join(5)
+    pool.join(5)
+    assert not refresher.is_alive() and not pool.is_alive()
+
+
+def test_batches(tmp_path, monkeypatch):
+    config = create_study(tmp_path)
+    _assign = data._assign
+
+    def failing_assign(config, cur, dataset, user_id):
+        sample = _assign(config, cur, dataset, user_id)
+        if user_id == "broken":
+            raise RuntimeError("broken user")
+        return sample
+
+    monkeypatch.setattr(data, "_assign", failing_assign)
+    service_config = Munch.fromDict(config.toDict())
+    config.service.url = start_service(service_config)
+
+    user_ids = [f"user{i}" for i in range(17)] + ["broken"]
+    with ThreadPoolExecutor(max_workers=len(user_ids)) as executor:
+        futures = {
+            user_id: executor.submit(data.request_assignment, config, user_id)
+            for user_id in user_ids
+        }
+    with pytest.raises(urllib.error.HTTPError):
+        futures.pop("broken").result()
+    samples = {user_id: future.result() for user_id, future in futures.items()}
+
+    frequencies = get_frequencies(config)
+    assert sum(frequencies.values()) == 17 * 5
+    assert max(frequencies.values()) - min(frequencies.values()) <= 1
+    # returning users get the same sample
+    assert data.request_assignment(config, "user0") == samples["user0"]
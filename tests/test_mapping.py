@@ -0,0 +1,69 @@
+import json
+import sqlite3
+
+from munch import Munch
+
+import data
+import db
+
+
+def setup():
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    db.create_schema(cur)
+    cur.executemany(
+        "INSERT INTO instance_frequency VALUES(?, 0)", [(i,) for i in range(10)]
+    )
+    data.save_assignment(cur, "user", [1, 2, 3])
+    data.update_frequencies(cur, [1, 2, 3])
+    return cur
+
+
+def get_frequencies(cur):
+    return dict(cur.execute("SELECT instance_id, frequency FROM instance_frequency"))
+
+
+def test_delete_mapping():
+    cur = setup()
+    revision = data.read_mapping_revision(cur)
+
+    cur.execute("DELETE FROM mapping WHERE user_id = 'user'")
+    assert data.get_assigned_instances(cur, "user") is None
+    assert get_frequencies(cur) == dict.fromkeys(range(10), 0)
+    assert data.read_mapping_revision(cur) > revision
+
+    # can be assigned again
+    data.save_assignment(cur, "user", [4, 5, 6])
+    assert data.get_assigned_instances(cur, "user") == [4, 5, 6]
+
+
+def test_update_mapping():
+    cur = setup()
+    cur.execute(
+        "UPDATE mapping SET instance_ids = ? WHERE user_id = 'user'",
+        (json.dumps([3, 4, 5]),),
+    )
+    assert data.get_assigned_instances(cur, "user") == [3, 4, 5]
+    assert get_frequencies(cur) == {i: 1 if i in (3, 4, 5) else 0 for i in range(10)}
+
+
+def test_delete_mapping_of_rejected_user():
+    cur = setup()
+    config = Munch(data=Munch(pool_size=0))
+    data.update_participant_status(config, cur, {"user": "REJECTED"})
+
+    # already removed from the frequencies
+    cur.execute("DELETE FROM mapping WHERE user_id = 'user'")
+    assert get_frequencies(cur) == dict.fromkeys(range(10), 0)
+
+
+def test_delete_mapping_releases_claimed_reservation():
+    cur = setup()
+    data.add_reservations(cur, [[7, 8, 9]])
+    data.update_frequencies(cur, [7, 8, 9])
+    assert data.claim_reservation(cur, "pooled") == [7, 8, 9]
+    data.save_assignment(cur, "pooled", [7, 8, 9])
+
+    cur.execute("DELETE FROM mapping WHERE user_id = 'pooled'")
+    data.add_reservations(cur, [[4, 5, 6]])
+    assert data.claim_reservation(cur, "pooled") == [4, 5, 6]
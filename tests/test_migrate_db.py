@@ -0,0 +1,88 @@
+import json
+import os
+import sqlite3
+
+import yaml
+
+import data
+import db
+import migrate_db
+
+
+def create_v0_study(tmp_path):
+    """A database as created before schema versions were introduced"""
+    dataset_path = tmp_path / "dataset.jsonl"
+    with open(dataset_path, "w") as h:
+        for i in range(10):
+            h.write(json.dumps({"post_id": i}) + "\n")
+    db_path = str(tmp_path / "study.sqlite")
+    con = sqlite3.connect(db_path)
+    with con:
+        con.execute("CREATE TABLE mapping(user_id TEXT, instance_ids JSON1)")
+        con.execute("CREATE TABLE participant_status(user_id TEXT, status TEXT)")
+        con.executemany(
+            "INSERT INTO mapping VALUES(?, ?)",
+            [
+                ("a", json.dumps([0, 1, 2])),
+                ("b", json.dumps([2, 3, 4])),
+                ("c", json.dumps([4, 5, 6])),
+                # only the first mapping of a user counts
+                ("a", json.dumps([7, 8, 9])),
+            ],
+        )
+        con.executemany(
+            "INSERT INTO participant_status VALUES(?, ?)",
+            [("a", "ACTIVE"), ("b", "APPROVED"), ("c", "ACTIVE"), ("c", "RETURNED")],
+        )
+    con.close()
+
+    config_path = str(tmp_path / "config.yml")
+    with open(config_path, "w") as h:
+        yaml.safe_dump(
+            {
+                "paths": {"db": db_path, "dataset": str(dataset_path)},
+                "data": {"instance_id_key": "post_id", "instances_per_annotator": 3},
+            },
+            h,
+        )
+    return config_path, db_path
+
+
+def test_migrate_v0(tmp_path):
+    config_path, db_path = create_v0_study(tmp_path)
+    migrate_db.main(config_path)
+    assert os.path.exists(f"{db_path}.v0.bak")
+
+    con = sqlite3.connect(db_path)
+    assert db.get_schema_version(con) == db.SCHEMA_VERSION
+    assert data.get_assigned_instances(con, "a") == [0, 1, 2]
+    assert dict(con.execute("SELECT user_id, status FROM participant_status")) == {
+        "a": "ACTIVE",
+        "b": "APPROVED",
+        "c": "RETURNED",
+    }
+
+    # c is rejected
+    frequencies = dict(con.execute("SELECT instance_id, frequency FROM instance_frequency"))
+    assert frequencies == {0: 1, 1: 1, 2: 2, 3: 1, 4: 1, 5: 0, 6: 0, 7: 0, 8: 0, 9: 0}
+    assert dict(con.execute("SELECT * FROM frequency_histogram WHERE instances > 0")) == {
+        0: 5,
+        1: 4,
+        2: 1,
+    }
+    assert dict(con.execute("SELECT * FROM status_count")) == {
+        "ACTIVE": 1,
+        "APPROVED": 1,
+        "RETURNED": 1,
+    }
+
+    # the triggers of the latest version are in place
+    with con:
+        con.execute("DELETE FROM mapping WHERE user_id = 'b'")
+    assert data.get_assigned_instances(con, "b") is None
+    res = con.execute("SELECT frequency FROM instance_frequency WHERE instance_id = 2")
+    assert res.fetchone() == (1,)
+    con.close()
+
+    # nothing left to do
+    migrate_db.main(config_path)
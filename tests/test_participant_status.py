@@ -0,0 +1,67 @@
+import sqlite3
+
+from munch import Munch
+
+import data
+import db
+
+
+def setup(pool_size):
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    db.create_schema(cur)
+    cur.executemany(
+        "INSERT INTO instance_frequency VALUES(?, 0)", [(i,) for i in range(10)]
+    )
+    config = Munch(data=Munch(pool_size=pool_size))
+    return config, cur
+
+
+def get_frequencies(cur):
+    return dict(cur.execute("SELECT instance_id, frequency FROM instance_frequency"))
+
+
+def get_unclaimed(cur):
+    res = cur.execute("SELECT COUNT(*) FROM reservation WHERE user_id IS NULL")
+    return res.fetchone()[0]
+
+
+def test_reject_and_restore_with_pool():
+    config, cur = setup(pool_size=5)
+    data.save_assignment(cur, "user", [1, 2, 3])
+    data.update_frequencies(cur, [1, 2, 3])
+    expected = get_frequencies(cur)
+
+    data.update_participant_status(config, cur, {"user": "REJECTED"})
+    # reclaimed into the pool, still counted
+    assert get_unclaimed(cur) == 1
+    assert get_frequencies(cur) == expected
+
+    data.update_participant_status(config, cur, {"user": "APPROVED"})
+    # taken out of the pool again instead of being counted twice
+    assert get_unclaimed(cur) == 0
+    assert get_frequencies(cur) == expected
+
+
+def test_restore_after_pool_sample_was_claimed():
+    config, cur = setup(pool_size=5)
+    data.save_assignment(cur, "user", [1, 2, 3])
+    data.update_frequencies(cur, [1, 2, 3])
+
+    data.update_participant_status(config, cur, {"user": "REJECTED"})
+    assert data.claim_reservation(cur, "other") == [1, 2, 3]
+    data.update_participant_status(config, cur, {"user": "APPROVED"})
+    # both users count
+    assert get_frequencies(cur) == {i: 2 if i in (1, 2, 3) else 0 for i in range(10)}
+
+
+def test_reject_and_restore_without_pool():
+    config, cur = setup(pool_size=0)
+    data.save_assignment(cur, "user", [1, 2, 3])
+    data.update_frequencies(cur, [1, 2, 3])
+    expected = get_frequencies(cur)
+
+    data.update_participant_status(config, cur, {"user": "RETURNED"})
+    assert get_frequencies(cur) == dict.fromkeys(range(10), 0)
+    data.update_participant_status(config, cur, {"user": "APPROVED"})
+    assert get_frequencies(cur) == expected
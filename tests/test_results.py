@@ -0,0 +1,89 @@
+import json
+import os
+import sqlite3
+import time
+
+import db
+from results import ResultsStore
+
+
+def count_writes(store):
+    writes = []
+    _write = store._write
+
+    def write(pending):
+        writes.append(dict(pending))
+        _write(pending)
+
+    store._write = write
+    return writes
+
+
+def test_burst_is_written_once(tmp_path):
+    store = ResultsStore(directory=str(tmp_path), flush_interval=0.2)
+    writes = count_writes(store)
+    for page in range(10):
+        store.save("user", {"page": page})
+    time.sleep(0.5)
+    assert len(writes) == 1
+    store.close()
+
+    assert len(writes) == 1
+    with open(tmp_path / "user.json") as h:
+        assert json.load(h) == {"page": 9}
+    assert os.listdir(tmp_path) == ["user.json"]
+
+
+def test_unchanged_responses_are_skipped(tmp_path):
+    store = ResultsStore(directory=str(tmp_path), flush_interval=0)
+    store.save("user", {"page": 1})
+    store.flush()
+    writes = count_writes(store)
+    store.save("user", {"page": 1})
+    store.close()
+    assert writes == []
+
+
+def test_close_writes_pending_responses(tmp_path):
+    # the writer would not flush before the end of the test
+    store = ResultsStore(directory=str(tmp_path), flush_interval=60)
+    store.save("user", {"page": 1})
+    store.close()
+
+    store = ResultsStore(directory=str(tmp_path))
+    assert json.loads(store.load("user")) == {"page": 1}
+    store.close()
+
+
+def test_replaces_file_atomically(tmp_path):
+    store = ResultsStore(directory=str(tmp_path), flush_interval=60)
+    store.save("user", {"page": 1})
+    store.flush()
+    # a crash while writing leaves the previous file intact
+    with open(tmp_path / "user.json.tmp", "w") as h:
+        h.write('{"pa')
+    store.save("user", {"page": 2})
+    store.close()
+
+    with open(tmp_path / "user.json") as h:
+        assert json.load(h) == {"page": 2}
+    assert sorted(os.listdir(tmp_path)) == ["user.json"]
+
+
+def test_database_backend(tmp_path):
+    path = str(tmp_path / "study.sqlite")
+    con = sqlite3.connect(path)
+    with con:
+        db.create_schema(con.cursor())
+    con.close()
+
+    database = db.Database(path)
+    store = ResultsStore(database=database, flush_interval=60)
+    store.save("user", {"page": 1})
+    store.save("user", {"page": 2})
+    store.close()
+
+    store = ResultsStore(database=database)
+    assert json.loads(store.load("user")) == {"page": 2}
+    store.close()
+    database.close()
@@ -0,0 +1,105 @@
+import json
+import sqlite3
+
+import yaml
+
+import data
+import db
+import results
+import studies
+
+
+def create_config(tmp_path, name):
+    dataset_path = tmp_path / "dataset.jsonl"
+    if not dataset_path.exists():
+        with open(dataset_path, "w") as h:
+            for i in range(20):
+                h.write(json.dumps({"post_id": i}) + "\n")
+    db_path = str(tmp_path / f"{name}.sqlite")
+    con = sqlite3.connect(db_path)
+    with con:
+        db.create_schema(con.cursor())
+        con.executemany(
+            "INSERT INTO instance_frequency VALUES(?, 0)", [(i,) for i in range(20)]
+        )
+    con.close()
+
+    config_path = str(tmp_path / f"{name}.yml")
+    with open(config_path, "w") as h:
+        yaml.safe_dump(
+            {
+                "paths": {"db": db_path, "dataset": str(dataset_path)},
+                "data": {
+                    "instance_id_key": "post_id",
+                    "instances_per_annotator": 5,
+                    "attention_per_annotator": 0,
+                },
+                # the refresher never reaches prolific in tests
+                "api": {
+                    "study_id": name,
+                    "token_file": str(tmp_path / "missing_token.txt"),
+                    "refresh_interval": 3600,
+                },
+                "results": {"backend": "db"},
+            },
+            h,
+        )
+    return config_path
+
+
+def visit(registry, name, user_id):
+    with registry.use(name) as study:
+        sample = data.get_user_instances(study.config, study.dataset, user_id)
+        store = results.get_results_store(study.config, study.config_path)
+        store.save(user_id, {"page": 1})
+        return study, sample
+
+
+def wait_closed(registry):
+    with registry._lock:
+        while registry._closing:
+            registry._closed.wait()
+
+
+def test_evict_close_and_reload(tmp_path):
+    registry = studies.StudyRegistry(
+        [create_config(tmp_path, "a"), create_config(tmp_path, "b")],
+        max_studies=1,
+        min_idle=0,
+    )
+    study_a, sample = visit(registry, "a", "user")
+    config = study_a.config
+    store_key = results.get_location(config, study_a.config_path)
+
+    visit(registry, "b", "user")
+    wait_closed(registry)
+    assert list(registry._loaded) == ["b"]
+    # closed, the responses were written before
+    assert not data.has_sampler(config)
+    assert config.paths.db not in db._databases
+    assert store_key not in results._stores
+    con = sqlite3.connect(config.paths.db)
+    assert con.execute("SELECT data FROM results").fetchall() == [('{"page": 1}',)]
+    con.close()
+
+    # loaded again with the same state
+    study, reloaded = visit(registry, "a", "user")
+    assert study is not study_a
+    assert reloaded == sample
+    wait_closed(registry)
+    assert list(registry._loaded) == ["a"]
+
+
+def test_active_study_is_not_evicted(tmp_path):
+    registry = studies.StudyRegistry(
+        [create_config(tmp_path, "a"), create_config(tmp_path, "b")],
+        max_studies=1,
+        min_idle=0,
+    )
+    with registry.use("a"):
+        visit(registry, "b", "user")
+        wait_closed(registry)
+        # over the limit until "a" is done
+        assert list(registry._loaded) == ["a"]
+    wait_closed(registry)
+    assert list(registry._loaded) == ["a"]
@@ -1,5 +1,7 @@
-import time
+import os
+import threading
 
+from munch import Munch
 import streamlit as st
 
 
@@ -13,19 +15,28 @@ scroll_to_top_js = """
 """
 
 
-# source: https://discuss.streamlit.io/t/question-about-scroll-event/59333/6
 def next_on_click(pages):
     def callback():
         pages.next()
-        temp = st.empty()
-        with temp:
-            st.components.v1.html(scroll_to_top_js)
-            time.sleep(0.3)  # To make sure the script can execute before being deleted
-        temp.empty()
+        # callbacks run before the rerun, so the script is rendered by
+        # `scroll_to_top` instead of waiting here for it to execute
+        st.session_state["_scroll_to_top"] = st.session_state.get("_scroll_to_top", 0) + 1
 
     return callback
 
 
+# source: https://discuss.streamlit.io/t/question-about-scroll-event/59333/6
+def scroll_to_top():
+    """Scroll to the top of the page if the page has just been changed with
+    the next button"""
+    count = st.session_state.get("_scroll_to_top", 0)
+    if count != st.session_state.get("_scrolled_to_top", 0):
+        st.session_state["_scrolled_to_top"] = count
+        # the counter makes consecutive scripts differ, identical ones are
+        # not executed again
+        st.components.v1.html(f"{scroll_to_top_js}<!-- {count} -->", height=0)
+
+
 def get_attention_indices_offsets(num_instances, num_attention):
     """This function equally spaces out the required number of attention checks
     over the number of instances and returns their indices
@@ -45,3 +56,20 @@ def get_attention_indices_offsets(num_instances, num_attention):
             attention_offset += 1
 
     return attention_indices, attention_offsets
+
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def load_config(config_path):
+    """Parse the config file once and return the cached result until the
+    file changes. The returned config is shared between sessions and must
+    not be modified."""
+    mtime = os.stat(config_path).st_mtime_ns
+    with _configs_lock:
+        cached = _configs.get(config_path)
+        if cached is None or cached[0] != mtime:
+            with open(config_path) as h:
+                cached = _configs[config_path] = (mtime, Munch.fromYAML(h))
+    return cached[1]